@@ -0,0 +1,186 @@
+'''
+On-disk cache of intermediate files (eg. per-plane CaImAn memmaps) that are
+shared between pipeline stages, and of results (eg. found ROIs) that can be
+reused when a stage is re-run with the same inputs.
+
+Entries are keyed on the identity of the source files (path, size and
+modification time) and on the transform that was applied to them, so a
+stale entry can never be returned after a source video changes. The total
+size of the cache is kept under a budget by evicting the least recently used
+entries.
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+# default location & size budget of the cache
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".calcium_imaging_analysis", "cache")
+DEFAULT_MAX_CACHE_SIZE  = 20 # GB
+
+# default location & size budget of the cache of results (eg. found ROIs)
+DEFAULT_RESULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".calcium_imaging_analysis", "results")
+DEFAULT_MAX_RESULT_CACHE_SIZE  = 2 # GB
+
+# version of the cached file formats -- bump this to invalidate existing entries
+CACHE_VERSION = 1
+
+INDEX_FILENAME = "index.json"
+
+def file_identity(path):
+    # identify a file by its absolute path, size and modification time
+    stat = os.stat(path)
+
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def source_identity(path):
+    # identify a source video by its files -- the shifts sidecar of a virtual motion-corrected video also depends on the video it's computed from
+    identity = [file_identity(path)]
+
+    if path.endswith(".npz"):
+        with np.load(path) as sidecar:
+            if 'video_path' in sidecar.files:
+                identity.append(file_identity(str(sidecar['video_path'])))
+
+    return identity
+
+def array_digest(array):
+    # create a short digest of an array (or None)
+    if array is None:
+        return None
+
+    array = np.ascontiguousarray(array)
+
+    return "{}-{}-{}".format(array.dtype.str, array.shape, hashlib.sha1(array.tobytes()).hexdigest())
+
+class IntermediateCache():
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_size=DEFAULT_MAX_CACHE_SIZE):
+        self.directory = directory
+        self.max_size  = int(max_size*1e9) # maximum total size of cached files (bytes)
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        self.index_path = os.path.join(self.directory, INDEX_FILENAME)
+
+        self.load_index()
+
+    def load_index(self):
+        self.index = {}
+
+        if os.path.exists(self.index_path):
+            try:
+                self.index = json.load(open(self.index_path))
+            except:
+                self.index = {}
+
+        # forget about entries whose files have disappeared
+        for key in list(self.index.keys()):
+            if not os.path.exists(self.index[key]['path']):
+                del self.index[key]
+
+    def save_index(self):
+        temp_path = self.index_path + ".temp"
+
+        json.dump(self.index, open(temp_path, "w"))
+
+        os.replace(temp_path, self.index_path)
+
+    def set_max_size(self, max_size):
+        self.max_size = int(max_size*1e9)
+
+        self.evict()
+
+    def key(self, video_paths, **transform):
+        # create a key from the identity of the source files and the transform applied to them
+        description = {'version' : CACHE_VERSION,
+                       'sources' : [ source_identity(path) for path in video_paths ],
+                       'transform': { name: transform[name] for name in sorted(transform.keys()) }}
+
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        # return the path of the cached file with the given key (or None if it isn't cached)
+        if key not in self.index.keys():
+            return None
+
+        path = self.index[key]['path']
+
+        if not os.path.exists(path):
+            del self.index[key]
+            self.save_index()
+
+            return None
+
+        self.index[key]['last_access'] = time.time()
+        self.save_index()
+
+        return path
+
+    def add(self, key, path):
+        # move a file into the cache and return its new path
+        new_path = os.path.join(self.directory, os.path.basename(path))
+
+        if os.path.abspath(path) != os.path.abspath(new_path):
+            shutil.move(path, new_path)
+
+        if key in self.index.keys() and self.index[key]['path'] != new_path:
+            self.remove_file(self.index[key]['path'])
+
+        self.index[key] = {'path'       : new_path,
+                           'size'       : os.path.getsize(new_path),
+                           'last_access': time.time()}
+
+        self.evict(keep=[key])
+
+        return new_path
+
+    def remove(self, key):
+        if key in self.index.keys():
+            self.remove_file(self.index[key]['path'])
+
+            del self.index[key]
+
+            self.save_index()
+
+    def size(self):
+        return np.sum([ entry['size'] for entry in self.index.values() ])
+
+    def evict(self, keep=[]):
+        # remove least recently used entries until the cache fits in its budget
+        keys = sorted(self.index.keys(), key=lambda key: self.index[key]['last_access'])
+
+        total_size = self.size()
+
+        for key in keys:
+            if total_size <= self.max_size:
+                break
+
+            if key in keep:
+                continue
+
+            if self.remove_file(self.index[key]['path']):
+                total_size -= self.index[key]['size']
+
+                del self.index[key]
+
+        self.save_index()
+
+    def clear(self):
+        for key in list(self.index.keys()):
+            if self.remove_file(self.index[key]['path']):
+                del self.index[key]
+
+        self.save_index()
+
+    def remove_file(self, path):
+        # files that are still memory-mapped can't be removed on some platforms
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            return True
+        except:
+            return False
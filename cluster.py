@@ -0,0 +1,92 @@
+'''
+Long-lived CaImAn cluster that is shared between pipeline stages.
+
+Starting a cluster spawns a pool of worker processes (each of which imports
+CaImAn), so rather than creating one for every motion correction or ROI
+finding run, the cluster is started the first time it is needed, reused
+afterwards, restarted if it has died and shut down when the app exits.
+'''
+
+import atexit
+import multiprocessing.pool
+import caiman as cm
+
+# how long to wait (in seconds) for the cluster to answer before considering it dead
+PING_TIMEOUT = 10
+
+def ping():
+    return True
+
+class ClusterManager():
+    def __init__(self, backend='multiprocessing', n_processes=None):
+        self.backend     = backend
+        self.n_processes = n_processes # number of processes to start (None = one per core)
+
+        self.c                   = None
+        self.dview               = None
+        self.n_processes_running = 1
+
+        # make sure the worker processes don't outlive the app
+        atexit.register(self.stop)
+
+    def get(self):
+        # return (c, dview, n_processes), starting or restarting the cluster if needed
+        if self.dview is None:
+            self.start()
+        elif not self.is_alive():
+            print("Cluster is not responding. Restarting it.")
+
+            self.stop()
+            self.start()
+
+        return self.c, self.dview, self.n_processes_running
+
+    def start(self):
+        print("Starting cluster.")
+
+        # stop any server left behind by a previous session
+        cm.stop_server()
+
+        self.c, self.dview, self.n_processes_running = cm.cluster.setup_cluster(backend=self.backend, n_processes=self.n_processes, single_thread=False)
+
+    def is_running(self):
+        # whether the cluster has been started (without checking that it's still responding)
+        return self.dview is not None
+
+    def is_alive(self):
+        if self.dview is None:
+            return False
+
+        try:
+            if self.backend == 'multiprocessing':
+                if self.dview._state != multiprocessing.pool.RUN:
+                    return False
+
+                return self.dview.apply_async(ping).get(timeout=PING_TIMEOUT)
+            else:
+                return len(self.c.ids) > 0
+        except:
+            return False
+
+    def stop(self):
+        if self.dview is None:
+            return
+
+        print("Stopping cluster.")
+
+        try:
+            if self.backend == 'multiprocessing':
+                self.dview.terminate()
+            else:
+                try:
+                    self.dview.terminate()
+                except:
+                    self.dview.shutdown()
+        except:
+            pass
+
+        cm.stop_server()
+
+        self.c                   = None
+        self.dview               = None
+        self.n_processes_running = 1
@@ -2,10 +2,12 @@ import os
 import json
 import numpy as np
 import tifffile
-import cv2
 import csv
 
 import utilities
+from footprints import footprint_stats
+from cache import IntermediateCache, DEFAULT_RESULT_CACHE_DIRECTORY
+from cluster import ClusterManager
 
 # set default parameters dictionary
 DEFAULT_PARAMS = {'use_patches'          : True,
@@ -40,7 +42,13 @@ DEFAULT_PARAMS = {'use_patches'          : True,
                   'neuropil_radius_ratio': 3,
                   'inner_neuropil_radius': 2,
                   'min_neuropil_pixels'  : 350,
-                  'invert_masks'         : False
+                  'invert_masks'         : False,
+                  'max_cache_size'       : 20, # GB
+                  'max_result_cache_size': 2, # GB
+                  'mc_num_workers'       : 0, # 0 = one per core
+                  'mc_memory_budget'     : 8, # GB
+                  'mc_virtual'           : False,
+                  'cnmf_num_workers'     : 0 # 0 = one per core
                   }
 
 # set filename for saving current parameters
@@ -66,6 +74,15 @@ class Controller():
         self.video_groups   = [] # groups that videos belong to
         self.ignored_frames = [] # frames to ignore for each video when finding ROIs
 
+        # create the cache of intermediate files shared between pipeline stages
+        self.cache = IntermediateCache(max_size=self.params['max_cache_size'])
+
+        # create the cache of ROI finding results
+        self.result_cache = IntermediateCache(directory=DEFAULT_RESULT_CACHE_DIRECTORY, max_size=self.params['max_result_cache_size'])
+
+        # create the cluster shared between pipeline stages (it is only started once it is needed)
+        self.cluster = ClusterManager()
+
         # initialize all variables
         self.reset_variables()
         self.reset_motion_correction_variables()
@@ -89,6 +106,7 @@ class Controller():
         self.bg_temporal_footprints  = {}
         self.filtered_out_rois       = {}
         self.mask_points             = {}
+        self.roi_filter_metrics      = {} # per-ROI metrics used for filtering, computed once for each plane
 
     def reset_roi_filtering_variables(self):
         self.manually_removed_rois = {}
@@ -219,30 +237,11 @@ class Controller():
             for z in range(video.shape[1]):
                 print("Calculating ROI activities for z={}...".format(z))
 
-                centroids = np.zeros((roi_spatial_footprints[z].shape[-1], 2))
                 kept_rois = [ roi for roi in range(roi_spatial_footprints[z].shape[-1]) if (roi not in all_removed_rois[z]) or (roi in locked_rois[z]) ]
 
-                footprints_2d = roi_spatial_footprints[z].toarray().reshape((video.shape[2], video.shape[3], roi_spatial_footprints[z].shape[-1]))
-
-                for roi in kept_rois:
-                    footprint_2d = footprints_2d[:, :, roi]
-
-                    mask = footprint_2d > 0
-
-                    contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-
-                    if len(contours) > 0:
-                        contour = contours[0]
-
-                        M = cv2.moments(contour)
-                        if M["m00"] > 0:
-                            center_x = int(M["m10"] / M["m00"])
-                            center_y = int(M["m01"] / M["m00"])
-                        else:
-                            center_x = 0
-                            center_y = 0
-
-                        centroids[roi] = [center_x, center_y]
+                # get (x, y) centroids straight from the sparse footprints
+                stats     = footprint_stats(roi_spatial_footprints[z], video.shape[2:])
+                centroids = np.floor(np.nan_to_num(stats['centroid'][:, ::-1]))
 
                 temporal_footprints = roi_temporal_footprints[z]
 
@@ -307,6 +306,7 @@ class Controller():
             else:
                 self.all_removed_rois = roi_data['removed_rois']
             self.locked_rois = roi_data['locked_rois']
+            self.roi_filter_metrics = {}
             if 'masks' in roi_data.keys():
                 self.mask_points = roi_data['masks']
             else:
@@ -361,6 +361,8 @@ class Controller():
             self.roi_temporal_residuals[group_num]  = roi_temporal_residuals
             self.bg_temporal_footprints[group_num]  = bg_temporal_footprints
 
+            self.invalidate_roi_filter_metrics(group_num)
+
         self.find_new_rois = False
 
     def remove_videos_at_indices(self, indices):
@@ -420,6 +422,8 @@ class Controller():
             del self.bg_temporal_footprints[group]
         if group in self.filtered_out_rois.keys():
             del self.filtered_out_rois[group]
+        if group in self.roi_filter_metrics.keys():
+            del self.roi_filter_metrics[group]
         if group in self.mask_points.keys():
             del self.mask_points[group]
         if group in self.manually_removed_rois.keys():
@@ -441,46 +445,120 @@ class Controller():
         return [ i for i in range(len(video_paths)) if self.video_groups[i] == group_num ]
 
     def motion_correct(self):
-        mc_videos, mc_borders = utilities.motion_correct_multiple_videos(self.video_paths, self.video_groups, self.params['max_shift'], self.params['patch_stride'], self.params['patch_overlap'], use_multiprocessing=self.use_multiprocessing)
-
-        mc_video_paths = []
-        for i in range(len(mc_videos)):
-            video_path    = self.video_paths[i]
-            directory     = os.path.dirname(video_path)
-            filename      = os.path.basename(video_path)
-            mc_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_mc.tif")
-            
-            # save the motion-corrected video
-            tifffile.imsave(mc_video_path, mc_videos[i])
-            
-            mc_video_paths.append(mc_video_path)
+        # the motion-corrected videos are written to disk as they are created
+        mc_video_paths, mc_borders = utilities.motion_correct_multiple_videos(self.video_paths, self.video_groups, self.params['max_shift'], self.params['patch_stride'], self.params['patch_overlap'], use_multiprocessing=self.use_multiprocessing, num_workers=self.params['mc_num_workers'], memory_budget=self.params['mc_memory_budget'], cluster=self.cluster, virtual=self.params['mc_virtual'])
 
         self.mc_video_paths = mc_video_paths
         self.mc_borders     = mc_borders
 
         self.use_mc_video = True
 
-    def find_rois(self):
+    def find_rois(self, refine=False):
         # set video paths
         if self.use_mc_video and len(self.mc_video_paths) > 0:
             video_paths = self.mc_video_paths
         else:
             video_paths = self.video_paths
 
-        roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = utilities.find_rois_multiple_videos(video_paths, self.video_lengths, self.video_groups, self.params, mc_borders=self.mc_borders, use_multiprocessing=self.use_multiprocessing, method=self.roi_finding_mode, ignored_frames=self.ignored_frames)
+        if refine:
+            # refine the current ROIs with CNMF instead of finding them from scratch (only in the groups that can be refined)
+            method       = "cnmf"
+            initial_rois = self.initial_rois()
+            group_nums   = list(initial_rois.keys())
+        else:
+            method       = self.roi_finding_mode
+            initial_rois = {}
+            group_nums   = None
+
+        roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = utilities.find_rois_multiple_videos(video_paths, self.video_lengths, self.video_groups, self.params, mc_borders=self.mc_borders, use_multiprocessing=self.use_multiprocessing, method=method, ignored_frames=self.ignored_frames, cache=self.cache, num_workers=self.params['cnmf_num_workers'], cluster=self.cluster, result_cache=self.result_cache, initial_rois=initial_rois, group_nums=group_nums)
+
+        self.rois_found(roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, refine=refine)
+
+    def rois_found(self, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, refine=False):
+        if not refine:
+            # the ROIs of every group were found
+            self.roi_spatial_footprints  = {}
+            self.roi_temporal_footprints = {}
+            self.roi_temporal_residuals  = {}
+            self.bg_spatial_footprints   = {}
+            self.bg_temporal_footprints  = {}
+
+            self.filtered_out_rois     = {}
+            self.manually_removed_rois = {}
+            self.all_removed_rois      = {}
+            self.locked_rois           = {}
+
+            self.roi_filter_metrics = {}
+
+        # replace the ROIs of the groups that were found -- other groups (eg. ones that couldn't be refined) keep their ROIs & removed ROIs
+        for group_num in roi_spatial_footprints.keys():
+            num_z = len(roi_spatial_footprints[group_num])
+
+            self.roi_spatial_footprints[group_num]  = roi_spatial_footprints[group_num]
+            self.roi_temporal_footprints[group_num] = roi_temporal_footprints[group_num]
+            self.roi_temporal_residuals[group_num]  = roi_temporal_residuals[group_num]
+            self.bg_spatial_footprints[group_num]   = bg_spatial_footprints[group_num]
+            self.bg_temporal_footprints[group_num]  = bg_temporal_footprints[group_num]
+
+            self.filtered_out_rois[group_num]     = [ [] for z in range(num_z) ]
+            self.manually_removed_rois[group_num] = [ [] for z in range(num_z) ]
+            self.all_removed_rois[group_num]      = [ [] for z in range(num_z) ]
+            self.locked_rois[group_num]           = [ [] for z in range(num_z) ]
+
+            # the filtering metrics belong to the ROIs that were replaced
+            if group_num in self.roi_filter_metrics.keys():
+                del self.roi_filter_metrics[group_num]
+
+    def initial_rois(self):
+        # get the footprints of the ROIs that haven't been removed in each group, to seed CNMF with
+        initial_rois = {}
+
+        for group_num in self.roi_spatial_footprints.keys():
+            if any([ bg_spatial_footprints is None for bg_spatial_footprints in self.bg_spatial_footprints[group_num] ]):
+                # ROIs without a background model (eg. found with suite2p) can't be refined, so they are kept as they are
+                print("ROIs of group {} have no background model and can't be refined.".format(group_num))
+                continue
+
+            roi_spatial_footprints  = []
+            roi_temporal_footprints = []
 
-        self.roi_spatial_footprints  = roi_spatial_footprints
-        self.roi_temporal_footprints = roi_temporal_footprints
-        self.roi_temporal_residuals  = roi_temporal_residuals
-        self.bg_spatial_footprints   = bg_spatial_footprints
-        self.bg_temporal_footprints  = bg_temporal_footprints
+            for z in range(len(self.roi_spatial_footprints[group_num])):
+                kept_rois = [ roi for roi in range(self.roi_spatial_footprints[group_num][z].shape[-1]) if roi not in self.all_removed_rois[group_num][z] ]
 
-        self.filtered_out_rois     = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.video_groups) }
-        self.manually_removed_rois = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.video_groups) }
-        self.all_removed_rois      = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.video_groups) }
-        self.locked_rois           = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.video_groups) }
+                roi_spatial_footprints.append(self.roi_spatial_footprints[group_num][z].tocsc()[:, kept_rois])
+                roi_temporal_footprints.append(self.roi_temporal_footprints[group_num][z][kept_rois])
+
+            initial_rois[group_num] = (roi_spatial_footprints, roi_temporal_footprints, self.bg_spatial_footprints[group_num], self.bg_temporal_footprints[group_num])
+
+        return initial_rois
 
     def filter_rois(self, mean_images, group_num):
+        video_paths = self.roi_filtering_video_paths(group_num)
+
+        num_z = len(self.roi_spatial_footprints[group_num])
+
+        if group_num not in self.roi_filter_metrics.keys():
+            self.roi_filter_metrics[group_num] = [ None for z in range(num_z) ]
+
+        # only compute the metrics of planes whose ROIs (or the parameters the metrics depend on) have changed
+        planes = self.stale_roi_filter_metrics(group_num)
+
+        if len(planes) > 0:
+            metrics = utilities.roi_filter_metrics(video_paths, self.roi_spatial_footprints[group_num], self.roi_temporal_footprints[group_num], self.roi_temporal_residuals[group_num], mean_images, self.params, planes=planes)
+
+            for z in planes:
+                self.roi_filter_metrics[group_num][z] = metrics[z]
+
+                # remember which ROIs the metrics were computed for, so that they're stale once the ROIs are replaced
+                self.roi_filter_metrics[group_num][z]['roi_spatial_footprints'] = self.roi_spatial_footprints[group_num][z]
+
+        # an explicit filtering run starts over from the filters alone
+        for z in range(num_z):
+            self.manually_removed_rois[group_num][z] = []
+
+        self.apply_roi_filters(group_num)
+
+    def roi_filtering_video_paths(self, group_num):
         # set video paths
         if self.use_mc_video and len(self.mc_video_paths) > 0:
             video_paths = self.mc_video_paths
@@ -488,16 +566,49 @@ class Controller():
             video_paths = self.video_paths
 
         # only use videos in the given group
-        video_paths = self.video_paths_in_group(video_paths, group_num)
+        return self.video_paths_in_group(video_paths, group_num)
 
-        # filter out ROIs and update the removed ROIs
-        self.filtered_out_rois[group_num] = utilities.filter_rois(video_paths, self.roi_spatial_footprints[group_num], self.roi_temporal_footprints[group_num], self.roi_temporal_residuals[group_num], self.bg_spatial_footprints[group_num], self.bg_temporal_footprints[group_num], mean_images, self.params)
-        
-        # keep locked ROIs
+    def stale_roi_filter_metrics(self, group_num):
+        # return the planes whose stored filtering metrics are missing or out of date
+        num_z = len(self.roi_spatial_footprints[group_num])
+
+        if group_num not in self.roi_filter_metrics.keys():
+            return list(range(num_z))
+
+        metric_params = { param: self.params[param] for param in utilities.ROI_FILTER_METRIC_PARAMS }
+        metric_params['video_paths'] = self.roi_filtering_video_paths(group_num)
+
+        planes = []
+        for z in range(num_z):
+            metrics = self.roi_filter_metrics[group_num][z]
+
+            if metrics is None or metrics['params'] != metric_params or metrics['roi_spatial_footprints'] is not self.roi_spatial_footprints[group_num][z] or (self.params['use_cnn'] and metrics['cnn_predictions'] is None):
+                planes.append(z)
+
+        return planes
+
+    def has_roi_filter_metrics(self, group_num):
+        # whether ROIs can be re-filtered from the stored metrics alone, without reading the videos
+        return group_num in self.roi_spatial_footprints.keys() and len(self.stale_roi_filter_metrics(group_num)) == 0
+
+    def apply_roi_filters(self, group_num):
+        # filter out ROIs using the stored metrics and update the removed ROIs
+        self.filtered_out_rois[group_num] = utilities.threshold_rois(self.roi_filter_metrics[group_num], self.params)
+
+        # keep locked ROIs (manually discarded ROIs stay discarded)
         for z in range(len(self.filtered_out_rois[group_num])):
-            self.manually_removed_rois[group_num][z] = []
             self.filtered_out_rois[group_num][z] = [ roi for roi in self.filtered_out_rois[group_num][z] if roi not in self.locked_rois[group_num][z] ]
-            self.all_removed_rois[group_num][z]      = self.filtered_out_rois[group_num][z] + self.manually_removed_rois[group_num][z]
+            self.all_removed_rois[group_num][z]  = self.filtered_out_rois[group_num][z] + [ roi for roi in self.manually_removed_rois[group_num][z] if roi not in self.filtered_out_rois[group_num][z] ]
+
+    def invalidate_roi_filter_metrics(self, group_num, z=None):
+        # forget the stored filtering metrics of a plane (or of all planes) after its ROIs have changed
+        if group_num not in self.roi_filter_metrics.keys():
+            return
+
+        if z is None:
+            del self.roi_filter_metrics[group_num]
+        else:
+            self.roi_filter_metrics[group_num][z] = None
 
     def discard_roi(self, roi, z, group_num):
         # add to discarded ROIs list
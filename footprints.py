@@ -0,0 +1,157 @@
+'''
+Statistics of ROI spatial footprints, computed straight from the sparse
+(pixels x ROIs) matrices that CaImAn & suite2p produce.
+
+Densifying a footprint matrix to get at these costs (pixels x ROIs) floats
+(eg. 16 GB for 2000 ROIs in a 1024x1024 plane), whereas the sparse matrix
+only stores the pixels that ROIs actually cover. All statistics are
+computed for every ROI at once from the non-zero entries of the matrix.
+
+Pixel coordinates are returned as (row, column) pairs of the plane image.
+The flat pixel indices of the matrix map onto the plane the same way
+np.reshape(..., shape, order=order) would map them.
+'''
+
+import numpy as np
+import scipy.sparse
+
+def pixel_coordinates(pixels, shape, order='C'):
+    # convert flat pixel indices to the (rows, columns) of the plane image
+    return np.unravel_index(pixels, shape, order=order)
+
+def footprint_stats(footprints, shape, order='C'):
+    '''Returns a dictionary of per-ROI arrays:
+
+        'area'          : number of pixels with a positive weight
+        'centroid'      : (row, column) centroid of those pixels
+        'bbox'          : (min row, min column, max row, max column) of those pixels (inclusive)
+        'peak'          : maximum weight
+        'peak_position' : (row, column) of the maximum weight
+        'center_of_mass': (row, column) center of mass of the weights
+
+    ROIs that cover no pixels get an area of 0 and NaN coordinates.'''
+
+    footprints = scipy.sparse.csc_matrix(footprints)
+    footprints.sum_duplicates()
+
+    num_rois = footprints.shape[-1]
+
+    # ROI that each stored entry belongs to
+    rois = np.repeat(np.arange(num_rois), np.diff(footprints.indptr))
+
+    rows, cols = pixel_coordinates(footprints.indices, shape, order=order)
+    weights    = footprints.data
+
+    positive = weights > 0
+
+    stats = {}
+
+    # area & centroid of the pixels with a positive weight
+    area = np.bincount(rois[positive], minlength=num_rois)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['area']     = area
+        stats['centroid'] = np.stack([np.bincount(rois[positive], weights=rows[positive], minlength=num_rois)/area,
+                                      np.bincount(rois[positive], weights=cols[positive], minlength=num_rois)/area], axis=1)
+
+    bbox = np.full((num_rois, 4), np.nan)
+    if np.any(positive):
+        bbox_min = np.full((num_rois, 2), np.iinfo(np.int64).max)
+        bbox_max = np.full((num_rois, 2), -1)
+
+        np.minimum.at(bbox_min, rois[positive], np.stack([rows[positive], cols[positive]], axis=1))
+        np.maximum.at(bbox_max, rois[positive], np.stack([rows[positive], cols[positive]], axis=1))
+
+        bbox[area > 0] = np.concatenate([bbox_min, bbox_max], axis=1)[area > 0]
+    stats['bbox'] = bbox
+
+    # peak weight & its position
+    peak          = np.full(num_rois, np.nan)
+    peak_position = np.full((num_rois, 2), np.nan)
+
+    nonempty = np.nonzero(np.diff(footprints.indptr) > 0)[0]
+    if len(nonempty) > 0:
+        # the largest entry of each column is found by sorting the entries by (column, weight)
+        order_in_matrix = np.lexsort((weights, rois))
+        last_entries    = order_in_matrix[footprints.indptr[nonempty+1] - 1]
+
+        peak[nonempty]          = weights[last_entries]
+        peak_position[nonempty] = np.stack([rows[last_entries], cols[last_entries]], axis=1)
+    stats['peak']          = peak
+    stats['peak_position'] = peak_position
+
+    # center of mass of the weights
+    total_weight = np.bincount(rois, weights=weights, minlength=num_rois)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['center_of_mass'] = np.stack([np.bincount(rois, weights=weights*rows, minlength=num_rois)/total_weight,
+                                            np.bincount(rois, weights=weights*cols, minlength=num_rois)/total_weight], axis=1)
+
+    return stats
+
+class ROILabelMap():
+    '''Maps each pixel of a plane to the ROI that has the largest weight
+    there, so that finding the ROI under a point is a single array lookup.
+    Pixels covered by several ROIs are also listed, along with all of their
+    ROIs (in order of decreasing weight).'''
+
+    def __init__(self, footprints):
+        footprints = scipy.sparse.csc_matrix(footprints)
+        footprints.sum_duplicates()
+
+        self.num_pixels = footprints.shape[0]
+        self.num_rois   = footprints.shape[-1]
+
+        rois    = np.repeat(np.arange(self.num_rois), np.diff(footprints.indptr))
+        pixels  = footprints.indices
+        weights = footprints.data
+
+        positive = weights > 0
+        rois     = rois[positive]
+        pixels   = pixels[positive]
+        weights  = weights[positive]
+
+        # sort entries by pixel, then by decreasing weight (ties go to the lowest ROI, as np.argmax does)
+        entry_order = np.lexsort((rois, -weights, pixels))
+        rois        = rois[entry_order]
+        pixels      = pixels[entry_order]
+
+        first_entries = np.concatenate([[True], pixels[1:] != pixels[:-1]]) if len(pixels) > 0 else np.zeros(0, dtype=bool)
+
+        self.labels = np.full(self.num_pixels, -1, dtype=np.int32)
+        self.labels[pixels[first_entries]] = rois[first_entries]
+
+        # pixels covered by more than one ROI
+        counts = np.bincount(pixels, minlength=self.num_pixels)
+
+        overlapping = counts[pixels] > 1
+
+        self.overlap_pixels = pixels[overlapping][first_entries[overlapping]]
+        self.overlap_indptr = np.concatenate([[0], np.cumsum(counts[self.overlap_pixels])])
+        self.overlap_rois   = rois[overlapping]
+
+    def roi_at(self, pixel):
+        # return the ROI with the largest weight at the given (flat) pixel, or None
+        if pixel < 0 or pixel >= self.num_pixels:
+            return None
+
+        roi = self.labels[pixel]
+
+        if roi < 0:
+            return None
+
+        return int(roi)
+
+    def rois_at(self, pixel):
+        # return all ROIs that cover the given (flat) pixel, in order of decreasing weight
+        roi = self.roi_at(pixel)
+
+        if roi is None:
+            return []
+
+        i = np.searchsorted(self.overlap_pixels, pixel)
+
+        if i < len(self.overlap_pixels) and self.overlap_pixels[i] == pixel:
+            return [ int(roi) for roi in self.overlap_rois[self.overlap_indptr[i]:self.overlap_indptr[i+1]] ]
+
+        return [roi]
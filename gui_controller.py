@@ -5,9 +5,12 @@ import cv2
 import csv
 import scipy
 import platform
-from PIL import Image
 
 import utilities
+from footprints import footprint_stats, ROILabelMap
+from roi_overlays import ROIOverlays
+from video_stats import load_video_stats
+from tail_angles import load_tail_angle_trace
 from param_window import ParamWindow
 from preview_window import PreviewWindow
 from cnn_training_window import CNNTrainingWindow
@@ -67,8 +70,10 @@ class GUIController():
 
     def reset_variables(self):
         self.video                  = None # currently loaded video
-        self.adjusted_video         = None # gamma- and contrast-adjusted video (for the current z plane)
+        self.display_lut            = None # lookup table mapping raw values of the video to gamma- and contrast-adjusted display values
+        self.display_lut_params     = None # (dtype, contrast, gamma, video max) that the lookup table was made for
         self.mean_images            = []   # mean images for all z planes
+        self.video_stats            = None # statistics of the currently loaded video (see video_stats.py)
         self.adjusted_mean_image    = None # gamma- and contrast-adjusted mean image (for the current z plane)
         self.selected_rois          = []   # ROIs currently selected by the user
         self.video_num              = None # which video is currently loaded
@@ -77,7 +82,10 @@ class GUIController():
         self.mask_images            = None # list of mask images for each z plane in the currently loaded video
         self.selected_mask          = None # which mask, if any, is selected
         self.roi_contours           = []   # list of contours for each ROI in the current z plane
-        self.roi_overlays           = []   # list of overlays for each ROI in the current z plane
+        self.roi_overlays           = None # overlays of the ROIs in the current z plane (cropped to their bounding boxes)
+        self.roi_label_maps         = {}   # label maps (used for finding the ROI under a point) for each group & z plane
+        self.roi_correlations       = {}   # correlations between the traces of all ROIs in the current z plane for each video of the group
+        self.normalized_traces      = {}   # z-scored & max-normalized traces of all ROIs in the current z plane for each video of the group
         self.kept_rois_overlay      = None # overlay containing kept ROIs
         self.removed_rois_overlay   = None # overlay containing removed ROIs
         self.tail_angle_traces      = []   # dict of tail angle traces for each video
@@ -112,12 +120,77 @@ class GUIController():
         else:
             return None
 
+    def roi_label_map(self):
+        # return the label map used to find the ROI under a point, rebuilding it if the footprints have changed
+        roi_spatial_footprints = self.roi_spatial_footprints()
+
+        if roi_spatial_footprints is None:
+            return None
+
+        key = (self.group_num, self.z)
+
+        if key not in self.roi_label_maps.keys() or self.roi_label_maps[key][0] is not roi_spatial_footprints:
+            self.roi_label_maps[key] = (roi_spatial_footprints, ROILabelMap(roi_spatial_footprints))
+
+        return self.roi_label_maps[key][1]
+
     def roi_temporal_footprints(self):
         if self.group_num in self.controller.roi_temporal_footprints.keys():
             return self.controller.roi_temporal_footprints[self.group_num][self.z]
         else:
             return None
 
+    def roi_trace_correlations(self):
+        # return the correlations between the traces of all ROIs in the current z plane during the loaded video,
+        # recomputing them only if the traces have changed (eg. after ROIs are merged or erased)
+        roi_temporal_footprints = self.roi_temporal_footprints()
+
+        if roi_temporal_footprints is None:
+            return None
+
+        start, end = self.loaded_video_frames()
+
+        key = (self.group_num, self.z, start)
+
+        if key not in self.roi_correlations.keys() or self.roi_correlations[key][0] is not roi_temporal_footprints:
+            self.prune_traces_cache(self.roi_correlations, roi_temporal_footprints)
+
+            self.roi_correlations[key] = (roi_temporal_footprints, utilities.trace_correlations(roi_temporal_footprints[:, start:end]))
+
+        return self.roi_correlations[key][1]
+
+    def normalized_roi_traces(self):
+        # return the traces of all ROIs in the current z plane during the loaded video, z-scored or scaled to a maximum of 1
+        # (depending on whether z-scores are shown), recomputing them only if the traces have changed (eg. after ROIs are merged or erased)
+        roi_temporal_footprints = self.roi_temporal_footprints()
+
+        if roi_temporal_footprints is None:
+            return None
+
+        start, end = self.loaded_video_frames()
+
+        key = (self.group_num, self.z, start, self.show_zscore)
+
+        if key not in self.normalized_traces.keys() or self.normalized_traces[key][0] is not roi_temporal_footprints:
+            self.prune_traces_cache(self.normalized_traces, roi_temporal_footprints)
+
+            traces = roi_temporal_footprints[:, start:end]
+
+            if self.show_zscore:
+                traces = (traces - np.mean(traces, axis=1)[:, np.newaxis])/np.std(traces, axis=1)[:, np.newaxis]
+            else:
+                traces = traces/np.amax(traces)
+
+            self.normalized_traces[key] = (roi_temporal_footprints, traces)
+
+        return self.normalized_traces[key][1]
+
+    def prune_traces_cache(self, cache, roi_temporal_footprints):
+        # only keep the entries computed from the current traces of the current z plane, so that replaced traces & other planes don't stay in memory
+        for key in list(cache.keys()):
+            if key[:2] != (self.group_num, self.z) or cache[key][0] is not roi_temporal_footprints:
+                del cache[key]
+
     def bg_spatial_footprints(self):
         if self.group_num in self.controller.bg_spatial_footprints.keys():
             return self.controller.bg_spatial_footprints[self.group_num][self.z]
@@ -165,6 +238,16 @@ class GUIController():
 
         return video_paths[self.video_num]
 
+    def loaded_video_frames(self):
+        # return the (start, end) frames of the loaded video within the traces of its group
+        video_lengths = self.selected_group_video_lengths()
+
+        index = self.current_group_video_paths().index(self.loaded_video_path())
+
+        start = int(np.sum(video_lengths[:index]))
+
+        return start, start + video_lengths[index]
+
     def video_groups(self):
         return self.controller.video_groups
 
@@ -234,8 +317,8 @@ class GUIController():
 
         # load the video
         base_name = os.path.basename(video_path)
-        if base_name.endswith('.tif') or base_name.endswith('.tiff'):
-            self.video = tifffile.memmap(video_path)
+        if base_name.endswith('.tif') or base_name.endswith('.tiff') or base_name.endswith(utilities.MC_SHIFTS_SUFFIX):
+            self.video = utilities.open_video(video_path)
         else:
             print("Error: Attempted to open a non-TIFF file. Only TIFF files are currently supported.")
             return
@@ -247,8 +330,11 @@ class GUIController():
         if self.z >= self.video.shape[1]:
             self.z = 0
 
+        # load the statistics of the video (computing them the first time the video is opened)
+        self.video_stats = load_video_stats(video_path)
+
         # figure out the dynamic range of the video
-        max_value = np.amax(self.video)
+        max_value = self.video_stats['max']
 
         if max_value > 2047:
             self.video_max = 4095
@@ -274,7 +360,7 @@ class GUIController():
 
         print("Opened video with shape {}.".format(self.video.shape))
 
-        self.update_adjusted_video()
+        self.update_display_lut()
 
         # calculate mean images
         self.update_mean_images()
@@ -310,7 +396,8 @@ class GUIController():
         self.param_window.update_ignored_frames_textbox(string)
 
     def update_mean_images(self):
-        self.mean_images = np.mean(self.video, axis=0)
+        # flip mean images 90 degrees to match the video
+        self.mean_images = self.video_stats['mean_images'].transpose((0, 2, 1))
 
         self.update_adjusted_mean_image()
 
@@ -325,43 +412,55 @@ class GUIController():
                     mask = self.create_mask_image(z, mask_points)
                     self.mask_images[z].append(mask)
 
-    def update_adjusted_video(self):
-        self.adjusted_video = utilities.adjust_gamma(utilities.adjust_contrast(self.video[:, self.z, :, :], self.gui_params['contrast']), self.gui_params['gamma'])
+    def update_display_lut(self):
+        # (re)make the lookup table if the video or the contrast & gamma have changed
+        params = (self.video.dtype, self.gui_params['contrast'], self.gui_params['gamma'], self.video_max)
+
+        if params != self.display_lut_params:
+            self.display_lut        = utilities.display_lut(*params)
+            self.display_lut_params = params
 
     def adjusted_frame(self, frame):
-        return utilities.adjust_gamma(utilities.adjust_contrast(self.video[frame, self.z, :, :], self.gui_params['contrast']), self.gui_params['gamma'])
+        # frames are adjusted only when they are shown, so no adjusted copy of the video is kept
+        return self.adjusted_frame_function()(frame)
+
+    def adjusted_frame_function(self):
+        # return a function that adjusts frames of the current video & plane with the current contrast & gamma. It only
+        # uses a snapshot of them (taken now), so it can be run by another thread while they are changed
+        self.update_display_lut()
+
+        video       = self.video
+        z           = self.z
+        display_lut = self.display_lut
+        contrast    = self.gui_params['contrast']
+        gamma       = self.gui_params['gamma']
+
+        def adjusted_frame(frame):
+            if display_lut is not None:
+                # map the raw values straight to display values
+                return display_lut[video[frame, z, :, :]]
+            else:
+                return utilities.adjust_gamma(utilities.adjust_contrast(video[frame, z, :, :], contrast), gamma)
+
+        return adjusted_frame
 
     def update_adjusted_mean_image(self):
         self.adjusted_mean_image = utilities.adjust_gamma(utilities.adjust_contrast(self.mean_images[self.z], self.gui_params['contrast']), self.gui_params['gamma'])
     
     def update_roi_contours_and_overlays(self):
         if self.roi_spatial_footprints() is not None:
-            roi_spatial_footprints = self.roi_spatial_footprints().toarray()
- 
-            roi_spatial_footprints = roi_spatial_footprints.reshape((self.video.shape[2], self.video.shape[3], roi_spatial_footprints.shape[-1])).transpose((1, 0, 2))
-            
-            self.roi_contours  = [ None for i in range(roi_spatial_footprints.shape[-1]) ]
-            
-            self.roi_overlays = np.zeros((roi_spatial_footprints.shape[-1], self.video.shape[2], self.video.shape[3], 4)).astype(np.uint8)
+            # build the label map now so that clicking on ROIs is instant
+            self.roi_label_map()
 
-            for i in range(roi_spatial_footprints.shape[-1]):
-                maximum = np.amax(roi_spatial_footprints[:, :, i])
+            num_rois = self.roi_spatial_footprints().shape[-1]
 
-                mask = (roi_spatial_footprints[:, :, i] > 0).copy()
-                
-                contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]
+            colors = np.array([ cmap(i % n_colors)[:3] for i in range(num_rois) ]).reshape((-1, 3))*255
 
-                color = cmap(i % n_colors)[:3]
-                color = [255*color[0], 255*color[1], 255*color[2]]
-
-                overlay = np.zeros((self.video.shape[2], self.video.shape[3], 4)).astype(np.uint8)
-                overlay[mask, :-1] = color
-                overlay[mask, -1] = 255.0*roi_spatial_footprints[mask, i]/maximum
-                self.roi_overlays[i] = overlay
-
-                self.roi_contours[i] = contours
+            # overlays are shown flipped 90 degrees (as in Fiji), so footprint pixels map onto them in Fortran order
+            self.roi_overlays = ROIOverlays(self.roi_spatial_footprints(), (self.video.shape[3], self.video.shape[2]), colors, order='F')
+            self.roi_contours = self.roi_overlays.contours
         else:
-            self.roi_overlays = []
+            self.roi_overlays = None
             self.roi_contours = []
 
     def update_merged_roi_overlays(self):
@@ -369,115 +468,79 @@ class GUIController():
 
         if roi_spatial_footprints is not None:
             kept_rois = [ roi for roi in range(roi_spatial_footprints.shape[-1]) if roi not in self.removed_rois() ]
-            
-            if len(kept_rois) > 0:
-                a = Image.fromarray(self.roi_overlays[kept_rois[0]])
-                for roi in kept_rois[1:]:
-                    b = Image.fromarray(self.roi_overlays[roi])
-                    a.alpha_composite(b)
-                self.kept_rois_overlay = np.asarray(a)
-            else:
-                self.kept_rois_overlay = None
+
+            self.kept_rois_overlay = self.composite_roi_overlays(kept_rois)
 
             removed_rois = [ roi for roi in range(roi_spatial_footprints.shape[-1]) if roi in self.removed_rois() ]
-            
-            if len(removed_rois) > 0:
-                a = Image.fromarray(self.roi_overlays[removed_rois[0]])
-                for roi in removed_rois[1:]:
-                    b = Image.fromarray(self.roi_overlays[roi])
-                    a.alpha_composite(b)
-                self.removed_rois_overlay = np.asarray(a)
-            else:
-                self.removed_rois_overlay = None
+
+            self.removed_rois_overlay = self.composite_roi_overlays(removed_rois)
         else:
             self.kept_rois_overlay    = None
             self.removed_rois_overlay = None
 
+    def update_merged_roi_overlays_around(self, changed_rois):
+        # update the kept & removed ROI overlays after the given ROIs have moved between them, redrawing
+        # only the regions covered by those ROIs
+        roi_spatial_footprints = self.roi_spatial_footprints()
+
+        if roi_spatial_footprints is None or self.roi_overlays is None:
+            self.update_merged_roi_overlays()
+            return
+
+        removed = set(self.removed_rois())
+
+        kept_rois    = [ roi for roi in range(roi_spatial_footprints.shape[-1]) if roi not in removed ]
+        removed_rois = [ roi for roi in range(roi_spatial_footprints.shape[-1]) if roi in removed ]
+
+        if self.kept_rois_overlay is None:
+            self.kept_rois_overlay = np.zeros(self.roi_overlays.shape + (4,), dtype=np.uint8)
+        if self.removed_rois_overlay is None:
+            self.removed_rois_overlay = np.zeros(self.roi_overlays.shape + (4,), dtype=np.uint8)
+
+        for roi in changed_rois:
+            if np.any(self.roi_overlays.sizes[roi] == 0):
+                continue
+
+            region = self.roi_overlays.bounds(roi)
+
+            r_0, r_1, c_0, c_1 = region
+
+            self.kept_rois_overlay[r_0:r_1, c_0:c_1]    = self.roi_overlays.composite(self.roi_overlays.rois_in_region(kept_rois, region), region)
+            self.removed_rois_overlay[r_0:r_1, c_0:c_1] = self.roi_overlays.composite(self.roi_overlays.rois_in_region(removed_rois, region), region)
+
+    def composite_roi_overlays(self, rois):
+        # composite the overlays of the given ROIs (in order) into a single image
+        if len(rois) == 0:
+            return None
+
+        return self.roi_overlays.composite(rois)
+
     def update_roi_heatmap(self):
         roi_spatial_footprints = self.roi_spatial_footprints()
 
         self.heatmap = None
 
         if roi_spatial_footprints is not None:
-            kept_rois = [ roi for roi in range(roi_spatial_footprints.shape[-1]) if roi not in self.removed_rois() ]
+            kept_rois = np.setdiff1d(np.arange(roi_spatial_footprints.shape[-1]), self.removed_rois()).astype(int)
 
             if len(kept_rois) > 0:
-                heatmap = self.roi_temporal_footprints()[kept_rois]
-                
-                video_lengths = self.selected_group_video_lengths()
+                heatmap = self.normalized_roi_traces()[kept_rois]
 
-                index = self.current_group_video_paths().index(self.loaded_video_path())
+                if self.show_zscore:
+                    if heatmap.shape[0] > 2:
+                        # put ROIs with correlated traces next to each other
+                        correlations = self.roi_trace_correlations()[np.ix_(kept_rois, kept_rois)]
 
-                if index == 0:
-                    heatmap = heatmap[:, :video_lengths[0]]
-                else:
-                    heatmap = heatmap[:, np.sum(video_lengths[:index]):np.sum(video_lengths[:index+1])]
-
-                if heatmap.shape[0] > 0:
-                    if self.show_zscore:
-                        heatmap = (heatmap - np.mean(heatmap, axis=1)[:, np.newaxis])/np.std(heatmap, axis=1)[:, np.newaxis]
-
-                        if heatmap.shape[0] > 2:
-                            correlations = np.corrcoef(heatmap)
-                            i, j = np.unravel_index(correlations.argmin(), correlations.shape)
-                        
-                            heatmap_sorted = heatmap.copy()
-                            heatmap_sorted[0]  = heatmap[i]
-                            heatmap_sorted[-1] = heatmap[j]
-                            
-                            remaining_indices = [ index for index in range(heatmap.shape[0]) if index not in (i, j) ]
-                            for k in range(1, heatmap.shape[0]-1):
-                                corrs_1 = [ correlations[i, index] for index in remaining_indices ]
-                                corrs_2 = [ correlations[j, index] for index in remaining_indices ]
-                                
-                                difference = [ corrs_1[l] - corrs_2[l] for l in range(len(remaining_indices)) ]
-                                l = np.argmax(difference)
-                                index = remaining_indices[l]
-                                
-                                heatmap_sorted[k] = heatmap[index]
-                                
-                                del remaining_indices[l]
-
-                            heatmap = heatmap_sorted
-                    else:
-                        heatmap = heatmap/np.amax(heatmap)
+                        heatmap = heatmap[utilities.correlation_order(correlations)]
 
-                    if self.show_zscore:
-                        heatmap[heatmap > 3]  = 3
-                        heatmap[heatmap < -2] = -2
+                    heatmap = np.clip(heatmap, -2, 3)
 
-                    self.heatmap = heatmap.T
+                self.heatmap = heatmap.T
 
         self.preview_window.update_heatmap_plot(self.heatmap)
 
     def update_selected_rois_plot(self):
-        temporal_footprints = self.roi_temporal_footprints()
-
-        if temporal_footprints is not None:
-            group_indices = [ i for i in range(len(self.controller.video_paths)) if self.controller.video_groups[i] == self.group_num ]
-            
-            if self.controller.use_mc_video and len(self.controller.mc_video_paths) > 0:
-                group_paths   = [ self.controller.mc_video_paths[i] for i in group_indices ]
-            else:
-                group_paths   = [ self.controller.video_paths[i] for i in group_indices ]
-
-            group_lengths = [ self.controller.video_lengths[i] for i in group_indices ]
-            
-            index = group_paths.index(self.loaded_video_path())
-
-            if len(self.controller.roi_temporal_footprints.keys()) > 0:
-                if index == 0:
-                    temporal_footprints = temporal_footprints[:, :group_lengths[0]]
-                else:
-                    temporal_footprints = temporal_footprints[:, np.sum(group_lengths[:index]):np.sum(group_lengths[:index+1])]
-            else:
-                temporal_footprints = None
-
-        if temporal_footprints is not None:
-            if self.show_zscore:
-                temporal_footprints = (temporal_footprints - np.mean(temporal_footprints, axis=1)[:, np.newaxis])/np.std(temporal_footprints, axis=1)[:, np.newaxis]
-
-        self.preview_window.plot_traces(temporal_footprints, self.selected_rois)
+        self.preview_window.plot_traces(self.normalized_roi_traces(), self.selected_rois)
 
     def update_tail_plot(self):
         self.preview_window.plot_tail_angles(self.tail_angle_traces[self.video_num], self.gui_params['tail_fps'], self.controller.params['imaging_fps'])
@@ -529,7 +592,7 @@ class GUIController():
             self.update_selected_rois_plot()
             self.update_tail_plot()
             
-            self.preview_window.create_text_items()
+            self.preview_window.update_text_items()
 
             # show ROI filtering parameters
             self.show_roi_filtering_params()
@@ -623,30 +686,11 @@ class GUIController():
             for z in range(video.shape[1]):
                 print("Calculating ROI activities for z={}...".format(z))
 
-                centroids = np.zeros((roi_spatial_footprints[z].shape[-1], 2))
                 kept_rois = [ roi for roi in range(roi_spatial_footprints[z].shape[-1]) if (roi not in all_removed_rois[z]) or (roi in locked_rois[z]) ]
 
-                footprints_2d = roi_spatial_footprints[z].toarray().reshape((video.shape[2], video.shape[3], roi_spatial_footprints[z].shape[-1]))
-
-                for roi in kept_rois:
-                    footprint_2d = footprints_2d[:, :, roi]
-
-                    mask = footprint_2d > 0
-
-                    contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
-
-                    if len(contours) > 0:
-                        contour = contours[0]
-
-                        M = cv2.moments(contour)
-                        if M["m00"] > 0:
-                            center_x = int(M["m10"] / M["m00"])
-                            center_y = int(M["m01"] / M["m00"])
-                        else:
-                            center_x = 0
-                            center_y = 0
-
-                        centroids[roi] = [center_x, center_y]
+                # get (x, y) centroids straight from the sparse footprints
+                stats     = footprint_stats(roi_spatial_footprints[z], video.shape[2:])
+                centroids = np.floor(np.nan_to_num(stats['centroid'][:, ::-1]))
 
                 temporal_footprints = roi_temporal_footprints[z]
 
@@ -697,7 +741,7 @@ class GUIController():
         # self.motion_correction_thread = MotionCorrectThread(self.param_window)
 
         # # set the parameters of the motion correction thread
-        # self.motion_correction_thread.set_parameters(self.controller.video_paths, self.controller.video_groups, int(self.controller.params["max_shift"]), int(self.controller.params["patch_stride"]), int(self.controller.params["patch_overlap"]), use_multiprocessing=self.controller.use_multiprocessing)
+        # self.motion_correction_thread.set_parameters(self.controller.video_paths, self.controller.video_groups, int(self.controller.params["max_shift"]), int(self.controller.params["patch_stride"]), int(self.controller.params["patch_overlap"]), use_multiprocessing=self.controller.use_multiprocessing, num_workers=int(self.controller.params["mc_num_workers"]), memory_budget=self.controller.params["mc_memory_budget"])
         
         # self.motion_correction_thread.progress.connect(self.motion_correction_progress)
         # self.motion_correction_thread.finished.connect(self.motion_correction_ended)
@@ -708,7 +752,7 @@ class GUIController():
         # # notify the param window
         # self.param_window.motion_correction_started()
 
-        mc_video_paths, mc_borders = utilities.motion_correct_multiple_videos(self.controller.video_paths, self.controller.video_groups, int(self.controller.params["max_shift"]), int(self.controller.params["patch_stride"]), int(self.controller.params["patch_overlap"]), progress_signal=None, thread=None, use_multiprocessing=self.controller.use_multiprocessing)
+        mc_video_paths, mc_borders = utilities.motion_correct_multiple_videos(self.controller.video_paths, self.controller.video_groups, int(self.controller.params["max_shift"]), int(self.controller.params["patch_stride"]), int(self.controller.params["patch_overlap"]), progress_signal=None, thread=None, use_multiprocessing=self.controller.use_multiprocessing, num_workers=int(self.controller.params["mc_num_workers"]), memory_budget=self.controller.params["mc_memory_budget"], cluster=self.controller.cluster, virtual=self.controller.params["mc_virtual"])
 
         self.motion_correction_ended(mc_video_paths, mc_borders)
 
@@ -738,7 +782,7 @@ class GUIController():
 
         self.load_video(self.video_num)
 
-        self.update_adjusted_video()
+        self.update_display_lut()
         self.update_adjusted_mean_image()
 
         if self.mode in ("loading", "motion_correcting"):
@@ -767,25 +811,26 @@ class GUIController():
         # # notify the param window
         # self.param_window.roi_finding_started()
 
-        roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = utilities.find_rois_multiple_videos(video_paths, self.controller.video_lengths, self.controller.video_groups, self.controller.params, mc_borders=self.controller.mc_borders, progress_signal=None, thread=None, use_multiprocessing=self.controller.use_multiprocessing, method=self.controller.roi_finding_mode, mask_points=self.controller.mask_points, ignored_frames=self.controller.ignored_frames)
+        roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = utilities.find_rois_multiple_videos(video_paths, self.controller.video_lengths, self.controller.video_groups, self.controller.params, mc_borders=self.controller.mc_borders, progress_signal=None, thread=None, use_multiprocessing=self.controller.use_multiprocessing, method=self.controller.roi_finding_mode, mask_points=self.controller.mask_points, ignored_frames=self.controller.ignored_frames, cache=self.controller.cache, num_workers=int(self.controller.params['cnmf_num_workers']), cluster=self.controller.cluster, result_cache=self.controller.result_cache)
 
         self.roi_finding_ended(roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints)
 
+    def refine_rois(self):
+        video_paths = self.video_paths()
+
+        # seed CNMF with the current ROIs, skipping initialization (groups that can't be refined keep their ROIs)
+        initial_rois = self.controller.initial_rois()
+
+        roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = utilities.find_rois_multiple_videos(video_paths, self.controller.video_lengths, self.controller.video_groups, self.controller.params, mc_borders=self.controller.mc_borders, progress_signal=None, thread=None, use_multiprocessing=self.controller.use_multiprocessing, method="cnmf", mask_points=self.controller.mask_points, ignored_frames=self.controller.ignored_frames, cache=self.controller.cache, num_workers=int(self.controller.params['cnmf_num_workers']), cluster=self.controller.cluster, result_cache=self.controller.result_cache, initial_rois=initial_rois, group_nums=list(initial_rois.keys()))
+
+        self.roi_finding_ended(roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, refine=True)
+
     def roi_finding_progress(self, group_num):
         # notify the param window
         self.param_window.update_roi_finding_progress(group_num)
 
-    def roi_finding_ended(self, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints):
-        self.controller.roi_spatial_footprints  = roi_spatial_footprints
-        self.controller.roi_temporal_footprints = roi_temporal_footprints
-        self.controller.roi_temporal_residuals  = roi_temporal_residuals
-        self.controller.bg_spatial_footprints   = bg_spatial_footprints
-        self.controller.bg_temporal_footprints  = bg_temporal_footprints
-
-        self.controller.filtered_out_rois     = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.controller.video_groups) }
-        self.controller.manually_removed_rois = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.controller.video_groups) }
-        self.controller.all_removed_rois      = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.controller.video_groups) }
-        self.controller.locked_rois           = { group_num: [ [] for z in range(len(roi_spatial_footprints[group_num])) ] for group_num in np.unique(self.controller.video_groups) }
+    def roi_finding_ended(self, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, refine=False):
+        self.controller.rois_found(roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, refine=refine)
 
         # notify the param window
         self.param_window.roi_finding_ended()
@@ -845,6 +890,9 @@ class GUIController():
         # save the current parameters
         self.save_params()
 
+        # shut down the cluster
+        self.controller.cluster.stop()
+
     def preview_contrast(self, contrast):
         self.gui_params['contrast'] = contrast
 
@@ -903,7 +951,7 @@ class GUIController():
             self.gui_params[param] = value
 
         if param in ("contrast, gamma"):
-            self.update_adjusted_video()
+            self.update_display_lut()
             self.update_adjusted_mean_image()
 
             if self.video_playing:
@@ -918,10 +966,13 @@ class GUIController():
                 self.play_video()
             else:
                 self.show_mean_image()
+        elif param in utilities.ROI_FILTER_THRESHOLD_PARAMS:
+            # preview the effect of the new threshold
+            self.refilter_rois()
         if param == "z":
             self.z = value
 
-            self.update_adjusted_video()
+            self.update_display_lut()
             self.update_adjusted_mean_image()
 
             self.update_roi_contours_and_overlays()
@@ -957,7 +1008,7 @@ class GUIController():
         if not self.video_playing:
             self.show_mean_image()
         else:
-            self.preview_window.create_text_items()
+            self.preview_window.update_text_items()
 
     def set_play_video(self, video_playing):
         print("Setting play video from {} to {}.".format(self.video_playing, video_playing))
@@ -981,11 +1032,26 @@ class GUIController():
         self.update_selected_rois_plot()
 
     def filter_rois(self):
-        mean_images = [ (utilities.mean(self.video, z)/self.video_max)*self.video_max for z in range(self.video.shape[1]) ]
-        mean_images = [ utilities.adjust_gamma(utilities.adjust_contrast(mean_image, self.gui_params['contrast']), self.gui_params['gamma']) for mean_image in mean_images ]
+        if self.controller.params['use_cnn']:
+            mean_images = [ utilities.adjust_gamma(utilities.adjust_contrast(mean_image, self.gui_params['contrast']), self.gui_params['gamma']) for mean_image in self.mean_images ]
+        else:
+            # mean images are only needed by the CNN
+            mean_images = None
 
         self.controller.filter_rois(mean_images, self.group_num)
 
+        self.update_filtered_rois()
+
+    def refilter_rois(self):
+        # re-apply the filtering thresholds to the stored metrics (if the ROIs have been filtered before)
+        if not self.controller.has_roi_filter_metrics(self.group_num):
+            return
+
+        self.controller.apply_roi_filters(self.group_num)
+
+        self.update_filtered_rois()
+
+    def update_filtered_rois(self):
         self.update_merged_roi_overlays()
         self.update_roi_heatmap()
 
@@ -1015,7 +1081,7 @@ class GUIController():
         if roi_point is not None:
             if len(self.controller.roi_spatial_footprints) > 0:
                 # find out which ROI to select
-                selected_roi = utilities.get_roi_containing_point(self.controller.roi_spatial_footprints[self.group_num][self.z], roi_point, self.mean_images[self.z].shape)
+                selected_roi = utilities.get_roi_containing_point(self.roi_label_map(), roi_point, self.mean_images[self.z].shape)
 
                 print("Selected ROI: {}".format(selected_roi))
 
@@ -1045,13 +1111,7 @@ class GUIController():
         load_path = QFileDialog.getOpenFileName(self.param_window, 'Select saved tail angle data.', '', 'CSV (*.csv)')[0]
 
         if load_path is not None and len(load_path) > 0:
-            tail_angles = np.genfromtxt(load_path, delimiter=",")
-
-            tail_angles = np.nanmean(tail_angles[:, -3:], axis=-1)
-
-            tail_angles -= np.mean(tail_angles[:100])
-
-            self.tail_angle_traces[self.video_num] = tail_angles
+            self.tail_angle_traces[self.video_num] = load_tail_angle_trace(load_path)
 
             tail_fps, imaging_fps, ok = TailTraceParametersDialog.getParameters(None, self.gui_params['tail_fps'], self.controller.params['imaging_fps'])
 
@@ -1082,8 +1142,10 @@ class GUIController():
         self.controller.roi_temporal_footprints[self.group_num][self.z] = self.controller.roi_temporal_footprints[self.group_num][self.z][nonerased_rois]
         self.controller.roi_temporal_residuals[self.group_num][self.z] = self.controller.roi_temporal_residuals[self.group_num][self.z][nonerased_rois]
 
-        self.roi_contours = [ self.roi_contours[i] for i in nonerased_rois ]
-        self.roi_overlays = [ self.roi_overlays[i] for i in nonerased_rois ]
+        self.controller.invalidate_roi_filter_metrics(self.group_num, self.z)
+
+        self.roi_overlays = self.roi_overlays.subset(nonerased_rois)
+        self.roi_contours = self.roi_overlays.contours
 
         for roi in sorted(self.selected_rois, reverse=True):
             if roi in self.controller.all_removed_rois[self.group_num][self.z]:
@@ -1113,13 +1175,13 @@ class GUIController():
         if not self.video_playing:
             self.show_mean_image()
         else:
-            self.preview_window.create_text_items()
+            self.preview_window.update_text_items()
 
     def discard_selected_rois(self):
         for roi in self.selected_rois:
             self.controller.discard_roi(roi, self.z, self.group_num)
 
-        self.update_merged_roi_overlays()
+        self.update_merged_roi_overlays_around(self.selected_rois)
         self.update_roi_heatmap()
 
         self.selected_rois = []
@@ -1130,7 +1192,7 @@ class GUIController():
         if not self.video_playing:
             self.show_mean_image()
         else:
-            self.preview_window.create_text_items()
+            self.preview_window.update_text_items()
 
     def discard_all_rois(self):
         self.controller.manually_removed_rois[self.group_num][self.z] = np.arange(self.controller.roi_spatial_footprints[self.group_num][self.z].shape[1]).tolist()
@@ -1148,13 +1210,13 @@ class GUIController():
         if not self.video_playing:
             self.show_mean_image()
         else:
-            self.preview_window.create_text_items()
+            self.preview_window.update_text_items()
 
     def keep_selected_rois(self):
         for roi in self.selected_rois:
             self.controller.keep_roi(roi, self.z, self.group_num)
 
-        self.update_merged_roi_overlays()
+        self.update_merged_roi_overlays_around(self.selected_rois)
         self.update_roi_heatmap()
 
         self.selected_rois = []
@@ -1165,7 +1227,7 @@ class GUIController():
         if not self.video_playing:
             self.show_mean_image()
         else:
-            self.preview_window.create_text_items()
+            self.preview_window.update_text_items()
 
     def keep_all_rois(self):
         self.controller.manually_removed_rois[self.group_num][self.z] = []
@@ -1183,7 +1245,7 @@ class GUIController():
         if not self.video_playing:
             self.show_mean_image()
         else:
-            self.preview_window.create_text_items()
+            self.preview_window.update_text_items()
 
     def save_selected_roi_traces(self):
         save_path = QFileDialog.getSaveFileName(self.param_window, 'Enter CSV filename.', '', 'CSV (*.csv)')[0]
@@ -1232,6 +1294,8 @@ class GUIController():
             self.controller.roi_spatial_footprints[self.group_num][self.z]  = roi_spatial_footprints
             self.controller.roi_temporal_footprints[self.group_num][self.z] = roi_temporal_footprints
 
+            self.controller.invalidate_roi_filter_metrics(self.group_num, self.z)
+
             all_removed_rois      = self.controller.all_removed_rois[self.group_num][self.z]
             locked_rois           = self.controller.locked_rois[self.group_num][self.z]
             manually_removed_rois = self.controller.manually_removed_rois[self.group_num][self.z]
@@ -1379,7 +1443,7 @@ class GUIController():
         if not self.video_playing:
             self.show_mean_image()
         else:
-            self.preview_window.create_text_items()
+            self.preview_window.update_text_items()
 
         self.cnn_training_window.update_with_predictions(predictions)
 
@@ -1429,18 +1493,20 @@ class MotionCorrectThread(QThread):
 
         self.running = False
 
-    def set_parameters(self, video_paths, groups, max_shift, patch_stride, patch_overlap, use_multiprocessing=True):
+    def set_parameters(self, video_paths, groups, max_shift, patch_stride, patch_overlap, use_multiprocessing=True, num_workers=0, memory_budget=None):
         self.video_paths         = video_paths
         self.groups              = groups
         self.max_shift           = max_shift
         self.patch_stride        = patch_stride
         self.patch_overlap       = patch_overlap
         self.use_multiprocessing = use_multiprocessing
+        self.num_workers         = num_workers
+        self.memory_budget       = memory_budget
 
     def run(self):
         self.running = True
 
-        mc_video_paths, mc_borders = utilities.motion_correct_multiple_videos(self.video_paths, self.groups, self.max_shift, self.patch_stride, self.patch_overlap, progress_signal=self.progress, thread=self, use_multiprocessing=self.use_multiprocessing)
+        mc_video_paths, mc_borders = utilities.motion_correct_multiple_videos(self.video_paths, self.groups, self.max_shift, self.patch_stride, self.patch_overlap, progress_signal=self.progress, thread=self, use_multiprocessing=self.use_multiprocessing, num_workers=self.num_workers, memory_budget=self.memory_budget)
 
         self.finished.emit(mc_video_paths, mc_borders)
 
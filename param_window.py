@@ -978,6 +978,9 @@ class MotionCorrectionWidget(ParamWidget):
         self.add_param_slider(label_name="Maximum Shift", name="max_shift", minimum=1, maximum=100, value=self.controller.params()['max_shift'], moved=self.update_param, num=0, released=self.update_param, description="Maximum shift (in pixels) allowed for motion correction.", int_values=True)
         self.add_param_slider(label_name="Patch Stride", name="patch_stride", minimum=1, maximum=100, value=self.controller.params()['patch_stride'], moved=self.update_param, num=1, released=self.update_param, description="Stride length (in pixels) of each patch used in motion correction.", int_values=True)
         self.add_param_slider(label_name="Patch Overlap", name="patch_overlap", minimum=1, maximum=100, value=self.controller.params()['patch_overlap'], moved=self.update_param, num=2, released=self.update_param, description="Overlap (in pixels) of patches used in motion correction.", int_values=True)
+        self.add_param_slider(label_name="Parallel Planes", name="mc_num_workers", minimum=0, maximum=64, value=self.controller.params()['mc_num_workers'], moved=self.update_param, num=3, released=self.update_param, description="Number of planes to motion correct at once (0 = one per core).", int_values=True)
+        self.add_param_slider(label_name="Memory Budget", name="mc_memory_budget", minimum=1, maximum=256, value=self.controller.params()['mc_memory_budget'], moved=self.update_param, num=4, released=self.update_param, description="Memory (in GB) that planes being motion corrected in parallel may use.", int_values=True)
+        self.add_param_checkbox(label_name="Save Shifts Only", name="mc_virtual", clicked=self.toggle_mc_virtual, description="Save only the motion correction shifts instead of motion-corrected copies of the videos, and apply them when frames are read.", num=5)
 
         self.button_widget_2 = QWidget(self)
         self.button_layout_2 = QHBoxLayout(self.button_widget_2)
@@ -1008,6 +1011,9 @@ class MotionCorrectionWidget(ParamWidget):
         self.motion_correct_button.clicked.connect(self.controller.motion_correct_video)
         self.button_layout_2.addWidget(self.motion_correct_button)
 
+    def toggle_mc_virtual(self, boolean, checkbox, related_params=[]):
+        self.controller.params()['mc_virtual'] = boolean
+
     def motion_correction_started(self):
         n_groups = len(np.unique(self.controller.video_groups()))
 
@@ -1099,6 +1105,14 @@ class ROIFindingWidget(ParamWidget):
         self.find_rois_button.clicked.connect(self.controller.find_rois)
         self.button_layout.addWidget(self.find_rois_button)
 
+        self.refine_rois_button = HoverButton('Refine ROIs', self.parent_widget, self.parent_widget.statusBar())
+        self.refine_rois_button.setHoverMessage("Re-run CNMF starting from the current ROIs (skips initialization).")
+        self.refine_rois_button.setIcon(QIcon("icons/action_icon.png"))
+        self.refine_rois_button.setIconSize(QSize(13,16))
+        self.refine_rois_button.setEnabled(False)
+        self.refine_rois_button.clicked.connect(self.controller.refine_rois)
+        self.button_layout.addWidget(self.refine_rois_button)
+
     def toggle_show_zscore(self):
         show_zscore = self.show_zscore_checkbox.isChecked()
 
@@ -1108,6 +1122,7 @@ class ROIFindingWidget(ParamWidget):
         n_groups = len(np.unique(self.controller.video_groups()))
 
         self.find_rois_button.setEnabled(False)
+        self.refine_rois_button.setEnabled(False)
         self.draw_mask_button.setEnabled(False)
         
         self.parent_widget.set_default_statusbar_message("Finding ROIs for group {}/{}...".format(1, n_groups))
@@ -1120,6 +1135,7 @@ class ROIFindingWidget(ParamWidget):
 
     def roi_finding_ended(self):
         self.find_rois_button.setEnabled(True)
+        self.refine_rois_button.setEnabled(True)
         self.draw_mask_button.setEnabled(True)
 
         self.parent_widget.set_default_statusbar_message("")
@@ -1147,6 +1163,7 @@ class CNMFROIFindingWidget(ParamWidget):
         self.add_param_slider(label_name="Patch Stride", name="cnmf_patch_stride", minimum=1, maximum=100, value=self.controller.params()['cnmf_patch_stride'], moved=self.update_param, num=7, multiplier=1, pressed=self.update_param, released=self.update_param, description="Stride for each patch (pixels).", int_values=True)
         self.add_param_slider(label_name="Max Merge Area", name="max_merge_area", minimum=1, maximum=500, value=self.controller.params()['max_merge_area'], moved=self.update_param, num=8, multiplier=1, pressed=self.update_param, released=self.update_param, description="Maximum area of merged ROI above which ROIs will not be merged (pixels).", int_values=True)
         self.add_param_chooser(label_name="Initialization Method", name="init_method", options=["Greedy ROI", "Sparse NMF", "PCA/ICA"], callback=self.set_init_method, num=9, description="Method to use to initialize ROI locations.")
+        self.add_param_slider(label_name="Parallel Planes", name="cnmf_num_workers", minimum=0, maximum=64, value=self.controller.params()['cnmf_num_workers'], moved=self.update_param, num=10, multiplier=1, pressed=self.update_param, released=self.update_param, description="Number of planes to find ROIs in at once (0 = one per core). Leftover cores are used for CNMF patches.", int_values=True)
         self.main_layout.addStretch()
 
     def toggle_use_patches(self, boolean, checkbox, related_params=[]):
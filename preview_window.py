@@ -1,4 +1,5 @@
 import os
+import threading
 import numpy as np
 import cv2
 import pyqtgraph as pg
@@ -9,6 +10,7 @@ from PIL import Image
 from PIL import ImageDraw
 
 import utilities
+from trace_pyramid import TracePyramid
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -17,12 +19,18 @@ from PyQt5.QtWidgets import *
 n_colors = 20
 cmap = utilities.get_cmap(n_colors)
 
+# scatter plot symbols that draw the number of each ROI, along with their sizes (in pixels)
+text_symbols = {}
+
 colormaps  = ["inferno", "plasma", "viridis", "magma", "Reds", "Greens", "Blues", "Greys", "gray", "hot"]
 
 ROUNDED_STYLESHEET   = "QLineEdit { background-color: rgba(255, 255, 255, 0.3); border-radius: 2px; border: 1px solid rgba(0, 0, 0, 0.5); padding: 2px; color: white; };"
 STATUSBAR_STYLESHEET = "background-color: rgba(50, 50, 50, 1); border-top: 1px solid rgba(0, 0, 0, 1); font-size: 12px; font-style: italic; color: white;"
 TOP_LABEL_STYLESHEET = "QLabel{color: white; font-weight: bold; font-size: 14px;}"
 
+# number of upcoming frames that are prepared ahead of the playhead during playback
+PREFETCH_BUFFER_SIZE = 32
+
 class PreviewWindow(QMainWindow):
     def __init__(self, controller):
         QMainWindow.__init__(self)
@@ -105,6 +113,12 @@ class PreviewWindow(QMainWindow):
         self.right_image_viewbox.addItem(self.right_image)
         self.right_image_viewbox.addItem(self.right_image_overlay)
 
+        # create left and right ROI label items (each holds the labels of all ROIs, and only shows the ones of its image)
+        self.left_text_item  = pg.ScatterPlotItem(pxMode=True)
+        self.right_text_item = pg.ScatterPlotItem(pxMode=True)
+        self.left_image_viewbox.addItem(self.left_text_item)
+        self.right_image_viewbox.addItem(self.right_text_item)
+
         # create selected ROI trace viewbox
         self.roi_trace_viewbox = self.pg_widget.addPlot(name='roi_trace', row=1, col=0, colspan=2)
         self.roi_trace_viewbox.setLabel('bottom', "Frame #")
@@ -141,6 +155,15 @@ class PreviewWindow(QMainWindow):
         self.tail_angle_viewbox.setMouseEnabled(x=True,y=False)
         self.tail_angle_viewbox.setXLink('roi_trace')
 
+        # the range of frames is set when a video is shown, rather than fit to the (partial) traces that are plotted
+        self.roi_trace_viewbox.enableAutoRange(x=False)
+        self.kept_traces_viewbox.enableAutoRange(x=False)
+        self.tail_angle_viewbox.enableAutoRange(x=False)
+
+        # show the traces & heatmap at the resolution of the screen whenever the visible range of frames changes
+        self.roi_trace_viewbox.sigXRangeChanged.connect(self.trace_plots_range_changed)
+        self.roi_trace_viewbox.getViewBox().sigResized.connect(self.trace_plots_range_changed)
+
         # register a callback function for when the PyQTGraph widget is clicked
         self.pg_widget.scene().sigMouseClicked.connect(self.plot_clicked)
 
@@ -219,6 +242,9 @@ class PreviewWindow(QMainWindow):
         # create a timer for updating the frames
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update_frame)
+
+        # create a thread that prepares upcoming frames during playback
+        self.frame_prefetcher = FramePrefetchThread(self)
         
         self.set_initial_state()
 
@@ -240,17 +266,27 @@ class PreviewWindow(QMainWindow):
     def set_initial_state(self):
         self.kept_rois_image         = None
         self.removed_rois_image      = None
-        self.text_items              = []
+        self.text_items_overlays     = None # ROI overlays that the ROI labels were made for
         self.outline_items           = []
         self.mask_items              = []
         self.temp_mask_item          = None
         self.frame_num               = 0    # current frame #
         self.n_frames                = 1    # total number of frames
+        self.dropped_frames          = 0    # number of frames that weren't ready in time during playback
         self.video_name              = ""   # name of the currently showing video
         self.mask_points             = []
         self.mask                    = None
         self.selected_rois           = []
         self.roi_temporal_footprints = None
+        self.trace_items             = []   # plot items of the traces of the selected ROIs
+        self.trace_pyramid           = None # multi-resolution version of the traces of the selected ROIs
+        self.heatmap_pyramid         = None # multi-resolution version of the heatmap
+        self.shown_traces_window     = None # (level, first bin, last bin) of the trace pyramid that is plotted
+        self.shown_heatmap_window    = None # (level, first bin, last bin) of the heatmap pyramid that is shown
+        self.tail_angles_item        = None # plot item of the tail angle trace
+        self.tail_angles_pyramid     = None # multi-resolution version of the tail angle trace
+        self.tail_samples_per_frame  = 1    # number of tail angle samples per frame of the video
+        self.shown_tail_window       = None # (level, first bin, last bin) of the tail angle pyramid that is plotted
 
         self.left_image.clear()
         self.left_image_overlay.clear()
@@ -263,6 +299,8 @@ class PreviewWindow(QMainWindow):
         self.top_widget.hide()
         self.bottom_widget.hide()
         self.timer.stop()
+        self.frame_prefetcher.stop_prefetching()
+        self.set_text_items_data(None)
         self.setWindowTitle("Preview")
         self.reset_default_statusbar_message()
 
@@ -271,7 +309,8 @@ class PreviewWindow(QMainWindow):
             self.controller.frame_offset = int(float(self.frame_offset_textbox.text()))
 
             if self.controller.heatmap is not None:
-                self.kept_traces_image.setRect(QRectF(self.controller.frame_offset + self.controller.z/self.controller.video.shape[1], 0, self.controller.heatmap.shape[0], self.controller.heatmap.shape[1]))
+                self.shown_heatmap_window = None
+                self.update_heatmap_resolution()
 
             if self.roi_temporal_footprints is not None:
                 self.plot_traces(self.roi_temporal_footprints, self.selected_rois)
@@ -304,7 +343,7 @@ class PreviewWindow(QMainWindow):
         print("Setting show ROIs to {}.".format(show_rois))
         self.controller.set_show_rois(show_rois)
 
-        self.create_text_items()
+        self.update_text_items()
 
     def show_plot(self):
         self.pg_widget.show()
@@ -327,6 +366,10 @@ class PreviewWindow(QMainWindow):
     def plot_tail_angles(self, tail_angles, tail_data_fps, imaging_fps):
         self.tail_angle_viewbox.clear()
 
+        self.tail_angles_item    = None
+        self.tail_angles_pyramid = None
+        self.shown_tail_window   = None
+
         imaging_fps_one_plane = imaging_fps
 
         if tail_angles is not None:
@@ -334,9 +377,14 @@ class PreviewWindow(QMainWindow):
             total_frames = int(np.floor(one_frame*self.controller.video.shape[0] + self.controller.frame_offset + 1))
 
             if total_frames < tail_angles.shape[0]:
-                x = np.linspace(0, self.controller.video.shape[0]+self.controller.frame_offset+1, total_frames)
+                # the tail angles are stretched over the frames of the video (plus the frame offset)
+                self.tail_samples_per_frame = max(total_frames - 1, 1)/(self.controller.video.shape[0] + self.controller.frame_offset + 1)
+
+                # like the traces, only as many samples as there are pixels are plotted
+                self.tail_angles_pyramid = TracePyramid(tail_angles[np.newaxis, :total_frames], statistics=('min', 'max'))
+                self.tail_angles_item    = self.tail_angle_viewbox.plot(pen=pg.mkPen((255, 255, 0), width=2))
 
-                self.tail_angle_viewbox.plot(x, tail_angles[:total_frames], pen=pg.mkPen((255, 255, 0), width=2))
+                self.update_tail_angles_resolution()
 
                 self.tail_angle_viewbox.addItem(self.current_frame_line_3)
 
@@ -352,23 +400,112 @@ class PreviewWindow(QMainWindow):
         self.roi_trace_viewbox.clear()
         self.selected_rois = selected_rois
         self.roi_temporal_footprints = roi_temporal_footprints
+
+        self.trace_items         = []
+        self.trace_pyramid       = None
+        self.shown_traces_window = None
+
+        # traces are given already z-scored or scaled to a maximum of 1
         if roi_temporal_footprints is not None and len(selected_rois) > 0:
-            if self.controller.show_zscore:
-                max_value = 1
-            else:
-                max_value = np.amax(roi_temporal_footprints)
+            self.trace_pyramid = TracePyramid(roi_temporal_footprints[selected_rois], statistics=('min', 'max'))
 
-            x = np.arange(roi_temporal_footprints.shape[1]) + self.controller.z/self.controller.video.shape[1] + self.controller.frame_offset
             for i in range(len(selected_rois)):
                 roi = selected_rois[i]
 
                 color = cmap(roi % n_colors)[:3]
                 color = [255*color[0], 255*color[1], 255*color[2]]
 
-                self.roi_trace_viewbox.plot(x, roi_temporal_footprints[roi]/max_value, pen=pg.mkPen(color, width=2))
+                self.trace_items.append(self.roi_trace_viewbox.plot(pen=pg.mkPen(color, width=2)))
+
+            self.update_traces_resolution()
 
         self.roi_trace_viewbox.addItem(self.current_frame_line_1)
 
+    def trace_plots_origin(self):
+        # return the x position of the first frame in the trace & heatmap plots
+        return self.controller.frame_offset + self.controller.z/self.controller.video.shape[1]
+
+    def trace_plots_window(self, pyramid, shown_window, origin, samples_per_frame=1):
+        # return the (level, first bin, last bin) of the pyramid that should be shown for the visible range of frames,
+        # or None if the shown window already covers that range at the right level. The pyramid's first sample is
+        # plotted at x = origin, and it has samples_per_frame samples per frame of the video
+        x_range = self.roi_trace_viewbox.getViewBox().viewRange()[0]
+        width   = max(int(self.roi_trace_viewbox.getViewBox().width()), 1)
+
+        start = (x_range[0] - origin)*samples_per_frame
+        end   = (x_range[1] - origin)*samples_per_frame
+
+        level = pyramid.level_for(end - start, width)
+
+        if shown_window is not None and shown_window[0] == level:
+            first_bin, last_bin = pyramid.window(level, start, end)
+
+            if shown_window[1] <= first_bin and shown_window[2] >= last_bin:
+                return None
+
+        # show the visible range plus half of it on either side, so that panning doesn't need a redraw right away
+        first_bin, last_bin = pyramid.window(level, start - (end - start)/2, end + (end - start)/2)
+
+        if last_bin <= first_bin:
+            return None
+
+        return level, first_bin, last_bin
+
+    def trace_plots_data(self, pyramid, window, origin, samples_per_frame=1):
+        # return the x positions & values to plot for a window of a min/max pyramid: the values themselves
+        # at full resolution, or a vertical line from the minimum to the maximum of each bin otherwise
+        level, first_bin, last_bin = window
+        bin_size = pyramid.bin_size(level)
+
+        if bin_size == 1:
+            x      = np.arange(first_bin, last_bin)/samples_per_frame + origin
+            values = pyramid.get(level, 'min', first_bin, last_bin)
+        else:
+            mins = pyramid.get(level, 'min', first_bin, last_bin)
+            maxs = pyramid.get(level, 'max', first_bin, last_bin)
+
+            x      = np.repeat((np.arange(first_bin, last_bin) + 0.5)*bin_size/samples_per_frame + origin, 2)
+            values = np.stack([mins, maxs], axis=2).reshape((mins.shape[0], -1))
+
+        return x, values
+
+    def trace_plots_range_changed(self, *args):
+        if self.controller.video is not None:
+            self.update_traces_resolution()
+            self.update_heatmap_resolution()
+            self.update_tail_angles_resolution()
+
+    def update_traces_resolution(self):
+        if self.trace_pyramid is None:
+            return
+
+        window = self.trace_plots_window(self.trace_pyramid, self.shown_traces_window, self.trace_plots_origin())
+
+        if window is None:
+            return
+
+        x, traces = self.trace_plots_data(self.trace_pyramid, window, self.trace_plots_origin())
+
+        for i in range(len(self.trace_items)):
+            self.trace_items[i].setData(x, traces[i])
+
+        self.shown_traces_window = window
+
+    def update_tail_angles_resolution(self):
+        if self.tail_angles_pyramid is None:
+            return
+
+        window = self.trace_plots_window(self.tail_angles_pyramid, self.shown_tail_window, 0, self.tail_samples_per_frame)
+
+        if window is None:
+            return
+
+        x, tail_angles = self.trace_plots_data(self.tail_angles_pyramid, window, 0, self.tail_samples_per_frame)
+
+        self.tail_angles_item.setData(x, tail_angles[0])
+
+        self.shown_tail_window = window
+
     def clear_text_and_outline_items(self):
         # remove all text and outline items from left and right plots
         self.clear_outline_items()
@@ -386,15 +523,9 @@ class PreviewWindow(QMainWindow):
                 del outline_item
 
     def clear_text_items(self):
-        # remove all text items from left and right plots
-        for i in range(len(self.text_items)-1, -1, -1):
-            text_item = self.text_items[i]
-            if text_item in self.left_image_viewbox.addedItems:
-                self.left_image_viewbox.removeItem(text_item)
-                del text_item
-            elif text_item in self.right_image_viewbox.addedItems:
-                self.right_image_viewbox.removeItem(text_item)
-                del text_item
+        # hide the ROI labels of the left and right plots
+        self.left_text_item.hide()
+        self.right_text_item.hide()
 
     def clear_mask_items(self):
         for i in range(len(self.mask_items)-1, -1, -1):
@@ -565,7 +696,7 @@ class PreviewWindow(QMainWindow):
         elif event.button() == 2:
             if not self.controller.drawing_mask:
                 if self.left_image in items:
-                    selected_roi = utilities.get_roi_containing_point(self.controller.roi_spatial_footprints(), (int(y), int(x)), self.controller.adjusted_mean_image.shape)
+                    selected_roi = utilities.get_roi_containing_point(self.controller.roi_label_map(), (int(y), int(x)), self.controller.adjusted_mean_image.shape)
 
                     if selected_roi is not None:
                         # self.controller.selected_rois = []
@@ -576,7 +707,7 @@ class PreviewWindow(QMainWindow):
 
                         self.controller.discard_selected_rois()
                 else:
-                    selected_roi = utilities.get_roi_containing_point(self.controller.roi_spatial_footprints(), (int(y), int(x)), self.controller.adjusted_mean_image.shape)
+                    selected_roi = utilities.get_roi_containing_point(self.controller.roi_label_map(), (int(y), int(x)), self.controller.adjusted_mean_image.shape)
 
                     if selected_roi is not None:
                         # self.controller.selected_rois = []
@@ -627,26 +758,46 @@ class PreviewWindow(QMainWindow):
 
         self.controller.set_play_video(play_video_bool)
 
-    def create_text_items(self):
-        self.clear_text_items()
+    def update_text_items(self):
+        # the labels are only remade when the ROIs change, otherwise only which of them are shown is updated
+        roi_overlays = self.controller.roi_overlays if self.controller.roi_spatial_footprints() is not None else None
 
-        if self.controller.show_rois:
-            if self.controller.roi_spatial_footprints() is not None:
-                for i in range(self.controller.roi_spatial_footprints().shape[-1]):
-                    x = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 0])-5 for j in range(len(self.controller.roi_contours[i])) ])
-                    y = np.amax([ np.amax(self.controller.roi_contours[i][j][:, 0, 1])-5 for j in range(len(self.controller.roi_contours[i])) ])
-                    
-                    color = cmap(i % n_colors)[:3]
-                    color = [255*color[0], 255*color[1], 255*color[2]]
-
-                    text_item = pg.TextItem("{}".format(i), color=color)
-                    text_item.setPos(QPoint(int(y), int(x)))
-                    self.text_items.append(text_item)
-
-                    if i not in self.controller.removed_rois():
-                        self.left_image_viewbox.addItem(text_item)
-                    else:
-                        self.right_image_viewbox.addItem(text_item)
+        if roi_overlays is not self.text_items_overlays:
+            self.set_text_items_data(roi_overlays)
+
+        if roi_overlays is None or len(roi_overlays) == 0 or not self.controller.show_rois:
+            self.clear_text_items()
+            return
+
+        kept = np.ones(len(roi_overlays), dtype=bool)
+        kept[list(self.controller.removed_rois())] = False
+
+        # ROIs that cover no pixels have no label
+        nonempty = np.all(roi_overlays.sizes > 0, axis=1)
+
+        self.left_text_item.setPointsVisible(kept & nonempty)
+        self.right_text_item.setPointsVisible(~kept & nonempty)
+
+        self.left_text_item.show()
+        self.right_text_item.show()
+
+    def set_text_items_data(self, roi_overlays):
+        # make the labels of the given ROIs (placed near the bottom-right corner of their contours)
+        self.text_items_overlays = roi_overlays
+
+        if roi_overlays is None or len(roi_overlays) == 0:
+            self.left_text_item.clear()
+            self.right_text_item.clear()
+            return
+
+        # the overlays are indexed by (x, y), so their rows & columns are the x & y coordinates of the plots
+        positions = roi_overlays.corners() - 5
+
+        symbols, sizes = zip(*[ text_symbol("{}".format(i)) for i in range(len(roi_overlays)) ])
+        brushes        = [ pg.mkBrush(*color) for color in roi_overlays.colors ]
+
+        for text_item in (self.left_text_item, self.right_text_item):
+            text_item.setData(pos=positions, symbol=list(symbols), size=list(sizes), brush=brushes, pen=pg.mkPen(None))
 
     def play_video(self):
         self.timer.stop()
@@ -654,27 +805,32 @@ class PreviewWindow(QMainWindow):
         self.show_plot()
 
         # set frame number to 0
-        self.frame_num = 0
+        self.frame_num      = 0
+        self.dropped_frames = 0
 
         # get the number of frames
-        self.n_frames = self.controller.adjusted_video.shape[0]
+        self.n_frames = self.controller.video.shape[0]
+
+        # start preparing frames (any frames prepared before may be out of date)
+        self.frame_prefetcher.start_prefetching(self.prepare_frame_function(), self.n_frames)
 
         # start the timer to update the frames
         self.timer.start(int(1000.0/self.controller.gui_params['fps']))
 
-        self.kept_traces_viewbox.setXRange(0, self.controller.adjusted_video.shape[0])
+        self.kept_traces_viewbox.setXRange(0, self.controller.video.shape[0])
 
-        self.create_text_items()
+        self.update_text_items()
 
     def show_mean_image(self):
         self.timer.stop()
+        self.frame_prefetcher.stop_prefetching()
 
         self.show_plot()
 
         self.update_left_image_plot(self.controller.adjusted_mean_image, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
         self.update_right_image_plot(self.controller.adjusted_mean_image, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
 
-        self.create_text_items()
+        self.update_text_items()
 
     def set_fps(self, fps):
         # restart the timer with the new fps
@@ -685,12 +841,37 @@ class PreviewWindow(QMainWindow):
         self.update_left_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
         self.update_right_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
 
-    def update_frame(self):
-        if self.controller.adjusted_video is not None:
-            frame = self.controller.adjusted_video[self.frame_num]
+    def prepare_frame_function(self):
+        # return a function that adjusts a frame & converts it to RGB for display. It's run by the prefetch thread, so it
+        # only uses a snapshot of the video, plane & display settings, taken here on the GUI thread
+        adjusted_frame = self.controller.adjusted_frame_function()
+        video_max      = self.controller.video_max
+
+        def prepare_frame(frame_num):
+            image = adjusted_frame(frame_num)
 
-            self.update_left_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
-            self.update_right_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
+            if image.dtype != np.uint8:
+                image = utilities.display_image(image, video_max)
+
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+
+        return prepare_frame
+
+    def update_frame(self):
+        if self.controller.video is not None:
+            try:
+                frame = self.frame_prefetcher.take_frame(self.frame_num)
+            except:
+                # preparing frames failed -- stop playing instead of dropping every frame
+                self.timer.stop()
+                raise
+
+            if frame is not None:
+                self.update_left_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
+                self.update_right_image_plot(frame, roi_spatial_footprints=self.controller.roi_spatial_footprints(), video_dimensions=self.controller.video.shape, removed_rois=self.controller.removed_rois(), selected_rois=self.controller.selected_rois, show_rois=self.controller.show_rois)
+            else:
+                # the frame wasn't ready in time -- skip it to keep up the frame rate
+                self.dropped_frames += 1
 
             # increment frame number (keeping it between 0 and n_frames)
             self.frame_num += 1
@@ -702,16 +883,13 @@ class PreviewWindow(QMainWindow):
 
             if not self.item_hovered:
                 # update status bar
-                self.set_default_statusbar_message("Viewing {}. Z={}. Frame {}/{}.".format(self.video_name, self.controller.z, self.frame_num + 1, self.n_frames))
+                self.set_default_statusbar_message("Viewing {}. Z={}. Frame {}/{}. Dropped frames: {}.".format(self.video_name, self.controller.z, self.frame_num + 1, self.n_frames, self.dropped_frames))
 
     def update_left_image_plot(self, image, roi_spatial_footprints=None, video_dimensions=None, removed_rois=None, selected_rois=None, show_rois=False):
-        image = 255.0*image/self.controller.video_max
-        image[image > 255] = 255
+        image = self.display_image(image)
 
         if len(image.shape) < 3:
-            image = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_GRAY2RGB)
-        else:
-            image = image.astype(np.uint8)
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
 
         self.kept_rois_image = image
 
@@ -731,6 +909,13 @@ class PreviewWindow(QMainWindow):
         if not self.item_hovered:
             self.set_default_statusbar_message("Viewing {}. Z={}.".format(self.video_name, self.controller.z))
 
+    def display_image(self, image):
+        # frames mapped through the controller's display lookup table are already scaled to 0-255
+        if image.dtype == np.uint8:
+            return image
+
+        return utilities.display_image(image, self.controller.video_max)
+
     def update_mask_items(self, selected_mask=-1):
         self.clear_mask_items()
         mask_points = self.controller.mask_points()
@@ -759,16 +944,49 @@ class PreviewWindow(QMainWindow):
         self.play_video_checkbox.setEnabled(True)
 
     def update_heatmap_plot(self, heatmap):
+        self.shown_heatmap_window = None
+
         if heatmap is not None:
-            if self.controller.show_zscore:
-                self.kept_traces_image.setImage(heatmap, levels=(-2.01, 3.01))
-            else:
-                self.kept_traces_image.setImage(heatmap, levels=(0, 1.01))
+            new_video = self.heatmap_pyramid is None or self.heatmap_pyramid.num_frames != heatmap.shape[0]
+
+            self.heatmap_pyramid = TracePyramid(heatmap.T, statistics=('mean',))
 
-            self.kept_traces_image.setRect(QRectF(self.controller.frame_offset + self.controller.z/self.controller.video.shape[1], 0, heatmap.shape[0], heatmap.shape[1]))
+            if new_video:
+                # show all frames of a new video
+                self.kept_traces_viewbox.setXRange(0, heatmap.shape[0])
+
+            self.update_heatmap_resolution()
         else:
+            self.heatmap_pyramid = None
+
             self.kept_traces_image.setImage(None)
 
+    def update_heatmap_resolution(self):
+        if self.heatmap_pyramid is None:
+            return
+
+        window = self.trace_plots_window(self.heatmap_pyramid, self.shown_heatmap_window, self.trace_plots_origin())
+
+        if window is None:
+            return
+
+        level, first_bin, last_bin = window
+        bin_size = self.heatmap_pyramid.bin_size(level)
+
+        heatmap = self.heatmap_pyramid.get(level, 'mean', first_bin, last_bin).T
+
+        if self.controller.show_zscore:
+            self.kept_traces_image.setImage(heatmap, levels=(-2.01, 3.01))
+        else:
+            self.kept_traces_image.setImage(heatmap, levels=(0, 1.01))
+
+        # the last bin may hold fewer frames, so the image ends at the last frame
+        last_frame = min(last_bin*bin_size, self.heatmap_pyramid.num_frames)
+
+        self.kept_traces_image.setRect(QRectF(self.trace_plots_origin() + first_bin*bin_size, 0, last_frame - first_bin*bin_size, heatmap.shape[1]))
+
+        self.shown_heatmap_window = window
+
     def create_removed_rois_image(self, image, video_max, roi_spatial_footprints=None, video_dimensions=None, removed_rois=None, selected_rois=None, show_rois=False):
         image = 255.0*image/video_max
         image[image > 255] = 255
@@ -794,13 +1012,10 @@ class PreviewWindow(QMainWindow):
         self.right_image.setImage(image, autoLevels=False)
 
     def update_right_image_plot(self, image, roi_spatial_footprints=None, video_dimensions=None, removed_rois=None, selected_rois=None, show_rois=False):
-        image = 255.0*image/self.controller.video_max
-        image[image > 255] = 255
+        image = self.display_image(image)
 
         if len(image.shape) < 3:
-            image = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_GRAY2RGB)
-        else:
-            image = image.astype(np.uint8)
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
 
         self.removed_rois_image = image
 
@@ -830,8 +1045,168 @@ class PreviewWindow(QMainWindow):
         if not self.controller.closing:
             ce.ignore()
         else:
+            self.timer.stop()
+            self.frame_prefetcher.quit_prefetching()
+
             ce.accept()
 
+def text_symbol(text):
+    # return a scatter plot symbol that draws the given text, and the size (in pixels) that it should be drawn at
+    if text not in text_symbols:
+        path = QPainterPath()
+        path.addText(0, 0, QFont(), text)
+
+        rect = path.boundingRect()
+        size = max(rect.width(), rect.height())
+
+        # symbols are scaled by their size, so they are made to fit in a unit square centered on the point
+        transform = QTransform()
+        transform.scale(1.0/size, 1.0/size)
+        transform.translate(-rect.center().x(), -rect.center().y())
+
+        text_symbols[text] = (transform.map(path), size)
+
+    return text_symbols[text]
+
+class FramePrefetchThread(QThread):
+    '''Prepares upcoming frames for display in the background during playback.
+
+    Frames ahead of the playhead are prepared (using frame_function, which
+    returns the display image of a frame number) into a buffer holding at
+    most buffer_size frames. If preparing frames falls behind the playhead,
+    the frames that were missed are skipped. If frame_function raises an
+    error, prefetching stops and the error is raised by take_frame.'''
+
+    def __init__(self, parent, buffer_size=PREFETCH_BUFFER_SIZE):
+        QThread.__init__(self, parent)
+
+        self.buffer_size = buffer_size
+
+        self.condition      = threading.Condition()
+        self.frame_function = None
+        self.frames         = {}  # prepared frames, keyed by frame number
+        self.n_frames       = 1
+        self.next_frame     = 0   # next frame to prepare
+        self.playhead       = 0   # next frame that will be shown
+        self.generation     = 0   # incremented whenever prepared frames become out of date
+        self.error          = None # error raised while preparing a frame, to be raised on the GUI thread
+        self.running        = False
+
+    def capacity(self):
+        return min(self.buffer_size, self.n_frames)
+
+    def frames_ahead(self, frame_num):
+        # number of frames between the playhead and the given frame
+        return (frame_num - self.playhead) % self.n_frames
+
+    def start_prefetching(self, frame_function, n_frames, start_frame=0):
+        with self.condition:
+            self.frame_function = frame_function
+            self.frames         = {}
+            self.n_frames       = max(n_frames, 1)
+            self.next_frame     = start_frame
+            self.playhead       = start_frame
+            self.generation    += 1
+            self.error          = None
+
+            self.condition.notify_all()
+
+        if not self.isRunning():
+            self.running = True
+            self.start()
+
+    def stop_prefetching(self):
+        with self.condition:
+            self.frame_function = None
+            self.frames         = {}
+            self.generation    += 1
+            self.error          = None
+
+    def quit_prefetching(self):
+        with self.condition:
+            self.running = False
+
+            self.condition.notify_all()
+
+        self.wait()
+
+    def skip_missed_frames(self, frames_late=0):
+        # if preparing frames has fallen behind the playhead (or the last frame was ready too late), skip ahead of the
+        # playhead by as many frames as were missed, so that the next frame to be prepared isn't already due by the time it's ready
+        if self.frames_ahead(self.next_frame) >= self.capacity():
+            frames_late = max(frames_late, (self.playhead - self.next_frame) % self.n_frames)
+
+        if frames_late > 0 and self.frames_ahead(self.next_frame) <= frames_late:
+            self.next_frame = (self.playhead + min(frames_late + 1, self.capacity() - 1)) % self.n_frames
+
+    def take_frame(self, frame_num):
+        # return the prepared frame with the given number (or None if it isn't ready), and move the playhead past it
+        with self.condition:
+            if self.error is not None:
+                error      = self.error
+                self.error = None
+
+                raise error
+
+            frame = self.frames.pop(frame_num, None)
+
+            self.playhead = (frame_num + 1) % self.n_frames
+
+            # forget frames that the playhead has passed
+            for prepared_frame_num in list(self.frames.keys()):
+                if self.frames_ahead(prepared_frame_num) >= self.capacity():
+                    del self.frames[prepared_frame_num]
+
+            self.skip_missed_frames()
+
+            self.condition.notify_all()
+
+        return frame
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (self.frame_function is None or len(self.frames) >= self.capacity()):
+                    self.condition.wait()
+
+                if not self.running:
+                    break
+
+                self.skip_missed_frames()
+
+                if self.next_frame in self.frames:
+                    # already prepared
+                    self.next_frame = (self.next_frame + 1) % self.n_frames
+                    continue
+
+                frame_function = self.frame_function
+                frame_num      = self.next_frame
+                generation     = self.generation
+
+                self.next_frame = (frame_num + 1) % self.n_frames
+
+            # prepare the frame without holding the lock, so that the playhead can keep moving
+            try:
+                frame = frame_function(frame_num)
+            except Exception as error:
+                # stop preparing frames & hand the error over to the GUI thread, rather than dropping every frame from now on
+                with self.condition:
+                    if generation == self.generation:
+                        self.frame_function = None
+                        self.error          = error
+
+                continue
+
+            with self.condition:
+                if generation != self.generation:
+                    continue
+
+                if self.frames_ahead(frame_num) >= self.capacity():
+                    # the playhead has already passed this frame
+                    self.skip_missed_frames((self.playhead - frame_num) % self.n_frames)
+                elif frame is not None:
+                    self.frames[frame_num] = frame
+
 class HoverCheckBox(QCheckBox):
     def __init__(self, text, parent=None, status_bar=None):
         QCheckBox.__init__(self, text, parent)
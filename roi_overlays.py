@@ -0,0 +1,231 @@
+'''
+Compact store of the colored overlays that are drawn on top of the video to
+show ROIs.
+
+Rather than keeping a full-size RGBA image for every ROI, each ROI's overlay
+is kept cropped to its bounding box, along with the offset of the box in the
+plane image. The contours of each ROI are found on the same crops.
+'''
+
+import numpy as np
+import scipy.sparse
+import cv2
+
+from footprints import footprint_stats, pixel_coordinates
+
+class ROIOverlays():
+    '''RGBA overlays of the ROIs in a plane.
+
+    footprints is a (pixels x ROIs) sparse matrix whose flat pixel indices
+    map onto an image of the given shape as np.reshape(..., shape,
+    order=order) would map them, and colors is an (ROIs x 3) array of RGB
+    colors (0-255). The alpha of each pixel is the ROI's weight there,
+    relative to its peak weight.'''
+
+    def __init__(self, footprints, shape, colors, order='C'):
+        footprints = scipy.sparse.csc_matrix(footprints)
+        footprints.sum_duplicates()
+
+        self.shape = tuple(shape)
+
+        num_rois = footprints.shape[-1]
+
+        stats = footprint_stats(footprints, self.shape, order=order)
+
+        self.offsets  = np.zeros((num_rois, 2), dtype=int) # (row, column) of the top-left corner of each patch
+        self.patches  = []                                  # (h, w, 4) RGBA overlay of each ROI, cropped to its bounding box
+        self.contours = []                                  # contours of each ROI (in plane coordinates, as cv2 returns them)
+        self.colors   = np.asarray(colors).reshape((-1, 3)).astype(np.uint8)
+
+        # the covered pixels of all ROIs, grouped by ROI, for compositing many overlays at once
+        entry_rows   = []
+        entry_cols   = []
+        entry_alphas = []
+
+        for i in range(num_rois):
+            weights = footprints.data[footprints.indptr[i]:footprints.indptr[i+1]]
+            pixels  = footprints.indices[footprints.indptr[i]:footprints.indptr[i+1]]
+
+            positive = weights > 0
+
+            if not np.any(positive):
+                self.patches.append(np.zeros((0, 0, 4), dtype=np.uint8))
+                self.contours.append([])
+                entry_rows.append(np.zeros(0, dtype=int))
+                entry_cols.append(np.zeros(0, dtype=int))
+                entry_alphas.append(np.zeros(0, dtype=np.uint8))
+                continue
+
+            weights    = weights[positive]
+            rows, cols = pixel_coordinates(pixels[positive], self.shape, order=order)
+
+            r_0, c_0, r_1, c_1 = stats['bbox'][i].astype(int)
+
+            self.offsets[i] = [r_0, c_0]
+
+            patch = np.zeros((r_1 - r_0 + 1, c_1 - c_0 + 1, 4), dtype=np.uint8)
+            patch[rows - r_0, cols - c_0, :-1] = self.colors[i]
+            patch[rows - r_0, cols - c_0, -1]  = 255.0*weights/stats['peak'][i]
+
+            self.patches.append(patch)
+
+            entry_rows.append(rows)
+            entry_cols.append(cols)
+            entry_alphas.append(patch[rows - r_0, cols - c_0, -1])
+
+            # pad the mask by one pixel so that contours touching the edge of the patch are closed, and shift them to plane coordinates
+            mask = np.zeros((patch.shape[0] + 2, patch.shape[1] + 2), dtype=np.uint8)
+            mask[1 + rows - r_0, 1 + cols - c_0] = 1
+
+            self.contours.append(cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE, offset=(int(c_0) - 1, int(r_0) - 1))[-2])
+
+        self.sizes = np.array([ patch.shape[:2] for patch in self.patches ], dtype=int).reshape((-1, 2)) # (height, width) of each patch
+
+        self.entry_indptr = np.concatenate([[0], np.cumsum([ len(rows) for rows in entry_rows ])]).astype(int)
+        self.entry_rows   = np.concatenate(entry_rows).astype(int) if num_rois > 0 else np.zeros(0, dtype=int)
+        self.entry_cols   = np.concatenate(entry_cols).astype(int) if num_rois > 0 else np.zeros(0, dtype=int)
+        self.entry_alphas = np.concatenate(entry_alphas) if num_rois > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.patches)
+
+    def bounds(self, i):
+        # return the (start row, end row, start column, end column) of the patch of ROI i (ends are exclusive)
+        r_0, c_0 = self.offsets[i]
+        h, w     = self.patches[i].shape[:2]
+
+        return r_0, r_0 + h, c_0, c_0 + w
+
+    def corners(self):
+        # return the (row, column) of the bottom-right corner of each ROI's patch (the furthest point of its contours)
+        return self.offsets + self.sizes - 1
+
+    def rois_in_region(self, rois, region):
+        # return the given ROIs (in the same order) whose patches overlap the region (start row, end row, start column, end column)
+        rois = np.asarray(rois, dtype=int)
+
+        r_0, r_1, c_0, c_1 = region
+
+        starts = self.offsets[rois]
+        ends   = starts + self.sizes[rois]
+
+        overlapping = (starts[:, 0] < r_1) & (ends[:, 0] > r_0) & (starts[:, 1] < c_1) & (ends[:, 1] > c_0) & np.all(self.sizes[rois] > 0, axis=1)
+
+        return rois[overlapping]
+
+    def crop(self, i, r_0, r_1, c_0, c_1):
+        # return the overlay of ROI i within the given region of the plane (ends are exclusive)
+        crop = np.zeros((r_1 - r_0, c_1 - c_0, 4), dtype=np.uint8)
+
+        p_r_0, p_r_1, p_c_0, p_c_1 = self.bounds(i)
+
+        # intersection of the region and the patch
+        i_r_0, i_r_1 = max(r_0, p_r_0), min(r_1, p_r_1)
+        i_c_0, i_c_1 = max(c_0, p_c_0), min(c_1, p_c_1)
+
+        if i_r_0 < i_r_1 and i_c_0 < i_c_1:
+            crop[i_r_0 - r_0:i_r_1 - r_0, i_c_0 - c_0:i_c_1 - c_0] = self.patches[i][i_r_0 - p_r_0:i_r_1 - p_r_0, i_c_0 - p_c_0:i_c_1 - p_c_0]
+
+        return crop
+
+    def overlay(self, i):
+        # return the full-size overlay of ROI i
+        return self.crop(i, 0, self.shape[0], 0, self.shape[1])
+
+    def entries(self, rois):
+        # return the indices of the covered pixels of the given ROIs, and the position of their ROI in rois
+        rois    = np.asarray(rois, dtype=int)
+        lengths = self.entry_indptr[rois+1] - self.entry_indptr[rois]
+
+        positions = np.repeat(np.arange(len(rois)), lengths)
+        indices   = np.repeat(self.entry_indptr[rois] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(np.sum(lengths))
+
+        return indices.astype(int), positions
+
+    def composite(self, rois, region=None):
+        '''Composites the overlays of the given ROIs, with later ROIs drawn over
+        earlier ones (like repeatedly alpha compositing them), into a single
+        RGBA image. If region (start row, end row, start column, end column)
+        is given, only that part of the plane is composited.'''
+
+        if region is None:
+            region = (0, self.shape[0], 0, self.shape[1])
+
+        r_0, r_1, c_0, c_1 = region
+
+        image = np.zeros((r_1 - r_0, c_1 - c_0, 4), dtype=np.uint8)
+
+        if len(rois) == 0:
+            return image
+
+        indices, positions = self.entries(rois)
+
+        rows = self.entry_rows[indices]
+        cols = self.entry_cols[indices]
+
+        inside = (rows >= r_0) & (rows < r_1) & (cols >= c_0) & (cols < c_1)
+
+        pixels    = (rows[inside] - r_0)*(c_1 - c_0) + (cols[inside] - c_0)
+        positions = positions[inside]
+        alphas    = self.entry_alphas[indices[inside]]/255.0
+        colors    = self.colors[np.asarray(rois, dtype=int)[positions]]
+
+        # sort by pixel, then by compositing order
+        entry_order = np.lexsort((positions, pixels))
+        pixels      = pixels[entry_order]
+        alphas      = alphas[entry_order]
+        colors      = colors[entry_order]
+
+        if len(pixels) == 0:
+            return image
+
+        # each entry is seen through the entries drawn over it at the same pixel, so its
+        # contribution is its alpha times the product of (1 - alpha) of the later entries.
+        # The products are found with sums of logs (fully opaque entries are counted separately).
+        opaque = alphas >= 1
+        logs   = np.where(opaque, 0, np.log(np.where(opaque, 0.5, 1 - alphas)))
+
+        group_starts = np.concatenate([[True], pixels[1:] != pixels[:-1]])
+        group_ends   = np.concatenate([np.nonzero(group_starts)[0][1:], [len(pixels)]]) - 1
+        group_nums   = np.cumsum(group_starts) - 1
+
+        cumulative_logs   = np.cumsum(logs)
+        cumulative_opaque = np.cumsum(opaque)
+
+        later_logs   = cumulative_logs[group_ends][group_nums] - cumulative_logs
+        later_opaque = cumulative_opaque[group_ends][group_nums] - cumulative_opaque
+
+        contributions = alphas*np.exp(later_logs)*(later_opaque == 0)
+
+        num_pixels   = image.shape[0]*image.shape[1]
+        total_alphas = np.bincount(pixels, weights=contributions, minlength=num_pixels)
+
+        flat_image = image.reshape((-1, 4))
+
+        covered = total_alphas > 0
+        for channel in range(3):
+            channel_sums = np.bincount(pixels, weights=contributions*colors[:, channel], minlength=num_pixels)
+
+            flat_image[covered, channel] = np.round(channel_sums[covered]/total_alphas[covered])
+        flat_image[:, 3] = np.round(255*np.minimum(total_alphas, 1))
+
+        return image
+
+    def subset(self, rois):
+        # return a store holding only the given ROIs (in the given order)
+        overlays = ROIOverlays.__new__(ROIOverlays)
+
+        indices, positions = self.entries(rois)
+
+        overlays.shape        = self.shape
+        overlays.offsets      = self.offsets[list(rois)].reshape((-1, 2))
+        overlays.patches      = [ self.patches[i] for i in rois ]
+        overlays.sizes        = self.sizes[list(rois)].reshape((-1, 2))
+        overlays.contours     = [ self.contours[i] for i in rois ]
+        overlays.colors       = self.colors[list(rois)].reshape((-1, 3))
+        overlays.entry_indptr = np.concatenate([[0], np.cumsum(self.entry_indptr[np.asarray(rois, dtype=int)+1] - self.entry_indptr[np.asarray(rois, dtype=int)])]).astype(int)
+        overlays.entry_rows   = self.entry_rows[indices]
+        overlays.entry_cols   = self.entry_cols[indices]
+        overlays.entry_alphas = self.entry_alphas[indices]
+
+        return overlays
@@ -0,0 +1,82 @@
+'''
+Loading of tail angle traces from the CSV files saved by the behavior
+tracking software.
+
+Parsing the CSV of an hour-long recording takes a while, so the tail angle
+trace is stored in a binary sidecar file next to the CSV the first time it
+is loaded, and then loaded from the sidecar. A sidecar is only used if the
+size and modification time of the CSV still match the ones it was made from.
+'''
+
+import os
+import json
+import numpy as np
+
+from cache import file_identity
+
+# suffix of the sidecar files that hold the tail angle traces
+TAIL_ANGLES_SUFFIX = "_tail_angles.npz"
+
+# version of the sidecar format -- bump this to invalidate existing sidecars
+TAIL_ANGLES_VERSION = 1
+
+# number of points at the end of the tail whose angles are averaged to get the tail angle
+NUM_TAIL_POINTS = 3
+
+# number of samples at the start of the trace that are used as its baseline
+BASELINE_SAMPLES = 100
+
+def tail_angles_path(csv_path):
+    return os.path.splitext(csv_path)[0] + TAIL_ANGLES_SUFFIX
+
+def load_tail_angle_trace(csv_path):
+    '''Returns the tail angle trace saved in a CSV file, loading it from the
+    CSV's sidecar if it's up to date, or parsing the CSV (and writing the
+    sidecar) otherwise.'''
+
+    path     = tail_angles_path(csv_path)
+    identity = json.dumps({'version': TAIL_ANGLES_VERSION, 'files': [file_identity(csv_path)]})
+
+    if os.path.exists(path):
+        try:
+            sidecar = np.load(path)
+
+            if str(sidecar['identity']) == identity:
+                return sidecar['tail_angles']
+        except:
+            pass
+
+    print("Parsing tail angles in {}...".format(csv_path))
+
+    tail_angles = parse_tail_angles(csv_path)
+
+    try:
+        temp_path = path + ".temp.npz"
+
+        np.savez(temp_path, identity=identity, tail_angles=tail_angles)
+
+        os.replace(temp_path, path)
+    except:
+        # the CSV's folder may not be writable -- the CSV will just be parsed again next time
+        print("Could not save tail angles of {}.".format(csv_path))
+
+    return tail_angles
+
+def parse_tail_angles(csv_path):
+    # the tail angle is the mean angle of the last points of the tail, relative to its mean at the start of the recording
+    tail_angles = np.nanmean(read_last_columns(csv_path, NUM_TAIL_POINTS), axis=-1)
+
+    tail_angles -= np.nanmean(tail_angles[:BASELINE_SAMPLES])
+
+    return tail_angles
+
+def read_last_columns(csv_path, num_columns):
+    # read the last columns of a CSV file as floats
+    with open(csv_path) as f:
+        num_fields = len(f.readline().split(","))
+
+    try:
+        return np.loadtxt(csv_path, delimiter=",", usecols=range(max(num_fields - num_columns, 0), num_fields), ndmin=2)
+    except ValueError:
+        # the file has missing values or non-numeric rows (eg. a header) -- use the slower parser, which turns them into NaNs
+        return np.genfromtxt(csv_path, delimiter=",")[:, -num_columns:]
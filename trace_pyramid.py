@@ -0,0 +1,77 @@
+'''
+Multi-resolution versions of traces, used to plot long recordings with only
+as many columns as there are pixels on the screen.
+
+Each level of the pyramid halves the number of frames of the previous one,
+by taking the minimum, maximum and/or mean of pairs of its frames. Plotting
+the min/max of each bin keeps peaks visible at any zoom level, while the mean
+is what a heatmap of the traces should show.
+'''
+
+import numpy as np
+
+STATISTICS = {'min' : np.amin,
+              'max' : np.amax,
+              'mean': np.mean}
+
+class TracePyramid():
+    '''Min/max/mean pyramid of a (traces x frames) array. Level 0 is the
+    array itself, and each frame of level k is a bin of 2**k frames of it.'''
+
+    def __init__(self, traces, statistics=('min', 'max'), dtype=np.float32):
+        traces = np.asarray(traces)
+
+        self.num_frames = traces.shape[-1]
+        self.statistics = list(statistics)
+        self.levels     = [ { statistic: traces for statistic in self.statistics } ]
+
+        while self.levels[-1][self.statistics[0]].shape[-1] > 1:
+            # the last bin may hold fewer frames than the others, which its pair's mean has to take into account
+            last_weight = self.last_bin_size(len(self.levels) - 1)/self.bin_size(len(self.levels) - 1)
+
+            self.levels.append({ statistic: reduce_pairs(self.levels[-1][statistic], statistic, dtype, last_weight) for statistic in self.statistics })
+
+    def bin_size(self, level):
+        return 2**level
+
+    def num_bins(self, level):
+        return self.levels[level][self.statistics[0]].shape[-1]
+
+    def last_bin_size(self, level):
+        # number of frames in the last bin of a level (which is smaller than the others if the frames don't fill it)
+        return self.num_frames - (self.num_bins(level) - 1)*self.bin_size(level)
+
+    def level_for(self, num_frames, max_columns):
+        # return the finest level that shows the given number of frames in at most max_columns bins
+        level = 0
+        while level < len(self.levels) - 1 and np.ceil(num_frames/self.bin_size(level)) > max_columns:
+            level += 1
+
+        return level
+
+    def window(self, level, start, end):
+        # return the (first, last) bins of a level that cover the frames from start to end (the last bin is exclusive)
+        bin_size = self.bin_size(level)
+
+        first_bin = int(min(max(np.floor(start/bin_size), 0), self.num_bins(level)))
+        last_bin  = int(min(max(np.ceil(end/bin_size), 0), self.num_bins(level)))
+
+        return first_bin, last_bin
+
+    def get(self, level, statistic, first_bin, last_bin):
+        return self.levels[level][statistic][:, first_bin:last_bin]
+
+def reduce_pairs(values, statistic, dtype, last_weight=1):
+    # combine pairs of adjacent frames of values (an odd last frame is kept as is). last_weight is the number of
+    # frames in the last bin of values relative to the others, so that the mean of the last pair is the true mean
+    num_frames = values.shape[-1]
+
+    pairs   = values[:, :num_frames - num_frames % 2].reshape((values.shape[0], -1, 2))
+    reduced = STATISTICS[statistic](pairs, axis=2)
+
+    if num_frames % 2 == 1:
+        reduced = np.concatenate([reduced, values[:, -1:]], axis=1)
+    elif statistic == 'mean' and last_weight != 1 and num_frames > 0:
+        reduced[:, -1] = (values[:, -2] + last_weight*values[:, -1])/(1 + last_weight)
+
+    return reduced.astype(dtype)
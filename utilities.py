@@ -9,6 +9,8 @@ import time
 import shutil
 import h5py
 import scipy
+import scipy.cluster.hierarchy
+import scipy.spatial.distance
 import peakutils
 import matplotlib.pyplot as plt
 from scipy import sparse
@@ -17,7 +19,7 @@ import caiman as cm
 from caiman.source_extraction.cnmf import cnmf as cnmf
 from caiman.source_extraction.cnmf import params as cnmf_params
 from caiman.source_extraction.cnmf import estimates as estimates
-from caiman.components_evaluation import estimate_components_quality_auto
+from caiman.components_evaluation import compute_event_exceptionality, find_activity_intervals
 from caiman.source_extraction.cnmf.temporal import update_temporal_components
 from caiman.source_extraction.cnmf.pre_processing import preprocess_data
 from caiman.motion_correction import MotionCorrect
@@ -28,6 +30,13 @@ from keras import layers
 from keras import optimizers
 from keras.preprocessing.image import ImageDataGenerator
 import logging
+import multiprocessing
+import multiprocessing.pool
+import queue
+
+from cache import array_digest
+from footprints import footprint_stats
+from cluster import ClusterManager
 
 # see if suite2p is available
 try:
@@ -37,6 +46,28 @@ try:
 except:
     suite2p_enabled = False
 
+# number of float32 copies of a plane held in memory while it is motion corrected
+MC_PLANE_COPIES = 4
+
+# parameters that affect the ROIs found by each method
+ROI_FINDING_PARAMS = {'cnmf'   : ['use_patches', 'cnmf_patch_size', 'cnmf_patch_stride', 'imaging_fps', 'decay_time',
+                                  'autoregressive_order', 'num_bg_components', 'merge_threshold', 'num_components',
+                                  'half_size', 'init_method', 'max_merge_area'],
+                      'suite2p': ['diameter', 'sampling_rate', 'connected', 'neuropil_basis_ratio', 'neuropil_radius_ratio',
+                                  'inner_neuropil_radius', 'min_neuropil_pixels']}
+
+# parameters that affect the metrics used to filter ROIs (the others are thresholds applied to the metrics)
+ROI_FILTER_METRIC_PARAMS    = ['imaging_fps', 'decay_time']
+ROI_FILTER_THRESHOLD_PARAMS = ['min_snr', 'min_spatial_corr', 'min_area', 'max_area', 'artifact_decay_speed', 'min_df_f',
+                               'cnn_accept_threshold', 'cnn_reject_threshold']
+
+# ROIs below these are rejected even if they pass the other SNR / spatial correlation threshold
+MIN_SNR_LOWEST          = 0.5
+MIN_SPATIAL_CORR_LOWEST = -1
+
+# suffix of the sidecar files that hold the shifts of a virtual motion-corrected video
+MC_SHIFTS_SUFFIX = "_mc_shifts.npz"
+
 def get_cmap(n, name='hsv'):
     '''Returns a function that maps each index in 0, 1, ..., n-1 to a distinct 
     RGB color; the keyword argument name must be a standard mpl colormap name.'''
@@ -51,115 +82,523 @@ def adjust_contrast(image, contrast):
 def adjust_gamma(image, gamma):
     return skimage.exposure.adjust_gamma(image, gamma)
 
-def motion_correct_multiple_videos(video_paths, video_groups, max_shift, patch_stride, patch_overlap, progress_signal=None, thread=None, use_multiprocessing=True):
-    start_time = time.time()
+def display_image(image, video_max):
+    # scale a (contrast- and gamma-adjusted) image to 0-255 for display
+    image = 255.0*image/video_max
+    image[image > 255] = 255
 
-    mc_video_paths = []
-    mc_videos  = []
-    mc_borders = {}
+    return image.astype(np.uint8)
 
-    if use_multiprocessing:
-        print("Using multiprocessing.")
+def display_lut(dtype, contrast, gamma, video_max):
+    '''Returns a lookup table that maps each raw value of a video with the given
+    dtype straight to its contrast- & gamma-adjusted display value (0-255),
+    or None if the dtype isn't an unsigned integer type of at most 16 bits.'''
+
+    dtype = np.dtype(dtype)
+
+    if dtype.kind != 'u' or dtype.itemsize > 2:
+        return None
 
-        backend = 'multiprocessing'
+    values = np.arange(np.iinfo(dtype).max + 1, dtype=np.float64)
 
-        # Create the cluster
-        cm.stop_server()
-        c, dview, n_processes = cm.cluster.setup_cluster(backend=backend, n_processes=None, single_thread=False)
+    return display_image(adjust_gamma(adjust_contrast(values, contrast), gamma), video_max)
+
+def open_video(video_path):
+    # open a TIFF video as a memmap, or a virtual motion-corrected video from its shifts sidecar
+    if video_path.endswith(MC_SHIFTS_SUFFIX):
+        return MotionCorrectedVideo(video_path)
     else:
-        c           = None
-        dview       = None
-        n_processes = 1
+        return tifffile.memmap(video_path, mode='r')
 
-    group_nums = np.unique(video_groups)
+def warp_frame(frame, x_shifts, y_shifts, grid=None):
+    '''Applies a piecewise-rigid shift field (shifts of each patch along
+    the first & second axes) to a frame, the same way CaImAn does.'''
 
-    for n in range(len(group_nums)):
-        group_num = group_nums[n]
-        paths = [ video_paths[i] for i in range(len(video_paths)) if video_groups[i] == group_num ]
+    dims = frame.shape
+
+    if grid is None:
+        grid = np.meshgrid(np.arange(0., dims[1]).astype(np.float32), np.arange(0., dims[0]).astype(np.float32))
+
+    x_grid, y_grid = grid
+
+    return cv2.remap(frame, -cv2.resize(y_shifts, dims[::-1]) + x_grid, -cv2.resize(x_shifts, dims[::-1]) + y_grid, cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+class MotionCorrectedVideo():
+    '''Presents a video as a (T, Z, Y, X) array that is motion corrected on
+    the fly, using the shifts stored in a sidecar file (see ShiftsWriter)
+    instead of a motion-corrected copy of the video.'''
+
+    def __init__(self, shifts_path, transposed=False):
+        self.shifts_path = shifts_path
+        self.transposed  = transposed # whether frames are returned flipped 90 degrees
+
+        shifts = np.load(shifts_path)
+
+        self.video_path  = str(shifts['video_path'])
+        self.mc_flipped  = bool(shifts['transpose']) # whether motion correction was done on flipped frames
+        self.x_shifts    = shifts['x_shifts']
+        self.y_shifts    = shifts['y_shifts']
+        self.borders     = shifts['borders']
+
+        self.source = tifffile.memmap(self.video_path, mode='r')
+
+        if len(self.source.shape) == 3:
+            # add a z dimension
+            self.source = self.source[:, np.newaxis, :, :]
+
+        if self.transposed:
+            self.shape = self.source.shape[:2] + self.source.shape[2:][::-1]
+        else:
+            self.shape = self.source.shape
+        self.dtype = self.source.dtype
+        self.ndim  = 4
+
+        if self.mc_flipped:
+            mc_dims = self.source.shape[2:][::-1]
+        else:
+            mc_dims = self.source.shape[2:]
+        self.grid = np.meshgrid(np.arange(0., mc_dims[1]).astype(np.float32), np.arange(0., mc_dims[0]).astype(np.float32))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def transpose(self, axes):
+        if tuple(axes) != (0, 1, 3, 2):
+            raise ValueError("A motion-corrected video can only be flipped along its last two axes.")
+
+        return MotionCorrectedVideo(self.shifts_path, transposed=not self.transposed)
+
+    def __array__(self, dtype=None):
+        video = self[:]
+
+        if dtype is not None:
+            video = video.astype(dtype)
+
+        return video
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        key = key + (slice(None),)*(4 - len(key))
+
+        single_frame = isinstance(key[0], (int, np.integer))
+        single_plane = isinstance(key[1], (int, np.integer))
+
+        frame_nums = np.atleast_1d(np.arange(self.shape[0])[key[0]])
+        plane_nums = np.atleast_1d(np.arange(self.shape[1])[key[1]])
+
+        result = np.empty((len(frame_nums), len(plane_nums)) + self.shape[2:], dtype=self.dtype)
+
+        for i in range(len(frame_nums)):
+            for j in range(len(plane_nums)):
+                result[i, j] = self.corrected_frame(frame_nums[i], plane_nums[j])
+
+        result = result[(slice(None), slice(None)) + key[2:]]
+
+        if single_plane:
+            result = result[:, 0]
+        if single_frame:
+            result = result[0]
+
+        return result
+
+    def corrected_frame(self, t, z):
+        frame = self.source[t, z].astype(np.float32)
+
+        if self.mc_flipped:
+            frame = frame.T
+
+        frame = warp_frame(frame, self.x_shifts[t, z], self.y_shifts[t, z], grid=self.grid)
+
+        # zero the border, where no data was available for every frame
+        border = int(self.borders[z])
+        if border > 0:
+            frame[:border]  = 0
+            frame[-border:] = 0
+            frame[:, :border]  = 0
+            frame[:, -border:] = 0
+
+        if self.mc_flipped != self.transposed:
+            frame = frame.T
+
+        if np.issubdtype(self.dtype, np.integer):
+            frame = np.clip(np.round(frame), np.iinfo(self.dtype).min, np.iinfo(self.dtype).max)
+
+        return frame.astype(self.dtype)
 
-        video_lengths = []
+class GroupVideo():
+    '''Presents the videos in a group as a single (T, Z, Y, X) array.
 
-        directory = os.path.dirname(paths[0])
+    Frames are read on demand from the memmaps of the individual videos,
+    so no concatenated copy of the group is ever written to disk. Masked
+    pixels (masks is a (Z, Y, X) boolean array) are returned as zeros.'''
 
-        final_video_path = os.path.join(directory, "final_video_temp.tif")
+    def __init__(self, video_paths, transpose=False, masks=None):
+        self.video_paths = list(video_paths)
+        self.directory   = os.path.dirname(self.video_paths[0])
+        self.transpose   = transpose
+        self.masks       = masks
 
-        with tifffile.TiffWriter(final_video_path) as tif:
-            for i in range(len(paths)):
-                video_path = paths[i]
-                new_video_path = os.path.join(directory, "video_temp.tif")
+        if self.masks is not None and not np.any(self.masks):
+            # nothing is masked out
+            self.masks = None
 
-                shutil.copyfile(video_path, new_video_path)
+        self.open_videos()
 
-                video = tifffile.memmap(new_video_path)
+    def open_videos(self):
+        self.videos = []
+        for video_path in self.video_paths:
+            video = open_video(video_path)
 
-                if len(video.shape) == 3:
-                    # add a z dimension
-                    video = video[:, np.newaxis, :, :]
+            if len(video.shape) == 3:
+                # add a z dimension
+                video = video[:, np.newaxis, :, :]
 
+            if self.transpose:
                 # flip video 90 degrees to match what is shown in Fiji
                 video = video.transpose((0, 1, 3, 2))
 
-                video_lengths.append(video.shape[0])
+            self.videos.append(video)
+
+        self.video_lengths = [ video.shape[0] for video in self.videos ]
+        self.video_offsets = np.concatenate([[0], np.cumsum(self.video_lengths)]).astype(int)
+
+        self.shape = (int(self.video_offsets[-1]),) + tuple(self.videos[0].shape[1:])
+        self.dtype = self.videos[0].dtype
+        self.ndim  = 4
+
+    def __getstate__(self):
+        # pickle the paths rather than the memmaps, so that the video can be sent to worker processes cheaply
+        state = self.__dict__.copy()
+        del state['videos']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        self.open_videos()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        frames = key[0]
+        rest   = key[1:]
+
+        if isinstance(frames, (int, np.integer)):
+            if frames < 0:
+                frames += self.shape[0]
+
+            if frames < 0 or frames >= self.shape[0]:
+                raise IndexError("Frame {} is out of range for a group video with {} frames.".format(frames, self.shape[0]))
+
+            i = np.searchsorted(self.video_offsets, frames, side='right') - 1
+
+            return self.apply_masks(self.videos[i][(frames - self.video_offsets[i],) + rest], rest, single_frame=True)
+
+        frame_nums = np.arange(self.shape[0])[frames]
+        video_nums = np.searchsorted(self.video_offsets, frame_nums, side='right') - 1
+
+        result = None
+        for i in np.unique(video_nums):
+            positions    = np.nonzero(video_nums == i)[0]
+            local_frames = frame_nums[positions] - self.video_offsets[i]
+
+            # pass the rest of the key on to the video, so that only the requested planes are read
+            # (and, for motion-corrected videos, warped)
+            if np.all(np.diff(local_frames) == 1):
+                # read contiguous frames with a single slice
+                data = self.videos[i][(slice(local_frames[0], local_frames[-1]+1),) + rest]
+            elif all([ isinstance(k, (int, np.integer, slice)) for k in rest ]):
+                data = self.videos[i][(local_frames,) + rest]
+            else:
+                # several index arrays would be broadcast together, so apply the rest of the key separately
+                data = self.videos[i][local_frames][(slice(None),) + rest]
+
+            data = self.apply_masks(data, rest)
+
+            if result is None:
+                result = np.empty((len(frame_nums),) + data.shape[1:], dtype=data.dtype)
+
+            result[positions] = data
+
+        if result is None:
+            result = np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+
+        return result
+
+    def apply_masks(self, data, rest=(), single_frame=False):
+        if self.masks is None:
+            return data
+
+        mask = self.masks[rest]
+
+        if not single_frame:
+            mask = mask[np.newaxis]
+
+        return np.where(mask, data.dtype.type(0), data)
+
+    def plane(self, z, frames=slice(None)):
+        return self[frames, z, :, :]
+
+    def iter_chunks(self, z=None, chunk_size=500):
+        # yield (start frame, chunk) pairs, where each chunk holds at most chunk_size frames
+        for start in range(0, self.shape[0], chunk_size):
+            end = min(start + chunk_size, self.shape[0])
+
+            if z is None:
+                yield start, self[start:end]
+            else:
+                yield start, self[start:end, z, :, :]
+
+    def video_frames(self, video_index):
+        # return the range of group frames that belongs to the video at the given index
+        return int(self.video_offsets[video_index]), int(self.video_offsets[video_index+1])
+
+    def cache_key(self, cache, **transform):
+        # create a cache key for data derived from this video
+        return cache.key(self.video_paths, transpose=self.transpose, masks=array_digest(self.masks), **transform)
+
+class GroupVideoWriter():
+    '''Writes planes of a (T, Z, Y, X) video with the same layout as a
+    GroupVideo into preallocated TIFF memmaps, one per video in the group,
+    so that the whole output never has to be held in memory.'''
+
+    virtual = False
+
+    def __init__(self, video, output_paths, dtype=np.uint16):
+        self.video        = video
+        self.output_paths = list(output_paths)
+
+        self.outputs = []
+        for i in range(len(self.output_paths)):
+            start, end = video.video_frames(i)
+
+            if video.transpose:
+                # outputs are saved with the same orientation as the original videos
+                shape = (end - start, video.shape[1], video.shape[3], video.shape[2])
+            else:
+                shape = (end - start,) + video.shape[1:]
+
+            self.outputs.append(tifffile.memmap(self.output_paths[i], shape=shape, dtype=dtype))
+
+    def write_plane(self, z, images, offset=0, chunk_size=500):
+        # write plane z (a (T, Y, X) array or memmap), subtracting offset, one chunk of frames at a time
+        for i in range(len(self.outputs)):
+            start, end = self.video.video_frames(i)
+
+            for chunk_start in range(start, end, chunk_size):
+                chunk_end = min(chunk_start + chunk_size, end)
+
+                chunk = (images[chunk_start:chunk_end] - offset).astype(self.outputs[i].dtype)
+
+                if self.video.transpose:
+                    chunk = chunk.transpose((0, 2, 1))
+
+                self.outputs[i][chunk_start-start:chunk_end-start, z] = chunk
+
+            self.outputs[i].flush()
+
+    def close(self):
+        for output in self.outputs:
+            output.flush()
+
+        self.outputs = []
+
+class ShiftsWriter():
+    '''Collects the piecewise-rigid shifts of each motion-corrected plane of a
+    GroupVideo and saves them in a small sidecar file for each video in the
+    group, which can be opened as a MotionCorrectedVideo.'''
+
+    virtual = True
+
+    def __init__(self, video, output_paths):
+        self.video        = video
+        self.output_paths = list(output_paths)
+
+        self.x_shifts = [ None for z in range(video.shape[1]) ]
+        self.y_shifts = [ None for z in range(video.shape[1]) ]
+        self.borders  = np.zeros(video.shape[1], dtype=int)
+
+    def write_shifts(self, z, x_shifts, y_shifts, border):
+        self.x_shifts[z] = x_shifts
+        self.y_shifts[z] = y_shifts
+        self.borders[z]  = border
+
+    def close(self):
+        x_shifts = np.stack(self.x_shifts, axis=1)
+        y_shifts = np.stack(self.y_shifts, axis=1)
+
+        for i in range(len(self.output_paths)):
+            start, end = self.video.video_frames(i)
+
+            np.savez(self.output_paths[i], video_path=os.path.abspath(self.video.video_paths[i]), transpose=self.video.transpose,
+                     x_shifts=x_shifts[start:end], y_shifts=y_shifts[start:end], borders=self.borders)
 
-                for k in range(video.shape[0]):
-                    tif.save(video[k])
+def plane_memmap(video, z, frames=None, cache=None):
+    '''Returns the path of a C-order CaImAn memmap holding plane z of a
+    GroupVideo. If frames is given, only those frames are included. If a
+    cache is given, a previously created memmap is reused when possible.'''
 
-                del video
+    return plane_memmaps(video, z, frame_sets=[frames], cache=cache)[0]
 
-                if os.path.exists(new_video_path):
-                    os.remove(new_video_path)
+def plane_memmaps(video, z, frame_sets=[None], cache=None, chunk_size=500):
+    '''Returns the paths of C-order CaImAn memmaps holding plane z of a
+    GroupVideo, one for each set of frames in frame_sets (None = all frames).
 
-        final_video = tifffile.memmap(final_video_path)
+    Memmaps that aren't cached are written straight from the source videos
+    in a single streaming pass, without any intermediate TIFF files.'''
 
-        if len(final_video.shape) == 5:
-            final_video_path_2 = os.path.join(directory, "final_video_temp_2.tif")
-            tifffile.imsave(final_video_path_2, final_video.reshape((final_video.shape[0]*final_video.shape[1], final_video.shape[2], final_video.shape[3], final_video.shape[4])))
-            if os.path.exists(final_video_path):
-                os.remove(final_video_path)
+    num_frames = video.shape[0]
+    d1, d2     = video.shape[-2:]
+
+    memmap_paths = [ None for frames in frame_sets ]
+    outputs      = []
+
+    for i in range(len(frame_sets)):
+        frames = frame_sets[i]
+
+        if frames is not None and len(frames) == num_frames and np.array_equal(frames, np.arange(num_frames)):
+            frames = None
+
+        if cache is not None:
+            if frames is None:
+                frames_digest = None
+            else:
+                frames_digest = array_digest(np.array(frames, dtype=np.int64))
+
+            key = video.cache_key(cache, z=z, frames=frames_digest, layout="caiman_memmap_C")
+
+            memmap_paths[i] = cache.get(key)
+
+            if memmap_paths[i] is not None:
+                print("Using cached memmap for plane z={}.".format(z))
+                continue
+
+            base_name = key
+        else:
+            key       = None
+            base_name = "memmap_z_{}_{}".format(z, i)
+
+        if frames is None:
+            frames = np.arange(num_frames)
         else:
-            final_video_path_2 = final_video_path
+            frames = np.array(frames, dtype=int)
 
-        del final_video
+        # use the same naming scheme as cm.save_memmap, so that cm.load_memmap can read the file
+        memmap_path = os.path.join(video.directory, "{}_d1_{}_d2_{}_d3_1_order_C_frames_{}_.mmap".format(base_name, d1, d2, len(frames)))
 
-        mc_video, new_video_path, mc_borders[group_num] = motion_correct(final_video_path_2, max_shift, patch_stride, patch_overlap, use_multiprocessing=use_multiprocessing, c=c, dview=dview, n_processes=n_processes)
-        
-        mc_video = mc_video.transpose((0, 1, 3, 2))
+        Yr = np.memmap(memmap_path, mode='w+', dtype=np.float32, shape=(d1*d2, len(frames)), order='C')
 
-        print(len(paths))
+        # column of the memmap that each frame of the video is written to (-1 = not included)
+        columns = np.full(num_frames, -1, dtype=int)
+        columns[frames] = np.arange(len(frames))
 
-        for i in range(len(paths)):
-            print("Saving motion-corrected video for {}.".format(paths[i]))
+        outputs.append((i, key, memmap_path, Yr, columns))
+
+    if len(outputs) > 0:
+        print("Creating memmap for plane z={}...".format(z))
+
+        for start, chunk in video.iter_chunks(z=z, chunk_size=chunk_size):
+            # pixels are stored in Fortran order, one column per frame
+            chunk = chunk.reshape((chunk.shape[0], d1*d2), order='F').T.astype(np.float32)
+
+            for i, key, memmap_path, Yr, columns in outputs:
+                chunk_columns = columns[start:start+chunk.shape[1]]
+                included      = chunk_columns >= 0
+                chunk_columns = chunk_columns[included]
+
+                if len(chunk_columns) == 0:
+                    continue
+
+                if np.all(np.diff(chunk_columns) == 1):
+                    Yr[:, chunk_columns[0]:chunk_columns[-1]+1] = chunk[:, included]
+                else:
+                    Yr[:, chunk_columns] = chunk[:, included]
+
+        for i, key, memmap_path, Yr, columns in outputs:
+            Yr.flush()
+
+        # close the memmaps before they are moved into the cache
+        written = [ (i, key, memmap_path) for i, key, memmap_path, Yr, columns in outputs ]
+        del outputs, Yr
+
+        for i, key, memmap_path in written:
+            if cache is not None:
+                memmap_path = cache.add(key, memmap_path)
+
+            memmap_paths[i] = memmap_path
+
+    return memmap_paths
+
+def motion_correct_multiple_videos(video_paths, video_groups, max_shift, patch_stride, patch_overlap, progress_signal=None, thread=None, use_multiprocessing=True, num_workers=0, memory_budget=None, cluster=None, virtual=False):
+    start_time = time.time()
+
+    mc_video_paths = []
+    mc_videos  = []
+    mc_borders = {}
+
+    # start a cluster just for this run if a shared one isn't given
+    temporary_cluster = use_multiprocessing and cluster is None
+    if temporary_cluster:
+        cluster = ClusterManager()
 
+    if use_multiprocessing:
+        print("Using multiprocessing.")
+
+        c, dview, n_processes = cluster.get()
+    else:
+        c           = None
+        dview       = None
+        n_processes = 1
+
+    group_nums = np.unique(video_groups)
+
+    for n in range(len(group_nums)):
+        group_num = group_nums[n]
+        paths = [ video_paths[i] for i in range(len(video_paths)) if video_groups[i] == group_num ]
+
+        # create a virtual video of the whole group (no frames are copied)
+        video = GroupVideo(paths, transpose=True)
+
+        group_mc_video_paths = []
+        for i in range(len(paths)):
             video_path    = paths[i]
             directory     = os.path.dirname(video_path)
             filename      = os.path.basename(video_path)
-            mc_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_mc.tif")
-
-            if i == 0:
-                tifffile.imsave(mc_video_path, mc_video[:video_lengths[0]])
+            if virtual:
+                mc_video_path = os.path.join(directory, os.path.splitext(filename)[0] + MC_SHIFTS_SUFFIX)
             else:
-                tifffile.imsave(mc_video_path, mc_video[np.sum(video_lengths[:i]):np.sum(video_lengths[:i]) + video_lengths[i]])
+                mc_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_mc.tif")
+
+            group_mc_video_paths.append(mc_video_path)
+
+        if virtual:
+            # only the shifts are saved, and motion correction is applied when frames are read
+            writer = ShiftsWriter(video, group_mc_video_paths)
+        else:
+            # motion-corrected planes are streamed into the output videos as they are finished
+            writer = GroupVideoWriter(video, group_mc_video_paths)
+
+        mc_borders[group_num] = motion_correct(video, writer, max_shift, patch_stride, patch_overlap, use_multiprocessing=use_multiprocessing, c=c, dview=dview, n_processes=n_processes, num_workers=num_workers, memory_budget=memory_budget)
+
+        writer.close()
 
-            mc_video_paths.append(mc_video_path)
+        mc_video_paths += group_mc_video_paths
 
         if progress_signal is not None:
             progress_signal.emit(n)
 
-        if os.path.exists(final_video_path_2):
-            os.remove(final_video_path_2)
-            os.remove(new_video_path)
+        del video
+        del writer
 
-        del mc_video
-
-    if use_multiprocessing:
-        if backend == 'multiprocessing':
-            dview.close()
-        else:
-            try:
-                dview.terminate()
-            except:
-                dview.shutdown()
-        cm.stop_server()
+    if temporary_cluster:
+        cluster.stop()
 
     end_time = time.time()
 
@@ -167,126 +606,53 @@ def motion_correct_multiple_videos(video_paths, video_groups, max_shift, patch_s
             
     return mc_video_paths, mc_borders
 
-def motion_correct(video_path, max_shift, patch_stride, patch_overlap, use_multiprocessing=True, c=None, dview=None, n_processes=1):
-    full_video_path = video_path
-
-    directory = os.path.dirname(full_video_path)
-    filename  = os.path.basename(full_video_path)
-
-    memmap_video = tifffile.memmap(video_path)
+def motion_correct(video, writer, max_shift, patch_stride, patch_overlap, use_multiprocessing=True, c=None, dview=None, n_processes=1, num_workers=0, memory_budget=None):
+    directory = video.directory
 
-    z_range = list(range(memmap_video.shape[1]))
+    z_range = list(range(video.shape[1]))
 
-    new_video_path = os.path.join(directory, "mc_video_temp.tif")
+    mc_borders = [ None for z in z_range ]
 
-    shutil.copyfile(video_path, new_video_path)
+    if use_multiprocessing:
+        num_workers = plane_workers(video, num_workers, memory_budget)
+    else:
+        num_workers = 1
 
-    mc_video = tifffile.memmap(new_video_path).astype(np.uint16)
+    if num_workers > 1:
+        print("Motion correcting {} planes in parallel using {} workers.".format(len(z_range), num_workers))
 
-    mc_borders = [ None for z in z_range ]
+        # each plane is motion corrected within a single worker process
+        args = [ (video, z, max_shift, patch_stride, patch_overlap, None, not writer.virtual) for z in z_range ]
 
-    counter = 0
-
-    for z in z_range:
-        print("Motion correcting plane z={}...".format(z))
-        z_video_path = os.path.join(directory, os.path.splitext(filename)[0] + "_z_{}_temp.tif".format(z))
-        tifffile.imsave(z_video_path, memmap_video[:, z, :, :])
-
-        mc_video[:, z, :, :] *= 0
-
-        # --- PARAMETERS --- #
-
-        params_movie = {'fname': z_video_path,
-                        'max_shifts': (max_shift, max_shift),  # maximum allow rigid shift (2,2)
-                        'niter_rig': 3,
-                        'splits_rig': 1,  # for parallelization split the movies in  num_splits chuncks across time
-                        'num_splits_to_process_rig': None,  # if none all the splits are processed and the movie is saved
-                        'strides': (patch_stride, patch_stride),  # intervals at which patches are laid out for motion correction
-                        'overlaps': (patch_overlap, patch_overlap),  # overlap between pathes (size of patch strides+overlaps)
-                        'splits_els': 1,  # for parallelization split the movies in  num_splits chuncks across time
-                        'num_splits_to_process_els': [None],  # if none all the splits are processed and the movie is saved
-                        'upsample_factor_grid': 4,  # upsample factor to avoid smearing when merging patches
-                        'max_deviation_rigid': 3,  # maximum deviation allowed for patch with respect to rigid shift         
-                        }
-
-        # load movie (in memory!)
-        fname = params_movie['fname']
-        niter_rig = params_movie['niter_rig']
-        # maximum allow rigid shift
-        max_shifts = params_movie['max_shifts']  
-        # for parallelization split the movies in  num_splits chuncks across time
-        splits_rig = params_movie['splits_rig']  
-        # if none all the splits are processed and the movie is saved
-        num_splits_to_process_rig = params_movie['num_splits_to_process_rig']
-        # intervals at which patches are laid out for motion correction
-        strides = params_movie['strides']
-        # overlap between pathes (size of patch strides+overlaps)
-        overlaps = params_movie['overlaps']
-        # for parallelization split the movies in  num_splits chuncks across time
-        splits_els = params_movie['splits_els'] 
-        # if none all the splits are processed and the movie is saved
-        num_splits_to_process_els = params_movie['num_splits_to_process_els']
-        # upsample factor to avoid smearing when merging patches
-        upsample_factor_grid = params_movie['upsample_factor_grid'] 
-        # maximum deviation allowed for patch with respect to rigid
-        # shift
-        max_deviation_rigid = params_movie['max_deviation_rigid']
-
-        # --- RIGID MOTION CORRECTION --- #
-
-        # Load the original movie
-        m_orig = tifffile.memmap(fname)
-        # m_orig = cm.load(fname)
-        min_mov = np.min(m_orig) # movie must be mostly positive for this to work
-
-        offset_mov = -min_mov
-
-        # Create motion correction object
-        mc = MotionCorrect(fname, min_mov,
-                           dview=dview, max_shifts=max_shifts, niter_rig=niter_rig, splits_rig=splits_rig, 
-                           num_splits_to_process_rig=num_splits_to_process_rig, 
-                        strides= strides, overlaps= overlaps, splits_els=splits_els,
-                        num_splits_to_process_els=num_splits_to_process_els, 
-                        upsample_factor_grid=upsample_factor_grid, max_deviation_rigid=max_deviation_rigid, 
-                        shifts_opencv = True, nonneg_movie = True, border_nan='min')
-
-        # Do rigid motion correction
-        mc.motion_correct_rigid(save_movie=False)
-
-        # --- ELASTIC MOTION CORRECTION --- #
-
-        # Do elastic motion correction
-        mc.motion_correct_pwrigid(save_movie=True, template=mc.total_template_rig, show_template=False)
-
-        # # Save elastic shift border
-        bord_px_els = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
-                                 np.max(np.abs(mc.y_shifts_els)))).astype(np.int)
+        if isinstance(dview, multiprocessing.pool.Pool):
+            # reuse the workers of the cluster
+            pool = dview
+        else:
+            pool = multiprocessing.Pool(processes=num_workers)
 
-        fnames = mc.fname_tot_els   # name of the pw-rigidly corrected file.
-        border_to_0 = bord_px_els     # number of pixels to exclude
-        fname_new = cm.save_memmap(fnames, base_name='memmap_z_{}'.format(z), order = 'C',
-                                   border_to_0 = bord_px_els) # exclude borders
+        try:
+            # keep at most num_workers planes in flight, and copy each plane into the output video as soon as it is finished
+            running = []
+            while len(args) > 0 or len(running) > 0:
+                while len(args) > 0 and len(running) < num_workers:
+                    running.append(pool.apply_async(motion_correct_plane_worker, (args.pop(0),)))
 
-        # now load the file
-        Yr, dims, T = cm.load_memmap(fname_new)
-        d1, d2 = dims
-        images = np.reshape(Yr.T, [T] + list(dims), order='F') 
+                z, fname_new, bord_px_els, shifts = running.pop(0).get()
 
-        mc_borders[z] = bord_px_els
+                mc_borders[z] = bord_px_els
 
-        mc_video[:, z, :, :] = (images - np.amin(images)).astype(memmap_video.dtype)
+                store_motion_corrected_plane(writer, z, fname_new, bord_px_els, shifts)
+        finally:
+            if pool is not dview:
+                pool.close()
+                pool.join()
+    else:
+        for z in z_range:
+            fname_new, bord_px_els, shifts = motion_correct_plane(video, z, max_shift, patch_stride, patch_overlap, dview=dview, save_movie=not writer.virtual)
 
-        del m_orig
-        if os.path.exists(z_video_path):
-            os.remove(z_video_path)
+            mc_borders[z] = bord_px_els
 
-        try:
-            os.remove(mc.fname_tot_rig)
-            os.remove(mc.fname_tot_els)
-        except:
-            pass
-
-        counter += 1
+            store_motion_corrected_plane(writer, z, fname_new, bord_px_els, shifts)
 
     mmap_files = glob.glob(os.path.join(directory, '*.mmap'))
     for mmap_file in mmap_files:
@@ -299,29 +665,175 @@ def motion_correct(video_path, max_shift, patch_stride, patch_overlap, use_multi
     for log_file in log_files:
         os.remove(log_file)
 
-    return mc_video, new_video_path, mc_borders
+    return mc_borders
 
-def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params, mc_borders={}, progress_signal=None, thread=None, use_multiprocessing=True, method="cnmf", mask_points=[], ignored_frames=[]):
-    start_time = time.time()
+def plane_workers(video, num_workers=0, memory_budget=None):
+    '''Returns the number of planes of a GroupVideo that can be motion corrected
+    at once. num_workers is the requested number of workers (0 = one per core),
+    and memory_budget (in GB) caps how many planes are held in memory at once.'''
 
-    group_nums = np.unique(video_groups)
+    num_planes = video.shape[1]
+
+    if num_workers is None or num_workers <= 0:
+        num_workers = multiprocessing.cpu_count()
+
+    num_workers = min(num_workers, num_planes)
+
+    if memory_budget is not None and memory_budget > 0:
+        plane_size = MC_PLANE_COPIES*4*video.shape[0]*video.shape[2]*video.shape[3]
 
-    if use_multiprocessing and method == "cnmf":
-        backend = 'multiprocessing'
+        num_workers = min(num_workers, int(memory_budget*1e9 // plane_size))
 
-        # Create the cluster
-        cm.stop_server()
-        c, dview, n_processes = cm.cluster.setup_cluster(backend=backend, n_processes=None, single_thread=False)
+    return max(num_workers, 1)
+
+def motion_correct_plane_worker(args):
+    # motion correct a single plane in a worker process
+    z = args[1]
+
+    fname_new, bord_px_els, shifts = motion_correct_plane(*args)
+
+    return z, fname_new, bord_px_els, shifts
+
+def store_motion_corrected_plane(writer, z, fname_new, bord_px_els, shifts=None):
+    if writer.virtual:
+        writer.write_shifts(z, shifts[0], shifts[1], bord_px_els)
+        return
+
+    # stream a motion-corrected plane into the output videos, without loading it into memory
+    Yr, dims, T = cm.load_memmap(fname_new)
+    images = np.reshape(Yr.T, [T] + list(dims), order='F') 
+
+    writer.write_plane(z, images, offset=np.amin(Yr))
+
+    del Yr, images
+
+def motion_correct_plane(video, z, max_shift, patch_stride, patch_overlap, dview=None, save_movie=True):
+    '''Motion corrects plane z of a GroupVideo. Returns the path of the
+    motion-corrected CaImAn memmap, the border (in pixels) to exclude & the
+    piecewise-rigid shifts along each axis, as (T, grid rows, grid columns)
+    arrays. If save_movie is False, only the shifts are computed and no
+    memmap is created.'''
+
+    directory = video.directory
+
+    print("Motion correcting plane z={}...".format(z))
+    z_video_path = os.path.join(directory, "video_z_{}_temp.tif".format(z))
+
+    # write the plane one chunk at a time
+    z_video = tifffile.memmap(z_video_path, shape=(video.shape[0],) + video.shape[2:], dtype=video.dtype)
+    for start, chunk in video.iter_chunks(z=z):
+        z_video[start:start+chunk.shape[0]] = chunk
+    z_video.flush()
+    del z_video
+
+    # --- PARAMETERS --- #
+
+    params_movie = {'fname': z_video_path,
+                    'max_shifts': (max_shift, max_shift),  # maximum allow rigid shift (2,2)
+                    'niter_rig': 3,
+                    'splits_rig': 1,  # for parallelization split the movies in  num_splits chuncks across time
+                    'num_splits_to_process_rig': None,  # if none all the splits are processed and the movie is saved
+                    'strides': (patch_stride, patch_stride),  # intervals at which patches are laid out for motion correction
+                    'overlaps': (patch_overlap, patch_overlap),  # overlap between pathes (size of patch strides+overlaps)
+                    'splits_els': 1,  # for parallelization split the movies in  num_splits chuncks across time
+                    'num_splits_to_process_els': [None],  # if none all the splits are processed and the movie is saved
+                    'upsample_factor_grid': 4,  # upsample factor to avoid smearing when merging patches
+                    'max_deviation_rigid': 3,  # maximum deviation allowed for patch with respect to rigid shift         
+                    }
+
+    # load movie (in memory!)
+    fname = params_movie['fname']
+    niter_rig = params_movie['niter_rig']
+    # maximum allow rigid shift
+    max_shifts = params_movie['max_shifts']  
+    # for parallelization split the movies in  num_splits chuncks across time
+    splits_rig = params_movie['splits_rig']  
+    # if none all the splits are processed and the movie is saved
+    num_splits_to_process_rig = params_movie['num_splits_to_process_rig']
+    # intervals at which patches are laid out for motion correction
+    strides = params_movie['strides']
+    # overlap between pathes (size of patch strides+overlaps)
+    overlaps = params_movie['overlaps']
+    # for parallelization split the movies in  num_splits chuncks across time
+    splits_els = params_movie['splits_els'] 
+    # if none all the splits are processed and the movie is saved
+    num_splits_to_process_els = params_movie['num_splits_to_process_els']
+    # upsample factor to avoid smearing when merging patches
+    upsample_factor_grid = params_movie['upsample_factor_grid'] 
+    # maximum deviation allowed for patch with respect to rigid
+    # shift
+    max_deviation_rigid = params_movie['max_deviation_rigid']
+
+    # --- RIGID MOTION CORRECTION --- #
+
+    # Load the original movie
+    m_orig = tifffile.memmap(fname)
+    # m_orig = cm.load(fname)
+    min_mov = np.min(m_orig) # movie must be mostly positive for this to work
+
+    offset_mov = -min_mov
+
+    # Create motion correction object
+    mc = MotionCorrect(fname, min_mov,
+                       dview=dview, max_shifts=max_shifts, niter_rig=niter_rig, splits_rig=splits_rig, 
+                       num_splits_to_process_rig=num_splits_to_process_rig, 
+                    strides= strides, overlaps= overlaps, splits_els=splits_els,
+                    num_splits_to_process_els=num_splits_to_process_els, 
+                    upsample_factor_grid=upsample_factor_grid, max_deviation_rigid=max_deviation_rigid, 
+                    shifts_opencv = True, nonneg_movie = True, border_nan='min')
+
+    # Do rigid motion correction
+    mc.motion_correct_rigid(save_movie=False)
+
+    # --- ELASTIC MOTION CORRECTION --- #
+
+    # Do elastic motion correction
+    mc.motion_correct_pwrigid(save_movie=save_movie, template=mc.total_template_rig, show_template=False)
+
+    # # Save elastic shift border
+    bord_px_els = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
+                             np.max(np.abs(mc.y_shifts_els)))).astype(np.int)
+
+    # get the shifts of each patch, laid out on the grid of patches
+    coords    = np.stack(mc.coord_shifts_els[0], axis=1)
+    grid_dims = tuple(np.max(coords, axis=0) - np.min(coords, axis=0) + 1)
+    x_shifts  = np.stack([ np.reshape(shifts, grid_dims, order='C') for shifts in mc.x_shifts_els ], axis=0).astype(np.float32)
+    y_shifts  = np.stack([ np.reshape(shifts, grid_dims, order='C') for shifts in mc.y_shifts_els ], axis=0).astype(np.float32)
+
+    if save_movie:
+        fnames = mc.fname_tot_els   # name of the pw-rigidly corrected file.
+        border_to_0 = bord_px_els     # number of pixels to exclude
+        fname_new = cm.save_memmap(fnames, base_name='memmap_z_{}'.format(z), order = 'C',
+                                   border_to_0 = bord_px_els) # exclude borders
     else:
-        c           = None
-        dview       = None
-        n_processes = 1
+        fname_new = None
 
-    new_roi_spatial_footprints  = {}
-    new_roi_temporal_footprints = {}
-    new_roi_temporal_residuals  = {}
-    new_bg_spatial_footprints   = {}
-    new_bg_temporal_footprints  = {}
+    del m_orig
+    if os.path.exists(z_video_path):
+        os.remove(z_video_path)
+
+    for fname in (mc.fname_tot_rig, mc.fname_tot_els):
+        try:
+            os.remove(fname)
+        except:
+            pass
+
+    return fname_new, bord_px_els, (x_shifts, y_shifts)
+
+def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params, mc_borders={}, progress_signal=None, thread=None, use_multiprocessing=True, method="cnmf", mask_points=[], ignored_frames=[], cache=None, num_workers=0, cluster=None, result_cache=None, initial_rois={}, group_nums=None):
+    '''Finds ROIs in each group of videos (or only in the groups in
+    group_nums, if given). If initial_rois holds (ROI spatial footprints, ROI
+    temporal footprints, background spatial footprints, background temporal
+    footprints) for a group, the ROIs of that group are refined with CNMF
+    instead of being found from scratch.'''
+
+    start_time = time.time()
+
+    if group_nums is None:
+        group_nums = np.unique(video_groups)
+
+    # first look up the cached results of each group, so that the cluster is only started if some group needs it
+    groups = []
 
     for n in range(len(group_nums)):
         group_num = group_nums[n]
@@ -336,77 +848,101 @@ def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params,
 
         print("Ignoring frames {}.".format(group_ignored_frames))
 
-        directory = os.path.dirname(paths[0])
+        masks = None
 
-        final_video_path = os.path.join(directory, "final_video_temp.tif")
+        if len(mask_points) > 0 and group_num in mask_points.keys():
+            # get the (flipped) dimensions of the videos in the group
+            video = GroupVideo(paths, transpose=True)
 
-        with tifffile.TiffWriter(final_video_path, bigtiff=False) as tif:
-            for i in range(len(paths)):
-                video_path = paths[i]
-                new_video_path = os.path.join(directory, "video_temp.tif")
+            mask = np.zeros(video.shape[1:]).astype(np.uint8)
+            for z in range(video.shape[1]):
+                if len(mask_points[group_num][z]) > 0:
+                    for p in mask_points[group_num][z]:
+                        # create mask image
+                        p = np.fliplr(np.array(p + [p[0]])).astype(int)
 
-                shutil.copyfile(video_path, new_video_path)
+                        cv2.fillConvexPoly(mask[z, :, :], p, 1)
 
-                video = tifffile.memmap(new_video_path)
+                if np.sum(mask[z]) == 0:
+                    mask[z] = 1
 
-                if len(video.shape) == 3:
-                    # add a z dimension
-                    video = video[:, np.newaxis, :, :]
+            mask = mask.astype(bool)
 
-                video = video.transpose((0, 1, 3, 2))
+            if not params['invert_masks']:
+                mask = mask == False
 
-                if len(mask_points) > 0 and n in mask_points.keys():
-                    mask = np.zeros(video.shape[1:]).astype(np.uint8)
-                    for z in range(video.shape[1]):
-                        if len(mask_points[n][z]) > 0:
-                            for p in mask_points[n][z]:
-                                # create mask image
-                                p = np.fliplr(np.array(p + [p[0]])).astype(int)
+            masks = mask
 
-                                cv2.fillConvexPoly(mask[z, :, :], p, 1)
+        # create a virtual video of the whole group (no frames are copied)
+        video = GroupVideo(paths, transpose=True, masks=masks)
 
-                        if np.sum(mask[z]) == 0:
-                            mask[z] = 1
+        if len(mc_borders.keys()) > 0:
+            borders = mc_borders[group_num]
+        else:
+            borders = None
 
-                    mask = mask.astype(bool)
+        refine = method == "cnmf" and group_num in initial_rois.keys()
 
-                    if not params['invert_masks']:
-                        mask = mask == False
+        result_key = None
+        roi_data   = None
 
-                    mask = np.repeat(mask[np.newaxis, :, :, :], video.shape[0], axis=0)
+        if result_cache is not None and not refine:
+            result_key = roi_finding_cache_key(result_cache, video, params, method, borders, group_ignored_frames)
+            roi_data   = load_cached_rois(result_cache, result_key)
 
-                    video[mask] = 0
+        groups.append((group_num, video, borders, group_ignored_frames, refine, result_key, roi_data))
 
-                for k in range(video.shape[0]):
-                    tif.save(video[k])
+    # start a cluster just for this run if a shared one isn't given (it's only started once a group needs it)
+    temporary_cluster = use_multiprocessing and method == "cnmf" and cluster is None
+    if temporary_cluster:
+        cluster = ClusterManager()
 
-                del video
+    new_roi_spatial_footprints  = {}
+    new_roi_temporal_footprints = {}
+    new_roi_temporal_residuals  = {}
+    new_bg_spatial_footprints   = {}
+    new_bg_temporal_footprints  = {}
 
-                if os.path.exists(new_video_path):
-                    os.remove(new_video_path)
+    for n in range(len(groups)):
+        group_num, video, borders, group_ignored_frames, refine, result_key, roi_data = groups[n]
 
-        final_video = tifffile.memmap(final_video_path).astype(np.uint16)
+        c           = None
+        dview       = None
+        n_processes = 1
 
-        if len(final_video.shape) == 5:
-            final_video_path_2 = os.path.join(directory, "final_video_temp_2.tif")
-            
-            tifffile.imsave(final_video_path_2, final_video.reshape((final_video.shape[0]*final_video.shape[1], final_video.shape[2], final_video.shape[3], final_video.shape[4])))
-            if os.path.exists(final_video_path):
-                os.remove(final_video_path)
+        if roi_data is None and use_multiprocessing and method == "cnmf":
+            if not refine and own_plane_clusters(video.shape[1], num_workers, cluster):
+                # the plane workers start their own clusters, so the shared cluster (which uses every core) is released
+                if cluster.is_running():
+                    print("Stopping the cluster while planes are processed by workers with their own clusters.")
+                    cluster.stop()
+            else:
+                c, dview, n_processes = cluster.get()
+
+        if roi_data is not None:
+            print("Using cached ROIs for group {}.".format(group_num))
+
+            roi_spatial_footprints  = roi_data['roi_spatial_footprints']
+            roi_temporal_footprints = roi_data['roi_temporal_footprints']
+            roi_temporal_residuals  = roi_data['roi_temporal_residuals']
+            bg_spatial_footprints   = roi_data['bg_spatial_footprints']
+            bg_temporal_footprints  = roi_data['bg_temporal_footprints']
+        elif refine:
+            roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = refine_rois_cnmf(video, params, *initial_rois[group_num], dview=dview, n_processes=n_processes, ignored_frames=group_ignored_frames, cache=cache)
         else:
-            final_video_path_2 = final_video_path
+            if method == "cnmf":
+                roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = find_rois_cnmf(video, params, mc_borders=borders, use_multiprocessing=use_multiprocessing, c=c, dview=dview, n_processes=n_processes, ignored_frames=group_ignored_frames, cache=cache, num_workers=num_workers)
+            else:
+                roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = find_rois_suite2p(video, params, mc_borders=borders, use_multiprocessing=use_multiprocessing)
 
-        del final_video
+            if result_cache is not None:
+                roi_data = {'roi_spatial_footprints' : roi_spatial_footprints,
+                            'roi_temporal_footprints': roi_temporal_footprints,
+                            'roi_temporal_residuals' : roi_temporal_residuals,
+                            'bg_spatial_footprints'  : bg_spatial_footprints,
+                            'bg_temporal_footprints' : bg_temporal_footprints}
 
-        if len(mc_borders.keys()) > 0:
-            borders = mc_borders[group_num]
-        else:
-            borders = None
-
-        if method == "cnmf":
-            roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = find_rois_cnmf(final_video_path_2, params, mc_borders=borders, use_multiprocessing=use_multiprocessing, c=c, dview=dview, n_processes=n_processes, ignored_frames=group_ignored_frames)
-        else:
-            roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints = find_rois_suite2p(final_video_path_2, params, mc_borders=borders, use_multiprocessing=use_multiprocessing)
+                save_cached_rois(result_cache, result_key, roi_data)
 
         new_roi_spatial_footprints[group_num]  = roi_spatial_footprints
         new_roi_temporal_footprints[group_num] = roi_temporal_footprints
@@ -414,21 +950,14 @@ def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params,
         new_bg_spatial_footprints[group_num]   = bg_spatial_footprints
         new_bg_temporal_footprints[group_num]  = bg_temporal_footprints
 
-        if os.path.exists(final_video_path_2):
-            os.remove(final_video_path_2)
+        groups[n] = None
+        del video
 
         if progress_signal is not None:
             progress_signal.emit(n)
 
-    if use_multiprocessing and method == "cnmf":
-        if backend == 'multiprocessing':
-            dview.close()
-        else:
-            try:
-                dview.terminate()
-            except:
-                dview.shutdown()
-        cm.stop_server()
+    if temporary_cluster:
+        cluster.stop()
 
     end_time = time.time()
 
@@ -436,24 +965,44 @@ def find_rois_multiple_videos(video_paths, video_lengths, video_groups, params,
 
     return new_roi_spatial_footprints, new_roi_temporal_footprints, new_roi_temporal_residuals, new_bg_spatial_footprints, new_bg_temporal_footprints
 
-def find_rois_cnmf(video_path, params, mc_borders=None, use_multiprocessing=True, c=None, dview=None, n_processes=1, ignored_frames=[]):
-    full_video_path = video_path
+def roi_finding_cache_key(cache, video, params, method, mc_borders=None, ignored_frames=[]):
+    # create a key for the ROIs found in a GroupVideo, from the videos and the parameters that affect the result
+    if mc_borders is not None:
+        mc_borders = [ int(border) for border in mc_borders ]
+
+    return video.cache_key(cache, stage="find_rois", method=method,
+                           params={ name: params[name] for name in ROI_FINDING_PARAMS[method] },
+                           mc_borders=mc_borders,
+                           ignored_frames=array_digest(np.array(ignored_frames, dtype=np.int64)))
+
+def load_cached_rois(cache, key):
+    # return cached ROI data with the given key (or None if it isn't cached)
+    roi_data_path = cache.get(key)
+
+    if roi_data_path is None:
+        return None
+
+    try:
+        return np.load(roi_data_path, allow_pickle=True).item()
+    except:
+        # the file is unreadable -- forget about it
+        cache.remove(key)
 
-    directory = os.path.dirname(full_video_path)
-    filename  = os.path.basename(full_video_path)
+        return None
 
-    new_video_path = os.path.join(directory, "cnmf_video_temp.tif")
+def save_cached_rois(cache, key, roi_data):
+    roi_data_path = os.path.join(cache.directory, "{}.npy".format(key))
 
-    shutil.copyfile(video_path, new_video_path)
+    np.save(roi_data_path, roi_data)
 
-    memmap_video = tifffile.memmap(video_path)
+    cache.add(key, roi_data_path)
+
+def find_rois_cnmf(video, params, mc_borders=None, use_multiprocessing=True, c=None, dview=None, n_processes=1, ignored_frames=[], cache=None, num_workers=0):
+    directory = video.directory
     
-    kept_frames = [ i for i in range(memmap_video.shape[0]) if i not in ignored_frames ]
+    kept_frames = [ i for i in range(video.shape[0]) if i not in ignored_frames ]
 
-    if len(memmap_video.shape) == 5:
-        num_z = memmap_video.shape[2]
-    else:
-        num_z = memmap_video.shape[1]
+    num_z = video.shape[1]
 
     roi_spatial_footprints  = [ None for i in range(num_z) ]
     roi_temporal_footprints = [ None for i in range(num_z) ]
@@ -461,155 +1010,234 @@ def find_rois_cnmf(video_path, params, mc_borders=None, use_multiprocessing=True
     bg_spatial_footprints   = [ None for i in range(num_z) ]
     bg_temporal_footprints  = [ None for i in range(num_z) ]
 
+    # create the memmaps of all planes up front, so that the cache is only ever touched by this process
+    plane_args = []
     for z in range(num_z):
-        fname = os.path.splitext(filename)[0] + "_masked_z_{}.tif".format(z)
-
-        z_video_path = os.path.join(directory, fname)
-
-        if len(memmap_video.shape) == 5:
-            z_video = memmap_video[kept_frames, :, z, :, :]
-            tifffile.imsave(z_video_path, z_video.reshape((-1, memmap_video.shape[3], memmap_video.shape[4])))
-        else:
-            z_video = memmap_video[kept_frames, z, :, :]
-            tifffile.imsave(z_video_path, z_video)
-
-        # dataset dependent parameters
-        fnames     = [z_video_path]        # filename to be processed
-        fr         = params['imaging_fps'] # imaging rate in frames per second
-        decay_time = params['decay_time']  # length of a typical transient in seconds
-        
-        # parameters for source extraction and deconvolution
-        p              = params['autoregressive_order']             # order of the autoregressive system
-        gnb            = params['num_bg_components']                # number of global background components
-        merge_thresh   = params['merge_threshold']                  # merging threshold, max correlation allowed
-        if params['use_patches']:
-            rf     = params['cnmf_patch_size']
-            stride = params['cnmf_patch_stride']
+        if len(ignored_frames) > 0:
+            # get memmaps of this plane excluding ignored frames (to find ROIs) & including all frames (to compute traces
+            # for the ignored frames too), both written in the same pass through the video
+            fname_new, fname_new_2 = plane_memmaps(video, z, frame_sets=[kept_frames, None], cache=cache)
         else:
-            rf     = None # half-size of the patches in pixels. e.g., if rf=25, patches are 50x50
-            stride = None # amount of overlap between the patches in pixels
-        K              = params['num_components']                   # number of components per patch
-        gSig           = [params['half_size'], params['half_size']] # expected half size of neurons
-        init_method    = params['init_method']                      # initialization method (if analyzing dendritic data using 'sparse_nmf')
-        is_dendrites   = False                                      # flag for analyzing dendritic data
-        alpha_snmf     = None                                       # sparsity penalty for dendritic data analysis through sparse NMF
-
-        # parameters for component evaluation
-        min_SNR        = params['min_snr']          # signal to noise ratio for accepting a component
-        rval_thr       = params['min_spatial_corr'] # space correlation threshold for accepting a component
-        max_merge_area = params['max_merge_area']
+            fname_new   = plane_memmap(video, z, cache=cache)
+            fname_new_2 = None
 
         if mc_borders is not None:
             border_pix = mc_borders[z]
         else:
             border_pix = 0
 
-        fname_new = cm.save_memmap(fnames, base_name='memmap_z_{}'.format(z), order='C') # exclude borders
+        plane_args.append((fname_new, fname_new_2, video.shape[-2:], params, border_pix))
 
-        # now load the file
-        Yr, dims, T = cm.load_memmap(fname_new)
-        d1, d2 = dims
-        images = np.reshape(Yr.T, [T] + list(dims), order='F')
+    if use_multiprocessing:
+        num_workers, plane_processes = cnmf_schedule(num_z, num_workers)
+    else:
+        num_workers = 1
 
-        params_dict = {'fnames': fnames,
-                       'fr': fr,
-                       'decay_time': decay_time,
-                       'rf': rf,
-                       'stride': stride,
-                       'K': K,
-                       'gSig': gSig,
-                       'merge_thr': merge_thresh,
-                       'p': p,
-                       'nb': gnb,
-                       'init_method': init_method,
-                       'dims': memmap_video.shape[-2:],
-                       'max_merge_area': max_merge_area}
+    if num_workers > 1 and plane_processes == 1 and isinstance(dview, multiprocessing.pool.Pool):
+        print("Finding ROIs in {} planes in parallel using {} workers of the cluster.".format(num_z, num_workers))
 
-        opts = cnmf_params.CNMFParams(params_dict=params_dict)
+        # each plane only gets a single process, so reuse the workers of the cluster
+        results = {}
+        args    = [ (z,) + plane_args[z] for z in range(num_z) ]
+        running = []
+        while len(args) > 0 or len(running) > 0:
+            while len(args) > 0 and len(running) < num_workers:
+                running.append(dview.apply_async(find_rois_cnmf_plane_pool_worker, (args.pop(0),)))
 
-        cnm = cnmf.CNMF(n_processes, params=opts, dview=dview)
-        cnm = cnm.fit_file()
+            z, result = running.pop(0).get()
 
-        Yr, dims, T = cm.load_memmap(cnm.mmap_file)
-        images = np.reshape(Yr.T, [T] + list(dims), order='F')
+            results[z] = result
+    elif num_workers > 1 and dview is None:
+        print("Finding ROIs in {} planes in parallel using {} workers with {} processes each.".format(num_z, num_workers, plane_processes))
 
-        # print(Yr.shape)
+        results = run_plane_workers(find_rois_cnmf_plane_worker, [ (z, plane_args[z] + (plane_processes,)) for z in range(num_z) ], num_workers)
+    else:
+        # planes are processed one at a time, using the given cluster (if any) for the CNMF patches
+        results = {}
+        for z in range(num_z):
+            results[z] = find_rois_cnmf_plane(*plane_args[z], dview=dview, n_processes=n_processes)
 
-        cnm2 = cnm.refit(images, dview=dview)
+    for z in range(num_z):
+        roi_spatial_footprints[z], roi_temporal_footprints[z], roi_temporal_residuals[z], bg_spatial_footprints[z], bg_temporal_footprints[z] = results[z]
 
-        fname_2 = os.path.splitext(filename)[0] + "_masked_z_{}_2.tif".format(z)
+    mmap_files = glob.glob(os.path.join(directory, "*.mmap"))
+    for mmap_file in mmap_files:
+        try:
+            os.remove(mmap_file)
+        except:
+            pass
 
-        z_video_path_2 = os.path.join(directory, fname_2)
+    log_files = glob.glob('Yr*_LOG_*')
+    for log_file in log_files:
+        os.remove(log_file)
 
-        # print(memmap_video[:, z, :, :].shape)
+    return roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints
 
-        z_video_2 = memmap_video[:, z, :, :]
-        tifffile.imsave(z_video_path_2, z_video_2)
+def cnmf_schedule(num_planes, num_workers=0, num_cores=None):
+    '''Splits the available cores between planes that are processed at the same
+    time & the CNMF patches within each plane. Returns the number of planes to
+    process at once and the number of processes to give to each plane.'''
 
-        # z_video_2 = memmap_video[:, z, :, :].transpose((1, 2, 0)).reshape((memmap_video.shape[2]*memmap_video.shape[3], memmap_video.shape[0]))
-        # tifffile.imsave(z_video_path_2, z_video_2)
+    if num_cores is None:
+        num_cores = multiprocessing.cpu_count()
 
-        # fname_new_2 = cm.save_memmap([z_video_path_2], base_name='memmap_z_{}_2'.format(z), order='C') # exclude borders
+    if num_workers is None or num_workers <= 0:
+        num_workers = num_cores
 
-        # Yr_2, dims, T = cm.load_memmap(fname_new_2)
+    num_workers = max(min(num_workers, num_planes, num_cores), 1)
 
-        fname_new_2 = cm.save_memmap([z_video_path_2], base_name='memmap_z_{}_2'.format(z), order='C') # exclude borders
+    # leftover cores are used for patch parallelism within each plane
+    plane_processes = max(num_cores // num_workers, 1)
 
-        # now load the file
-        Yr_2, dims, T = cm.load_memmap(fname_new_2)
+    return num_workers, plane_processes
 
-        print(Yr_2.shape)
+def own_plane_clusters(num_planes, num_workers=0, cluster=None):
+    # whether the planes of a group are found by plane workers that start their own clusters, rather than on the cluster's
+    # workers (only possible for a multiprocessing cluster, when each plane gets a single process) or one at a time
+    num_workers, plane_processes = cnmf_schedule(num_planes, num_workers)
+
+    if num_workers <= 1:
+        return False
+
+    return plane_processes > 1 or cluster is None or cluster.backend != 'multiprocessing'
+
+def run_plane_workers(target, plane_args, num_workers):
+    '''Runs target(queue, z, *args) for each (z, args) in plane_args, with at most
+    num_workers processes at once, and returns a dictionary of the results
+    (put on the queue as (z, result) pairs) indexed by z.
+
+    Plain processes are used rather than a pool since pool workers are
+    daemonic & can't start the CaImAn clusters used for patch parallelism.'''
+
+    result_queue = multiprocessing.Queue()
+
+    pending = list(plane_args)
+    running = {}
+    results = {}
+
+    while len(pending) > 0 or len(running) > 0:
+        # start workers until all are busy
+        while len(pending) > 0 and len(running) < num_workers:
+            z, args = pending.pop(0)
+
+            process = multiprocessing.Process(target=target, args=(result_queue, z) + tuple(args))
+            process.start()
 
+            running[z] = process
+
+        # wait for a plane to finish
         try:
-            Cin = np.zeros((cnm2.A.shape[1], memmap_video.shape[0]))
-            fin = np.zeros((cnm2.b.shape[1], memmap_video.shape[0]))
-        except:
-            Cin = np.zeros((cnm2.estimates.A.shape[1], memmap_video.shape[0]))
-            fin = np.zeros((cnm2.estimates.b.shape[1], memmap_video.shape[0])) 
+            z, result = result_queue.get(timeout=1)
+        except queue.Empty:
+            # make sure that no worker has died without reporting back
+            for z in running.keys():
+                if running[z].exitcode is not None and running[z].exitcode != 0:
+                    result = None
+                    break
+            else:
+                continue
 
-        if len(ignored_frames) > 0:
-            try:
-                C, A, b, f, S, bl, c1, sn, g, YrA, lam = update_temporal_components(Yr_2, cnm2.A, cnm2.b, Cin, fin, dview=dview, p=0, method='cvx')
-
-                roi_spatial_footprints[z]  = cnm2.A
-                roi_temporal_footprints[z] = C
-                roi_temporal_residuals[z]  = YrA
-                bg_spatial_footprints[z]   = cnm2.b
-                bg_temporal_footprints[z]  = f
-            except:
-                C, A, b, f, S, bl, c1, sn, g, YrA, lam = update_temporal_components(Yr_2, cnm2.estimates.A, cnm2.estimates.b, Cin, fin, dview=dview, p=0, method='cvx')
-
-                roi_spatial_footprints[z]  = cnm2.estimates.A
-                roi_temporal_footprints[z] = C
-                roi_temporal_residuals[z]  = YrA
-                bg_spatial_footprints[z]   = cnm2.estimates.b
-                bg_temporal_footprints[z]  = f
-
-                print(roi_temporal_footprints[z].shape)
+        running.pop(z).join()
+
+        if result is None:
+            for process in running.values():
+                process.terminate()
+
+            raise Exception("Finding ROIs failed for plane z={}.".format(z))
+
+        results[z] = result
+
+    return results
+
+def find_rois_cnmf_plane_worker(queue, z, fname_new, fname_new_2, dims, params, border_pix, n_processes):
+    # find ROIs in a single plane in a worker process, using its own cluster for the CNMF patches
+    try:
+        if n_processes > 1:
+            c, dview, n_processes = cm.cluster.setup_cluster(backend='multiprocessing', n_processes=n_processes, single_thread=False)
         else:
-            try:
-                roi_spatial_footprints[z]  = cnm2.A
-                roi_temporal_footprints[z] = cnm2.C
-                roi_temporal_residuals[z]  = cnm2.YrA
-                bg_spatial_footprints[z]   = cnm2.b
-                bg_temporal_footprints[z]  = cnm2.f
-            except:
-                roi_spatial_footprints[z]  = cnm2.estimates.A
-                roi_temporal_footprints[z] = cnm2.estimates.C
-                roi_temporal_residuals[z]  = cnm2.estimates.YrA
-                bg_spatial_footprints[z]   = cnm2.estimates.b
-                bg_temporal_footprints[z]  = cnm2.estimates.f
-
-        if os.path.exists(z_video_path):
-            os.remove(z_video_path)
+            dview = None
+
+        result = find_rois_cnmf_plane(fname_new, fname_new_2, dims, params, border_pix, dview=dview, n_processes=n_processes)
+
+        if dview is not None:
+            dview.close()
+    except:
+        logging.exception("Finding ROIs failed for plane z={}.".format(z))
+
+        result = None
+
+    queue.put((z, result))
+
+def find_rois_cnmf_plane_pool_worker(args):
+    # find ROIs in a single plane in a worker of the cluster (which can't start a cluster of its own)
+    z = args[0]
+
+    return z, find_rois_cnmf_plane(*args[1:])
+
+def find_rois_cnmf_plane(fname_new, fname_new_2, dims, params, border_pix=0, dview=None, n_processes=1):
+    '''Finds ROIs in the CaImAn memmap of a single plane. If fname_new_2 (a memmap
+    that includes ignored frames) is given, traces are computed from it.'''
+
+    params_dict = cnmf_params_dict(params, [fname_new], dims)
+
+    opts = cnmf_params.CNMFParams(params_dict=params_dict)
+
+    cnm = cnmf.CNMF(n_processes, params=opts, dview=dview)
+    cnm = cnm.fit_file()
+
+    Yr, dims, T = cm.load_memmap(cnm.mmap_file)
+    images = np.reshape(Yr.T, [T] + list(dims), order='F')
+
+    # print(Yr.shape)
+
+    cnm2 = cnm.refit(images, dview=dview)
+
+    return cnmf_results(cnm2, fname_new_2, dview=dview)
 
-        if os.path.exists(z_video_path_2):
-            os.remove(z_video_path_2)
+def refine_rois_cnmf(video, params, roi_spatial_footprints, roi_temporal_footprints, bg_spatial_footprints, bg_temporal_footprints, dview=None, n_processes=1, ignored_frames=[], cache=None):
+    '''Refines existing ROIs of a GroupVideo (eg. after changing the merge
+    threshold or autoregressive order). CNMF is seeded with the given
+    footprints, so initialization is skipped and only the spatial & temporal
+    update iterations are run.'''
 
-    del memmap_video
+    directory = video.directory
 
-    if os.path.exists(new_video_path):
-        os.remove(new_video_path)
+    kept_frames = [ i for i in range(video.shape[0]) if i not in ignored_frames ]
+
+    num_z = video.shape[1]
+
+    new_roi_spatial_footprints  = [ None for i in range(num_z) ]
+    new_roi_temporal_footprints = [ None for i in range(num_z) ]
+    new_roi_temporal_residuals  = [ None for i in range(num_z) ]
+    new_bg_spatial_footprints   = [ None for i in range(num_z) ]
+    new_bg_temporal_footprints  = [ None for i in range(num_z) ]
+
+    for z in range(num_z):
+        if roi_spatial_footprints[z].shape[-1] == 0:
+            # CNMF can't be seeded with no ROIs, so a plane whose ROIs have all been removed is kept as it is
+            print("No ROIs to refine in plane z={}.".format(z))
+
+            new_roi_spatial_footprints[z]  = roi_spatial_footprints[z]
+            new_roi_temporal_footprints[z] = roi_temporal_footprints[z]
+            new_roi_temporal_residuals[z]  = np.zeros((0, video.shape[0]))
+            new_bg_spatial_footprints[z]   = bg_spatial_footprints[z]
+            new_bg_temporal_footprints[z]  = bg_temporal_footprints[z]
+
+            continue
+
+        print("Refining ROIs in plane z={}...".format(z))
+
+        if len(ignored_frames) > 0:
+            fname_new, fname_new_2 = plane_memmaps(video, z, frame_sets=[kept_frames, None], cache=cache)
+        else:
+            fname_new   = plane_memmap(video, z, cache=cache)
+            fname_new_2 = None
+
+        # seed the temporal footprints with the frames that are used for fitting
+        Cin = roi_temporal_footprints[z][:, kept_frames]
+        fin = bg_temporal_footprints[z][:, kept_frames]
+
+        new_roi_spatial_footprints[z], new_roi_temporal_footprints[z], new_roi_temporal_residuals[z], new_bg_spatial_footprints[z], new_bg_temporal_footprints[z] = refine_rois_cnmf_plane(fname_new, fname_new_2, video.shape[-2:], params, roi_spatial_footprints[z], Cin, bg_spatial_footprints[z], fin, dview=dview, n_processes=n_processes)
 
     mmap_files = glob.glob(os.path.join(directory, "*.mmap"))
     for mmap_file in mmap_files:
@@ -622,16 +1250,133 @@ def find_rois_cnmf(video_path, params, mc_borders=None, use_multiprocessing=True
     for log_file in log_files:
         os.remove(log_file)
 
-    return roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints
+    return new_roi_spatial_footprints, new_roi_temporal_footprints, new_roi_temporal_residuals, new_bg_spatial_footprints, new_bg_temporal_footprints
 
-def find_rois_suite2p(video_path, params, mc_borders=None, use_multiprocessing=True):
-    if suite2p_enabled:
-        full_video_path = video_path
+def refine_rois_cnmf_plane(fname_new, fname_new_2, dims, params, Ain, Cin, b_in, f_in, dview=None, n_processes=1):
+    # run CNMF on the memmap of a single plane, starting from the given footprints
+    params_dict = cnmf_params_dict(params, [fname_new], dims, use_patches=False)
+
+    # the number of background components is set by the seed
+    params_dict['nb'] = b_in.shape[-1]
+
+    opts = cnmf_params.CNMFParams(params_dict=params_dict)
+
+    # run on the whole plane and don't stop after initialization (which is skipped since CNMF is seeded), as refit() does
+    opts.set('patch', {'rf': None, 'stride': None, 'only_init': False})
+
+    cnm = cnmf.CNMF(n_processes, params=opts, dview=dview)
+
+    # seed CNMF with the given footprints, so that the spatial & temporal updates and merging start from them
+    cnm.estimates = estimates.Estimates(scipy.sparse.csc_matrix(Ain), b_in, Cin, f_in, dims=dims)
+    cnm.mmap_file = fname_new
+
+    Yr, dims, T = cm.load_memmap(fname_new)
+    images = np.reshape(Yr.T, [T] + list(dims), order='F')
+
+    cnm2 = cnm.fit(images)
+
+    return cnmf_results(cnm2, fname_new_2, dview=dview)
+
+def cnmf_params_dict(params, fnames, dims, use_patches=None):
+    # create a CaImAn parameters dictionary from our parameters
+    if use_patches is None:
+        use_patches = params['use_patches']
+
+    # dataset dependent parameters
+    fr         = params['imaging_fps'] # imaging rate in frames per second
+    decay_time = params['decay_time']  # length of a typical transient in seconds
+    
+    # parameters for source extraction and deconvolution
+    p              = params['autoregressive_order']             # order of the autoregressive system
+    gnb            = params['num_bg_components']                # number of global background components
+    merge_thresh   = params['merge_threshold']                  # merging threshold, max correlation allowed
+    if use_patches:
+        rf     = params['cnmf_patch_size']
+        stride = params['cnmf_patch_stride']
+    else:
+        rf     = None # half-size of the patches in pixels. e.g., if rf=25, patches are 50x50
+        stride = None # amount of overlap between the patches in pixels
+    K              = params['num_components']                   # number of components per patch
+    gSig           = [params['half_size'], params['half_size']] # expected half size of neurons
+    init_method    = params['init_method']                      # initialization method (if analyzing dendritic data using 'sparse_nmf')
+    is_dendrites   = False                                      # flag for analyzing dendritic data
+    alpha_snmf     = None                                       # sparsity penalty for dendritic data analysis through sparse NMF
+
+    # parameters for component evaluation
+    min_SNR        = params['min_snr']          # signal to noise ratio for accepting a component
+    rval_thr       = params['min_spatial_corr'] # space correlation threshold for accepting a component
+    max_merge_area = params['max_merge_area']
+
+    params_dict = {'fnames': fnames,
+                   'fr': fr,
+                   'decay_time': decay_time,
+                   'rf': rf,
+                   'stride': stride,
+                   'K': K,
+                   'gSig': gSig,
+                   'merge_thr': merge_thresh,
+                   'p': p,
+                   'nb': gnb,
+                   'init_method': init_method,
+                   'dims': dims,
+                   'max_merge_area': max_merge_area}
+
+    return params_dict
+
+def cnmf_results(cnm2, fname_new_2=None, dview=None):
+    '''Returns the footprints found by a fitted CNMF object. If fname_new_2 (a
+    memmap that includes ignored frames) is given, traces are computed from it.'''
+
+    if fname_new_2 is not None:
+        # now load the file
+        Yr_2, dims, T = cm.load_memmap(fname_new_2)
+
+        print(Yr_2.shape)
 
-        video = tifffile.memmap(video_path)
+        try:
+            Cin = np.zeros((cnm2.A.shape[1], T))
+            fin = np.zeros((cnm2.b.shape[1], T))
+        except:
+            Cin = np.zeros((cnm2.estimates.A.shape[1], T))
+            fin = np.zeros((cnm2.estimates.b.shape[1], T)) 
+
+        try:
+            C, A, b, f, S, bl, c1, sn, g, YrA, lam = update_temporal_components(Yr_2, cnm2.A, cnm2.b, Cin, fin, dview=dview, p=0, method='cvx')
 
-        directory = os.path.dirname(full_video_path)
-        filename  = os.path.basename(full_video_path)
+            roi_spatial_footprints  = cnm2.A
+            roi_temporal_footprints = C
+            roi_temporal_residuals  = YrA
+            bg_spatial_footprints   = cnm2.b
+            bg_temporal_footprints  = f
+        except:
+            C, A, b, f, S, bl, c1, sn, g, YrA, lam = update_temporal_components(Yr_2, cnm2.estimates.A, cnm2.estimates.b, Cin, fin, dview=dview, p=0, method='cvx')
+
+            roi_spatial_footprints  = cnm2.estimates.A
+            roi_temporal_footprints = C
+            roi_temporal_residuals  = YrA
+            bg_spatial_footprints   = cnm2.estimates.b
+            bg_temporal_footprints  = f
+
+            print(roi_temporal_footprints.shape)
+    else:
+        try:
+            roi_spatial_footprints  = cnm2.A
+            roi_temporal_footprints = cnm2.C
+            roi_temporal_residuals  = cnm2.YrA
+            bg_spatial_footprints   = cnm2.b
+            bg_temporal_footprints  = cnm2.f
+        except:
+            roi_spatial_footprints  = cnm2.estimates.A
+            roi_temporal_footprints = cnm2.estimates.C
+            roi_temporal_residuals  = cnm2.estimates.YrA
+            bg_spatial_footprints   = cnm2.estimates.b
+            bg_temporal_footprints  = cnm2.estimates.f
+
+    return roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints
+
+def find_rois_suite2p(video, params, mc_borders=None, use_multiprocessing=True):
+    if suite2p_enabled:
+        directory = video.directory
 
         roi_spatial_footprints  = [ None for i in range(video.shape[1]) ]
         roi_temporal_footprints = [ None for i in range(video.shape[1]) ]
@@ -643,7 +1388,7 @@ def find_rois_suite2p(video_path, params, mc_borders=None, use_multiprocessing=T
             shutil.rmtree("suite2p")
 
         for z in range(video.shape[1]):
-            fname = os.path.splitext(filename)[0] + "_masked_z_{}.h5".format(z)
+            fname = "video_masked_z_{}.h5".format(z)
 
             z_video_path = os.path.join(directory, fname)
 
@@ -722,167 +1467,207 @@ def find_rois_suite2p(video_path, params, mc_borders=None, use_multiprocessing=T
             bg_spatial_footprints[z]   = None
             bg_temporal_footprints[z]  = None
 
-            os.remove(fname)
+            os.remove(z_video_path)
             shutil.rmtree("suite2p")
 
         return roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints
 
-def filter_rois(video_paths, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, bg_spatial_footprints, bg_temporal_footprints, mean_images, params):
-    directory = os.path.dirname(video_paths[0])
+def roi_filter_metrics(video_paths, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, mean_images, params, planes=None):
+    '''Computes the per-ROI metrics used to filter the ROIs in each plane of a
+    group (see roi_quality_metrics), plus the CNN predictions if the CNN is
+    used. Only the planes in planes are computed (all of them if planes is
+    None) -- the other entries of the returned list are None.'''
 
-    final_video_path = os.path.join(directory, "final_video_temp.tif")
+    # create a virtual video of the whole group (no frames are copied)
+    video = GroupVideo(video_paths, transpose=True)
 
-    with tifffile.TiffWriter(final_video_path, bigtiff=True) as tif:
-        for i in range(len(video_paths)):
-            video_path = video_paths[i]
+    num_z = video.shape[1]
 
-            video = tifffile.memmap(video_path)
-                
-            if len(video.shape) == 3:
-                # add a z dimension
-                video = video[:, np.newaxis, :, :]
+    if planes is None:
+        planes = range(num_z)
 
-            for k in range(video.shape[0]):
-                tif.save(video[k])
+    metrics = [ None for z in range(num_z) ]
 
-            del video
+    for z in planes:
+        metrics[z] = roi_quality_metrics(video, z, roi_spatial_footprints[z], roi_temporal_footprints[z], roi_temporal_residuals[z], params['imaging_fps']/num_z, params['decay_time'])
 
-    final_video = tifffile.memmap(final_video_path)
+        if params['use_cnn']:
+            predictions, final_crops = test_cnn_on_data(roi_spatial_footprints[z], mean_images[z], params['half_size'])
 
-    if len(final_video.shape) == 5:
-        final_video_path_2 = os.path.join(directory, "final_video_temp_2.tif")
-        tifffile.imsave(final_video_path_2, final_video.reshape((final_video.shape[0]*final_video.shape[1], final_video.shape[2], final_video.shape[3], final_video.shape[4])))
-        if os.path.exists(final_video_path):
-            os.remove(final_video_path)
-    else:
-        final_video_path_2 = final_video_path
+            metrics[z]['cnn_predictions'] = predictions
+        else:
+            metrics[z]['cnn_predictions'] = None
+
+        # remember what the metrics were computed from, so that stale metrics can be detected
+        metrics[z]['params'] = { param: params[param] for param in ROI_FILTER_METRIC_PARAMS }
+        metrics[z]['params']['video_paths'] = list(video_paths)
 
-    del final_video
+    del video
 
+    return metrics
+
+def threshold_rois(metrics, params):
+    # return the ROIs in each plane that don't pass the filtering thresholds, given their metrics
     filtered_out_rois = []
 
-    memmap_video = tifffile.memmap(final_video_path_2)
+    for plane_metrics in metrics:
+        # accept ROIs that have either a high enough SNR or spatial correlation (as CaImAn does)
+        accepted = (plane_metrics['snr'] >= params['min_snr']) | (plane_metrics['r_values'] >= params['min_spatial_corr'])
+        rejected = (~accepted) | (plane_metrics['snr'] < MIN_SNR_LOWEST) | (plane_metrics['r_values'] < MIN_SPATIAL_CORR_LOWEST)
 
-    if len(memmap_video.shape) == 5:
-        n_frames = memmap_video.shape[1]
-        num_z = memmap_video.shape[2]
-        height = memmap_video.shape[3]
-        width = memmap_video.shape[4]
-    else:
-        n_frames = memmap_video.shape[0]
-        num_z = memmap_video.shape[1]
-        height = memmap_video.shape[2]
-        width = memmap_video.shape[3]
+        rejected |= (plane_metrics['area'] < params['min_area']) | (plane_metrics['area'] > params['max_area'])
+        rejected |= plane_metrics['min_zscore_diff'] < -params['artifact_decay_speed']
+        rejected |= plane_metrics['df_f'] < params['min_df_f']
 
-    for z in range(num_z):
-        directory = os.path.dirname(final_video_path_2)
-        filename  = os.path.basename(final_video_path_2)
+        predictions = plane_metrics['cnn_predictions']
 
-        fname = os.path.splitext(filename)[0] + "_masked_z_{}_d1_{}_d2_{}_d3_1_order_C_frames_{}_.mmap".format(z, height, width, n_frames)
+        if params['use_cnn'] and predictions is not None and len(predictions) == len(rejected):
+            rejected |= predictions[:, 1] > params['cnn_reject_threshold']
+            rejected &= ~(predictions[:, 0] > params['cnn_accept_threshold'])
 
-        video_path = os.path.join(directory, fname)
+        filtered_out_rois.append([ int(i) for i in np.nonzero(rejected)[0] ])
 
-        if len(memmap_video.shape) == 5:
-            tifffile.imsave(video_path, memmap_video[:, :, z, :, :].reshape((-1, memmap_video.shape[3], memmap_video.shape[4])).transpose([1, 2, 0]).astype(np.float32))
-        else:
-            tifffile.imsave(video_path, memmap_video[:, z, :, :].transpose([1, 2, 0]).astype(np.float32))
+    return filtered_out_rois
 
-        video = tifffile.memmap(video_path)
+def roi_quality_metrics(video, z, roi_spatial_footprints, roi_temporal_footprints, roi_temporal_residuals, fr, decay_time, chunk_size=500):
+    '''Computes quality metrics for the ROIs found in plane z of a group video.
 
-        dims = video.shape[:2]
+    Returns a dictionary of per-ROI arrays: 'snr', 'r_values' (spatial
+    correlation), 'area', 'min_zscore_diff' (steepest drop of the z-scored
+    trace, used to detect artifacts) and 'df_f'. The SNR and spatial
+    correlation follow CaImAn's component evaluation, but the video is
+    only read (in chunks, straight from the original memmaps) at the
+    frames around each ROI's largest peaks.'''
 
-        idx_components, idx_components_bad, SNR_comp, r_values, cnn_preds = \
-                estimate_components_quality_auto(video, roi_spatial_footprints[z], roi_temporal_footprints[z], bg_spatial_footprints[z], bg_temporal_footprints[z], 
-                                                 roi_temporal_residuals[z], params['imaging_fps']/num_z, params['decay_time'], [params['half_size'], params['half_size']], dims, 
-                                                 dview = None, min_SNR=params['min_snr'], 
-                                                 r_values_min = params['min_spatial_corr'], use_cnn = False, 
-                                                 thresh_cnn_min = params['cnn_accept_threshold'], thresh_cnn_lowest=params['cnn_reject_threshold'], gSig_range=[ (i, i) for i in range(max(1, params['half_size']-2), params['half_size']+2) ])
+    A = scipy.sparse.csc_matrix(roi_spatial_footprints)
+    C = np.asarray(roi_temporal_footprints)
 
-        if isinstance(roi_spatial_footprints[z], scipy.sparse.coo_matrix):
-            f = roi_spatial_footprints[z].toarray()
-        else:
-            f = roi_spatial_footprints[z]
+    num_rois = A.shape[1]
 
-        size_neurons_gt = (f > 0).sum(0)
-        neurons_to_discard = np.where((size_neurons_gt < params['min_area']) | (size_neurons_gt > params['max_area']))[0]
+    if num_rois == 0:
+        return { name: np.zeros(0) for name in ('snr', 'r_values', 'area', 'min_zscore_diff', 'df_f') }
 
-        idx_components_bad = np.union1d(idx_components_bad, neurons_to_discard)
+    if roi_temporal_residuals is None or np.shape(roi_temporal_residuals) != C.shape:
+        # residuals are not available (or out of date, eg. after ROIs have been merged)
+        traces = C
+    else:
+        traces = C + np.asarray(roi_temporal_residuals)
 
-        zscores = (roi_temporal_footprints[z] - np.mean(roi_temporal_footprints[z], axis=1)[:, np.newaxis])/np.std(roi_temporal_footprints[z], axis=1)[:, np.newaxis]
-        zscore_diffs = np.diff(zscores, axis=0)
-        min_zscore_diffs = np.amin(zscore_diffs, axis=1)
+    metrics = {}
 
-        neurons_to_discard = np.where(min_zscore_diffs < -params['artifact_decay_speed'])[0]
+    metrics['snr']      = trace_snr(traces, fr, decay_time)
+    metrics['r_values'] = spatial_correlations(video, z, A, C, chunk_size=chunk_size)
+    metrics['area']     = footprint_stats(A, video.shape[2:], order='F')['area']
 
-        idx_components_bad = np.union1d(idx_components_bad, neurons_to_discard)
+    zscores = (C - np.mean(C, axis=1)[:, np.newaxis])/np.std(C, axis=1)[:, np.newaxis]
+    if C.shape[1] > 1:
+        metrics['min_zscore_diff'] = np.amin(np.diff(zscores, axis=1), axis=1)
+    else:
+        metrics['min_zscore_diff'] = np.zeros(num_rois)
 
-        abs_traces = np.abs(roi_temporal_footprints[z])
-        df_f = np.abs(np.amax(roi_temporal_footprints[z], axis=1) - np.amin(roi_temporal_footprints[z], axis=1))/np.mean(abs_traces[:, :10])
+    abs_traces = np.abs(C)
+    metrics['df_f'] = np.abs(np.amax(C, axis=1) - np.amin(C, axis=1))/np.mean(abs_traces[:, :10])
 
-        neurons_to_discard = np.where(df_f < params['min_df_f'])[0]
+    return metrics
 
-        idx_components_bad = np.union1d(idx_components_bad, neurons_to_discard)
+def trace_snr(traces, fr, decay_time):
+    # estimate the SNR of each trace from how exceptional its largest events are (as CaImAn does)
+    num_samples = max(1, int(np.ceil(fr*decay_time)))
 
-        if params['use_cnn']:
-            predictions, final_crops = test_cnn_on_data(roi_spatial_footprints[z], mean_images[z], params['half_size'])
+    # remove a slowly-varying baseline
+    baseline_size = int(min(traces.shape[-1]/5, 800))
+    if baseline_size > 1:
+        traces = traces - scipy.ndimage.percentile_filter(traces, 8, size=[1, baseline_size])
 
-            neurons_to_discard = [ i for i in range(predictions.shape[0]) if predictions[i, 1] > params['cnn_reject_threshold'] ]
+    fitness, _, _, _ = compute_event_exceptionality(traces, N=num_samples)
 
-            neurons_to_keep = [ i for i in range(predictions.shape[0]) if predictions[i, 0] > params['cnn_accept_threshold'] ]
+    return -scipy.stats.norm.ppf(np.exp(fitness/num_samples))
 
-            idx_components_bad = np.union1d(idx_components_bad, neurons_to_discard)
+def spatial_correlations(video, z, A, C, chunk_size=500, num_peaks=10, peak_threshold=0.3, frames_before=3, frames_after=10):
+    # correlate each spatial footprint with the mean image of the frames around its largest peaks (as CaImAn does),
+    # reading only those frames from the video
+    num_rois = A.shape[1]
+    dims     = video.shape[2:]
 
-            idx_components_bad = [ i for i in idx_components_bad if i not in neurons_to_keep ]
+    intervals = find_activity_intervals(C, Npeaks=num_peaks, tB=-frames_before, tA=frames_after, thres=peak_threshold)
 
-        filtered_out_rois.append(list(idx_components_bad))
+    # find overlapping ROIs (any ROIs that share a pixel, as in CaImAn)
+    overlaps = (A.T @ A).toarray()
+    np.fill_diagonal(overlaps, 0)
 
-        if os.path.exists(video_path):
-            try:
-                os.remove(video_path)
-            except:
-                pass
+    roi_frames = []
+    roi_pixels = []
+    for i in range(num_rois):
+        footprint = A[:, i]
+        pixels    = footprint.indices[footprint.data > 0]
 
-        del video
+        roi_pixels.append(np.unravel_index(pixels, dims, order='F'))
 
-    del memmap_video
+        if intervals[i] is None or len(pixels) < 3:
+            roi_frames.append(None)
+            continue
 
-    if os.path.exists(final_video_path_2):
-        os.remove(final_video_path_2)
+        # only use frames where overlapping ROIs are not active, if there are any
+        frames = set(intervals[i])
+        for j in np.nonzero(overlaps[:, i] > 0)[0]:
+            if intervals[j] is not None:
+                frames -= set(intervals[j])
 
-    mmap_files = glob.glob(os.path.join(directory, "*.mmap"))
-    for mmap_file in mmap_files:
-        try:
-            os.remove(mmap_file)
-        except:
-            pass
+        if len(frames) == 0:
+            frames = set(intervals[i])
 
-    log_files = glob.glob('Yr*_LOG_*')
-    for log_file in log_files:
-        os.remove(log_file)
+        roi_frames.append(np.array(sorted(frames), dtype=int))
 
-    return filtered_out_rois
+    sums = [ np.zeros(len(rows)) for rows, cols in roi_pixels ]
 
-def get_roi_containing_point(spatial_footprints, roi_point, video_shape):
-    flattened_point = roi_point[0]*video_shape[0] + roi_point[1]
+    active_frames = [ frames for frames in roi_frames if frames is not None ]
+    if len(active_frames) > 0:
+        active_frames = np.unique(np.concatenate(active_frames))
+    else:
+        active_frames = np.zeros(0, dtype=int)
 
-    if flattened_point >= video_shape[0]*video_shape[1]:
-        return None
+    for start in range(0, len(active_frames), chunk_size):
+        chunk_frames = active_frames[start:start+chunk_size]
 
-    try:
-        spatial_footprints = spatial_footprints.toarray()
-    except:
-        pass
+        chunk = video[chunk_frames, z, :, :]
 
-    if spatial_footprints is not None:
-        roi = np.argmax(spatial_footprints[flattened_point, :])
-        
-        if spatial_footprints[flattened_point, roi] != 0:
+        for i in range(num_rois):
+            if roi_frames[i] is None:
+                continue
 
-            print(np.sum(spatial_footprints[:, roi] > 0))
-            return roi
-    else:
+            frames = roi_frames[i][(roi_frames[i] >= chunk_frames[0]) & (roi_frames[i] <= chunk_frames[-1])]
+
+            if len(frames) == 0:
+                continue
+
+            positions  = np.searchsorted(chunk_frames, frames)
+            rows, cols = roi_pixels[i]
+
+            sums[i] += chunk[positions[:, np.newaxis], rows[np.newaxis, :], cols[np.newaxis, :]].sum(0, dtype=np.float64)
+
+    r_values = np.zeros(num_rois)
+    for i in range(num_rois):
+        if roi_frames[i] is None:
+            continue
+
+        mean_image = sums[i]/len(roi_frames[i])
+        footprint  = A[:, i]
+        weights    = footprint.data[footprint.data > 0]
+
+        if np.std(mean_image) > 0 and np.std(weights) > 0:
+            r_values[i] = np.corrcoef(mean_image, weights)[0, 1]
+
+    return r_values
+
+def get_roi_containing_point(roi_label_map, roi_point, video_shape):
+    # roi_label_map is a footprints.ROILabelMap of the plane's spatial footprints
+    flattened_point = roi_point[0]*video_shape[0] + roi_point[1]
+
+    if roi_label_map is None or flattened_point >= video_shape[0]*video_shape[1]:
         return None
 
+    return roi_label_map.roi_at(flattened_point)
+
 def blend_transparent(face_img, overlay_t_img):
     # Split out the transparency mask from the colour info
     overlay_img = overlay_t_img[:,:,:3] # Grab the BRG planes
@@ -903,6 +1688,34 @@ def blend_transparent(face_img, overlay_t_img):
     # And finally just add them together, and rescale it back to an 8bit integer image    
     return np.uint8(cv2.addWeighted(face_part, 255.0, overlay_part, 255.0, 0.0))
 
+def trace_correlations(traces):
+    # return the correlation matrix of the rows of traces (as np.corrcoef does, except that constant rows are uncorrelated with every row)
+    centered = traces - np.mean(traces, axis=1)[:, np.newaxis]
+    norms    = np.sqrt(np.sum(centered**2, axis=1))
+
+    norms[norms == 0] = np.inf
+
+    normalized = centered/norms[:, np.newaxis]
+
+    return np.dot(normalized, normalized.T)
+
+def correlation_order(correlations):
+    '''Returns an order of the rows of a correlation matrix in which
+    correlated rows are next to each other: the leaf order of an
+    average-linkage hierarchical clustering, with 1 - correlation as the
+    distance between rows.'''
+
+    if correlations.shape[0] < 3:
+        return np.arange(correlations.shape[0])
+
+    distances = 1 - np.nan_to_num(correlations)
+    distances = np.maximum((distances + distances.T)/2, 0)
+    np.fill_diagonal(distances, 0)
+
+    linkage = scipy.cluster.hierarchy.linkage(scipy.spatial.distance.squareform(distances, checks=False), method='average')
+
+    return scipy.cluster.hierarchy.leaves_list(linkage)
+
 def calculate_tail_beat_frequency(fps, tail_angle_array):
     tail_angles = tail_angle_array.copy()
 
@@ -1028,11 +1841,10 @@ def preprocess_spatial_footprints(roi_spatial_footprints, mean_image, crop_size,
     crop = (crop_size, crop_size)
 
     dims = np.array(dims)
-    coms = [scipy.ndimage.center_of_mass(
-        mm.toarray().reshape(dims, order='F')) for mm in roi_spatial_footprints.tocsc().T]
+    coms = np.nan_to_num(footprint_stats(roi_spatial_footprints, dims, order='F')['center_of_mass'])
     coms = np.maximum(coms, crop)
     coms = np.array([np.minimum(cms, dims - crop)
-                     for cms in coms]).astype(np.int)
+                     for cms in coms]).astype(int)
 
     crop_imgs = [mm.toarray().reshape(dims, order='F')[com[0] - crop[0]:com[0] + crop[0],
                                                        com[1] - crop[1]:com[1] + crop[1]] for mm, com in zip(roi_spatial_footprints.tocsc().T, coms)]
@@ -1042,8 +1854,9 @@ def preprocess_spatial_footprints(roi_spatial_footprints, mean_image, crop_size,
                             com[1] - crop[1]:com[1] + crop[1]] for com in coms]
 
     if roi_overlays is not None:
-        overlay_crops = [roi_overlays[i, coms[i][0] - crop[0]:coms[i][0] + crop[0],
-                                coms[i][1] - crop[1]:coms[i][1] + crop[1], :] for i in range(len(coms))]
+        # roi_overlays is a roi_overlays.ROIOverlays store
+        overlay_crops = [roi_overlays.crop(i, coms[i][0] - crop[0], coms[i][0] + crop[0],
+                                           coms[i][1] - crop[1], coms[i][1] + crop[1]) for i in range(len(coms))]
 
     final_crops = np.array([cv2.resize(
         im / np.linalg.norm(im), (50, 50)) for im in crop_imgs])[:, :, :, np.newaxis]
@@ -1216,53 +2029,17 @@ def create_dataset_subset(images, labels, kept_rois):
     return final_images, labels
 
 def merge_rois(rois, roi_spatial_footprints, roi_temporal_footprints, bg_spatial_footprints, bg_temporal_footprints, roi_temporal_residuals, video_paths, z, params):
-    directory = os.path.dirname(video_paths[0])
-
-    final_video_path = os.path.join(directory, "final_video_temp.tif")
-
-    with tifffile.TiffWriter(final_video_path, bigtiff=False) as tif:
-        for i in range(len(video_paths)):
-            video_path = video_paths[i]
-            new_video_path = os.path.join(directory, "video_temp.tif")
-
-            shutil.copyfile(video_path, new_video_path)
-
-            video = tifffile.memmap(new_video_path)
-
-            if len(video.shape) == 3:
-                # add a z dimension
-                video = video[:, np.newaxis, :, :]
-
-            video = video.transpose((0, 1, 3, 2))[:, z, :, :]
-
-            dims = video.shape[-2:]
-
-            for k in range(video.shape[0]):
-                tif.save(video[k])
-
-            del video
-
-            if os.path.exists(new_video_path):
-                os.remove(new_video_path)
-
-    final_video = tifffile.memmap(final_video_path).astype(np.uint16)
-
-    if len(final_video.shape) == 5:
-        final_video_path_2 = os.path.join(directory, "final_video_temp_2.tif")
-        tifffile.imsave(final_video_path_2, final_video.reshape((final_video.shape[0]*final_video.shape[1], final_video.shape[2], final_video.shape[3], final_video.shape[4])))
-        if os.path.exists(final_video_path):
-            os.remove(final_video_path)
-    else:
-        final_video_path_2 = final_video_path
+    # create a virtual video of the whole group (no frames are copied)
+    video = GroupVideo(video_paths, transpose=True)
 
-    del final_video
+    dims = video.shape[-2:]
 
     est = estimates.Estimates(roi_spatial_footprints, bg_spatial_footprints, roi_temporal_footprints, bg_temporal_footprints, roi_temporal_residuals)
 
     est.YrA = est.R
 
     # dataset dependent parameters
-    fnames     = [final_video_path_2]  # filename to be processed
+    fnames     = video.video_paths     # filenames to be processed
     fr         = params['imaging_fps'] # imaging rate in frames per second
     decay_time = params['decay_time']  # length of a typical transient in seconds
     
@@ -1308,7 +2085,6 @@ def merge_rois(rois, roi_spatial_footprints, roi_temporal_footprints, bg_spatial
     roi_spatial_footprints = est.A
     roi_temporal_footprints = est.C
 
-    if os.path.exists(final_video_path_2):
-        os.remove(final_video_path_2)
+    del video
 
     return roi_spatial_footprints, roi_temporal_footprints
\ No newline at end of file
@@ -0,0 +1,143 @@
+'''
+Per-video statistics (maximum, per-plane mean/max/std images, percentiles)
+that are stored in a sidecar file next to each video.
+
+The statistics are computed in a single streaming pass over the video the
+first time they are needed, and then loaded from the sidecar. A sidecar is
+only used if the size and modification time of the video (and, for virtual
+motion-corrected videos, of their source video) still match the ones it was
+computed from.
+'''
+
+import os
+import json
+import numpy as np
+
+from cache import file_identity
+import utilities
+
+# suffix of the sidecar files that hold the statistics of a video
+STATS_SUFFIX = "_stats.npz"
+
+# version of the sidecar format -- bump this to invalidate existing sidecars
+STATS_VERSION = 1
+
+# percentiles of each plane's values that are stored
+PERCENTILES = [0.1, 1, 5, 50, 95, 99, 99.9]
+
+# number of frames that are sampled (evenly) to estimate the percentiles of non-integer videos
+MAX_PERCENTILE_FRAMES = 100
+
+def stats_path(video_path):
+    return os.path.splitext(video_path)[0] + STATS_SUFFIX
+
+def video_identity(video_path):
+    # identify a video by its files, so that stale statistics can be detected
+    identity = [file_identity(video_path)]
+
+    if video_path.endswith(utilities.MC_SHIFTS_SUFFIX):
+        # virtual motion-corrected videos also depend on the video they are computed from
+        identity.append(file_identity(str(np.load(video_path)['video_path'])))
+
+    return json.dumps({'version': STATS_VERSION, 'files': identity})
+
+def load_video_stats(video_path, chunk_size=500):
+    '''Returns the statistics of a video (see compute_video_stats), loading them
+    from the video's sidecar if it's up to date, or computing them (and
+    writing the sidecar) otherwise.'''
+
+    path     = stats_path(video_path)
+    identity = video_identity(video_path)
+
+    if os.path.exists(path):
+        try:
+            stats = np.load(path)
+
+            if str(stats['identity']) == identity:
+                return { key: stats[key] for key in stats.files if key != 'identity' }
+        except:
+            pass
+
+    print("Computing statistics of {}...".format(video_path))
+
+    stats = compute_video_stats(video_path, chunk_size=chunk_size)
+
+    try:
+        temp_path = path + ".temp.npz"
+
+        np.savez(temp_path, identity=identity, **stats)
+
+        os.replace(temp_path, path)
+    except:
+        # the video's folder may not be writable -- the statistics will just be computed again next time
+        print("Could not save statistics of {}.".format(video_path))
+
+    return stats
+
+def compute_video_stats(video_path, chunk_size=500):
+    '''Computes the statistics of a video in a single streaming pass. Returns a
+    dictionary with:
+
+        'shape'        : (T, Z, Y, X) shape of the video
+        'max'          : maximum value
+        'mean_images'  : (Z, Y, X) mean of each plane
+        'max_images'   : (Z, Y, X) maximum of each plane
+        'std_images'   : (Z, Y, X) standard deviation of each plane
+        'percentiles'  : (Z, len(PERCENTILES)) percentiles of each plane's values
+        'percentile_qs': the percentiles that were computed (PERCENTILES)
+
+    Percentiles are exact for 8- & 16-bit unsigned integer videos, and
+    estimated from a sample of frames otherwise.'''
+
+    video = utilities.GroupVideo([video_path])
+
+    num_frames, num_z = video.shape[:2]
+
+    sums        = np.zeros(video.shape[1:])
+    square_sums = np.zeros(video.shape[1:])
+    max_images  = np.full(video.shape[1:], -np.inf)
+
+    exact_percentiles = video.dtype.kind == 'u' and video.dtype.itemsize <= 2
+
+    if exact_percentiles:
+        # count how often each value occurs in each plane
+        histograms = np.zeros((num_z, np.iinfo(video.dtype).max + 1), dtype=np.int64)
+    else:
+        sampled_frames = set(np.linspace(0, num_frames - 1, min(num_frames, MAX_PERCENTILE_FRAMES)).astype(int))
+        samples        = [ [] for z in range(num_z) ]
+
+    for start, chunk in video.iter_chunks(chunk_size=chunk_size):
+        chunk = np.asarray(chunk)
+
+        sums        += np.sum(chunk, axis=0, dtype=np.float64)
+        square_sums += np.sum(np.square(chunk, dtype=np.float64), axis=0)
+        max_images   = np.maximum(max_images, np.amax(chunk, axis=0))
+
+        for z in range(num_z):
+            if exact_percentiles:
+                histograms[z] += np.bincount(chunk[:, z].ravel(), minlength=histograms.shape[1])
+            else:
+                frames = [ i for i in range(chunk.shape[0]) if start + i in sampled_frames ]
+
+                if len(frames) > 0:
+                    samples[z].append(chunk[frames, z].ravel())
+
+    mean_images = sums/num_frames
+    std_images  = np.sqrt(np.maximum(square_sums/num_frames - mean_images**2, 0))
+
+    percentiles = np.zeros((num_z, len(PERCENTILES)))
+    for z in range(num_z):
+        if exact_percentiles:
+            # smallest value whose cumulative count reaches each percentile
+            cumulative_counts = np.cumsum(histograms[z])
+            percentiles[z]    = np.searchsorted(cumulative_counts, np.array(PERCENTILES)/100.0*cumulative_counts[-1])
+        else:
+            percentiles[z] = np.percentile(np.concatenate(samples[z]), PERCENTILES)
+
+    return {'shape'        : np.array(video.shape),
+            'max'          : np.amax(max_images),
+            'mean_images'  : mean_images,
+            'max_images'   : max_images.astype(video.dtype),
+            'std_images'   : std_images,
+            'percentiles'  : percentiles,
+            'percentile_qs': np.array(PERCENTILES)}